@@ -1,4 +1,4 @@
-__version__ = '20260103.000'
+__version__ = '20261017.022'
 
 '''
     Provides methods to call ConnctWise API for incident creation and update
@@ -13,16 +13,73 @@ __version__ = '20260103.000'
     20251204.001    added truncation for max ticket summary length of 100
     20251205.000    added method get_tickets which retrieves tickets modified since TS
     20260103.000    updated get_tickets with pagination
+    20261017.000    all API calls go through a pooled keep-alive session (get_pool_stats for reuse counters)
+    20261017.001    added AsyncConnectWise - asyncio (aiohttp) versions of the operations used by the sync loop
+    20261017.002    member email lookups are served from an LRU / TTL cache (optional warm-up and persistence)
+    20261017.003    get_company is served from an in-memory company directory (bulk loaded, refreshed incrementally)
+    20261017.004    boards / priorities / statuses are cached and validated at startup - ticket creation is a single POST
+    20261017.005    audit records are fetched once per ticket per sync cycle (clear_audit_cache starts a new cycle)
+    20261017.006    get_audit_records can page through only the records after a per-ticket cursor (get_audit_cursor)
+    20261017.007    get_ticket_notes is paginated and can page through only the notes updated after a per-ticket cursor
+    20261017.008    ticket / audit / note / member reads request only the fields the sync uses (cw_fields) - get_payload_stats
+    20261017.009    get_tickets counts the matching tickets first and fetches the pages concurrently
+    20261017.010    added iter_tickets - yields tickets page by page (get_tickets collects it)
+    20261017.011    iter_tickets can be limited to a list of ticket ids (id in (...) chunked to cw_max_conditions_length)
+    20261017.012    429/5xx responses and connection errors are retried with jittered backoff (sync and async clients)
+                    AsyncConnectWise runs the blocking company directory / reference data refreshes in the executor
+    20261017.013    cw_fields_measure (extra unprojected GET per call site) is off by default - payload bytes from Content-Length
+    20261017.014    get_audit_records pages through the whole audit trail without a cursor too (cw_audit_page_size)
+    20261017.015    company directory is kept by company id so renamed companies drop their old name; one refresh at a time
+    20261017.016    AsyncConnectWise uses per socket connect / read timeouts and retries timeouts like read errors
+    20261017.017    read timeouts (cw_request_timeout) are retried for idempotent methods instead of ending the cycle
+    20261017.018    cw_fields_measure is on by default again so the bytes saved are reported (one extra GET per call site)
+    20261017.019    iter_tickets only re-queries the id gaps between the pages received after drift or a failed page
+    20261017.020    one reference data reload at a time - a failed reload is retried after 5 minutes, not on every ticket
+    20261017.021    added release_audit_records - the sync drops a ticket's audit records once it is done with it
+    20261017.022    member cache is saved through a temp file; members without an email are cached as well
 
 '''
 
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from email.utils import parsedate_to_datetime
 import json
+import os, sys
+import hashlib
+import threading
+import asyncio
+import math
+import random
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep
+from collections import namedtuple, OrderedDict, deque
 from datetime import datetime
+try:
+    import aiohttp
+except ImportError:
+    # only needed for AsyncConnectWise
+    aiohttp = None
+
+# status / body / headers of an aiohttp response, read so the async methods parse it the same way as a requests response
+AsyncResponse = namedtuple('AsyncResponse', ['status_code', 'text', 'headers'])
+
+# response codes that are retried by ConnectWise._send - POST only on 429 (the others may come after it was applied)
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'PATCH']
+
+# fields= projection per call site - what connectwise-case-sync.py reads from each response ('' = full objects)
+DEFAULT_CW_FIELDS = {
+    'tickets': 'id,status/name,owner,_info/lastUpdated',
+    'ticket': 'id,status/name,owner,_info/lastUpdated',
+    'audit': 'text,enteredDate,enteredBy,auditType,auditSubType,auditSource',
+    'notes': 'id,text,_info/lastUpdated',
+    'member': 'primaryEmail'
+}
 
 class ConnectWise:
 
-    def __init__(self, logger, config={}, public_key=''):
+    def __init__(self, logger, config={}, public_key='', optional_data_path=None):
 
         self.l = logger
         self.l.info('Stellar-ConnectWise version: [{}]'.format(__version__))
@@ -55,11 +112,82 @@ class ConnectWise:
         self.headers = {'Accept': 'application/json', 'Content-type': 'application/json',
                      'clientId': '{}'.format(self.cw_client_id)}
         self.auth = ('{}+{}'.format(self.cw_company_id, self.cw_public_key), '{}'.format(self.cw_private_key))
+
+        # added 20261017.000 - pooled keep-alive session shared by all API calls
+        self.cw_pool_size = int(config.get('cw_pool_size', 10))
+        self.cw_request_timeout = config.get('cw_request_timeout', 60)
+        self.cw_max_retries = int(config.get('cw_max_retries', 3))
+        self.cw_retry_backoff = float(config.get('cw_retry_backoff', 1))
+        self.cw_retry_max_wait = 60
+        self.request_cnt = 0
+        self.request_lock = threading.Lock()
+        self.session = self._make_session()
         self.base_url = 'https://{}/{}/apis/3.0'.format(self.cw_host, self._get_company_info())
 
         # preload the default (fallback) company to avoid useless lookups
         self.cw_default_company_id = self.get_default_company_id()
 
+        # added 20261017.003 - in-memory company directory (seconds between incremental refreshes - 0 to disable)
+        self.company_directory_refresh = int(ticket_config.get('company_directory_refresh', 3600))
+        self.company_directory = {}
+        # id -> name key of every known company - the name directory is rebuilt from it, so renames drop the old name
+        self.company_directory_ids = {}
+        self.company_directory_misses = set()
+        self.company_directory_ts = 0
+        self.company_directory_lock = threading.Lock()
+        if self.company_directory_refresh and not self.cw_avoid_company_lookup:
+            self.load_company_directory()
+
+        # added 20261017.004 - boards / priorities / statuses (seconds between reloads)
+        self.reference_data_refresh = int(ticket_config.get('reference_data_refresh', 86400))
+        self.boards = {}
+        self.priorities = {}
+        self.statuses = {}
+        self.reference_data_ts = 0
+        # a failed reload is tried again after this many seconds instead of on every ticket
+        self.reference_data_retry = min(self.reference_data_refresh, 300)
+        self.reference_data_lock = threading.Lock()
+        self.load_reference_data()
+        self.validate_reference_data()
+
+        # added 20261017.005 - audit trail per ticket for the current sync cycle
+        self.audit_cache = {}
+        self.audit_cache_lock = threading.Lock()
+        # added 20261017.006 - page size for cursor based audit retrieval
+        self.audit_page_size = int(config.get('cw_audit_page_size', 100))
+        self.notes_page_size = int(config.get('cw_notes_page_size', 100))
+        # added 20261017.009 - get_tickets paging (CW caps pageSize at 1000)
+        self.tickets_page_size = min(int(config.get('cw_tickets_page_size', 1000)), 1000)
+        self.tickets_page_workers = max(int(config.get('cw_tickets_page_workers', 4)), 1)
+        # added 20261017.011 - longest conditions string sent when polling a list of ticket ids
+        self.max_conditions_length = int(config.get('cw_max_conditions_length', 2000))
+
+        # added 20261017.008 - fields= projections (cw_fields overrides the defaults per call site)
+        self.fields = dict(DEFAULT_CW_FIELDS)
+        self.fields.update(config.get('cw_fields', {}) or {})
+        # repeats the first request per call site once without the projection to estimate the bytes saved
+        # (one extra GET per call site for the life of the process)
+        self.fields_measure = config.get('cw_fields_measure', True)
+        self.payload_stats = {}
+        self.payload_lock = threading.Lock()
+
+        # added 20261017.002 - member (ticket owner) email cache
+        self.member_cache = lru_ttl_cache(max_size=int(config.get('cw_member_cache_size', 500)),
+                                          ttl=int(config.get('cw_member_cache_ttl', 3600)))
+        self.member_cache_file = ''
+        if config.get('cw_member_cache_persist', False):
+            data_path = os.path.dirname(os.path.realpath(sys.argv[0]))
+            if optional_data_path:
+                if str(optional_data_path).startswith("/"):
+                    data_path = optional_data_path
+                else:
+                    data_path = "{}/{}".format(data_path, optional_data_path)
+            self.member_cache_file = "{}/cw_member_cache.json".format(data_path)
+            loaded_cnt = self.member_cache.load(self.member_cache_file)
+            self.l.info("Loaded cached member emails: [{}]".format(loaded_cnt))
+        if config.get('cw_member_cache_warmup', False):
+            self.warm_member_cache()
+
 
     def get_version(self):
         return __version__
@@ -68,7 +196,7 @@ class ConnectWise:
         ret = False
         url = "{}{}".format(self.base_url, '/system/info')
         self.l.info("Testing connection to: [{}]".format(url))
-        r = requests.get(url=url, headers=self.headers, auth=self.auth)
+        r = self._get(url)
         rr = json.loads(r.text)
         printable_r = json.dumps(rr, indent=4, sort_keys=True)
         # self.l.debug(printable_r)
@@ -84,13 +212,11 @@ class ConnectWise:
 
     def get_ticket(self, ticket_id):
         _URL_ = self.base_url
-        _AUTH_ = self.auth
-        _HEADERS_ = self.headers
         l = self.l
         l.info("Getting ticket: [{}]".format(ticket_id))
         rr = {}
         url = "{}/service/tickets/{}".format(_URL_, ticket_id)
-        r = requests.get(url=url, headers=_HEADERS_, auth=_AUTH_)
+        r = self._get_fields(url, 'ticket')
         if 200 <= r.status_code <= 299:
             rr = json.loads(r.text)
             # printable_r = json.dumps(rr, indent=4, sort_keys=True)
@@ -100,40 +226,195 @@ class ConnectWise:
             l.error("Error retrieving CW ticket id: {} [{}: {}]".format(ticket_id, r.status_code, r.text))
         return rr
 
-    def get_tickets(self, since_ts_epoch):
-        _URL_ = self.base_url
-        _AUTH_ = self.auth
-        _HEADERS_ = self.headers
+    def get_tickets(self, since_ts_epoch, ticket_ids=None):
+        ''' :return: list of tickets updated since since_ts_epoch (seconds) - see iter_tickets '''
+        return list(self.iter_tickets(since_ts_epoch, ticket_ids=ticket_ids))
+
+    def iter_tickets(self, since_ts_epoch, ticket_ids=None):
+        '''
+        yields the tickets updated since since_ts_epoch (seconds) ordered by id, page by page - the count is queried
+        first so up to cw_tickets_page_workers pages are fetched ahead concurrently. tickets updated while paging
+        are left for the next call; tickets missed because pages drifted (or a page failed) are picked up by id at
+        the end - only the id ranges between the pages received and the ids after the last one are queried
+        :param ticket_ids: only look at these tickets - None for all tickets
+        '''
         since_ts_str = self._epoch_to_datestring(since_ts_epoch)
-        ret = []
-        if since_ts_str:
-            self.l.info("Getting tickets since: [{}] UTC".format(since_ts_str))
-            page_cnt = 1
-            page_size = 50
-            while True:
-                url = '{}/service/tickets?conditions=lastUpdated > "{}"&pageSize={}&page={}'.format(_URL_, since_ts_str, page_size, page_cnt)
-                r = requests.get(url=url, headers=_HEADERS_, auth=_AUTH_)
-                if 200 <= r.status_code <= 299:
-                    rr = json.loads(r.text)
-                    if rr:
-                        self.l.debug("retrieved page: {}".format(page_cnt))
-                        ret.extend(rr)
-                        page_cnt += 1
-                        if len(rr) < page_size:
-                            break
-                    else:
-                        break
-                else:
-                    self.l.error("Error retrieving CW tickets: [{}: {}]".format(r.status_code, r.text))
-                    break
-        else:
+        if not since_ts_str:
             self.l.error("Cannot get ticket - epoch to string broken: [{}]".format(since_ts_epoch))
+            return
+        self.l.info("Getting tickets since: [{}] UTC".format(since_ts_str))
+        conditions = self._make_tickets_conditions(since_ts_str)
+        if ticket_ids is not None:
+            for id_conditions in self._make_ticket_id_conditions(conditions, ticket_ids):
+                for page in self._iter_tickets_after_id(id_conditions):
+                    for ticket in page:
+                        yield ticket
+            return
+        ticket_cnt = self._get_ticket_count(conditions)
+        seen_ids = set()
+        page_bounds = []
+        complete = False
+        if ticket_cnt is not None:
+            complete = True
+            page_numbers = iter(range(1, math.ceil(ticket_cnt / self.tickets_page_size) + 1))
+            with ThreadPoolExecutor(max_workers=self.tickets_page_workers) as executor:
+                pending = deque()
+                for page_cnt in page_numbers:
+                    pending.append(executor.submit(self._get_tickets_page, conditions, page_cnt))
+                    if len(pending) >= self.tickets_page_workers:
+                        break
+                try:
+                    while pending:
+                        page = pending.popleft().result()
+                        if page is None:
+                            complete = False
+                            break
+                        next_page_cnt = next(page_numbers, None)
+                        if next_page_cnt:
+                            pending.append(executor.submit(self._get_tickets_page, conditions, next_page_cnt))
+                        self._add_page_bounds(page, page_bounds)
+                        for ticket in self._drop_seen_tickets(page, seen_ids):
+                            yield ticket
+                finally:
+                    for future in pending:
+                        future.cancel()
+        if ticket_cnt is None or not complete or len(seen_ids) < ticket_cnt:
+            if ticket_cnt is not None:
+                self.l.warning("CW ticket pages drifted while fetching: [{} of {}] - retrieving the gaps by id".format(
+                    len(seen_ids), ticket_cnt))
+            for (missed_conditions, last_id) in self._make_missed_tickets_queries(conditions, page_bounds):
+                for page in self._iter_tickets_after_id(missed_conditions, last_id):
+                    for ticket in self._drop_seen_tickets(page, seen_ids):
+                        yield ticket
+
+    def _make_tickets_conditions(self, since_ts_str):
+        # the upper bound keeps tickets that are updated while paging from shifting the pages
+        until_ts_str = self._epoch_to_datestring(time())
+        return 'lastUpdated > "{}" and lastUpdated <= "{}"'.format(since_ts_str, until_ts_str)
+
+    def _make_ticket_id_conditions(self, conditions, ticket_ids):
+        ''' adds "id in (...)" to the conditions - split so no conditions string is longer than cw_max_conditions_length '''
+        ret = []
+        id_strings = [str(ticket_id) for ticket_id in sorted(set(int(t) for t in ticket_ids if str(t).isdigit()))]
+        chunk = []
+        chunk_len = len(conditions) + len(' and id in ()')
+        for id_string in id_strings:
+            if chunk and chunk_len + len(id_string) + 1 > self.max_conditions_length:
+                ret.append('{} and id in ({})'.format(conditions, ','.join(chunk)))
+                chunk = []
+                chunk_len = len(conditions) + len(' and id in ()')
+            chunk.append(id_string)
+            chunk_len += len(id_string) + 1
+        if chunk:
+            ret.append('{} and id in ({})'.format(conditions, ','.join(chunk)))
+        return ret
+
+    def _make_tickets_page_url(self, conditions, page_cnt):
+        return '{}/service/tickets?conditions={}&orderBy=id asc&pageSize={}&page={}'.format(
+            self.base_url, conditions, self.tickets_page_size, page_cnt)
+
+    def _make_tickets_after_id_url(self, conditions, last_id):
+        return '{}/service/tickets?conditions=({}) and id > {}&orderBy=id asc&pageSize={}'.format(
+            self.base_url, conditions, last_id, self.tickets_page_size)
+
+    def _get_ticket_count(self, conditions):
+        ''' :return: number of tickets matching the conditions - None on error '''
+        r = self._get('{}/service/tickets/count?conditions={}'.format(self.base_url, conditions))
+        return self._parse_ticket_count(r)
+
+    def _parse_ticket_count(self, r):
+        if 200 <= r.status_code <= 299:
+            ticket_cnt = json.loads(r.text).get('count', 0)
+            self.l.debug("tickets to retrieve: {}".format(ticket_cnt))
+            return ticket_cnt
+        self.l.error("Error counting CW tickets: [{}: {}]".format(r.status_code, r.text))
+        return None
+
+    def _get_tickets_page(self, conditions, page_cnt):
+        ''' :return: the tickets on the page - None on error '''
+        r = self._get_fields(self._make_tickets_page_url(conditions, page_cnt), 'tickets')
+        return self._parse_tickets_page(r, page_cnt)
+
+    def _parse_tickets_page(self, r, page_cnt):
+        if 200 <= r.status_code <= 299:
+            self.l.debug("retrieved page: {}".format(page_cnt))
+            return json.loads(r.text)
+        self.l.error("Error retrieving CW tickets: [{}: {}]".format(r.status_code, r.text))
+        return None
+
+    def _add_page_bounds(self, page, page_bounds):
+        ''' first / last id of each page received, in page order '''
+        if page:
+            page_bounds.append((page[0].get('id', 0), page[-1].get('id', 0)))
+
+    def _make_missed_tickets_queries(self, conditions, page_bounds):
+        '''
+        pages are ordered by id and tickets can only leave the result set while paging (the upper lastUpdated bound),
+        so a ticket is only skipped when it shifts across the boundary between two pages - or sits on a page that
+        was not received. the gaps between the pages received (chunked to cw_max_conditions_length) and everything
+        after the last one are queried instead of the whole result set
+        :return: list of (conditions, id to start after)
+        '''
+        ret = []
+        gaps = ['(id > {} and id < {})'.format(prev_bounds[1], bounds[0])
+                for (prev_bounds, bounds) in zip(page_bounds, page_bounds[1:]) if bounds[0] > prev_bounds[1] + 1]
+        chunk = []
+        chunk_len = len(conditions) + len(' and ()')
+        for gap in gaps:
+            if chunk and chunk_len + len(gap) + len(' or ') > self.max_conditions_length:
+                ret.append(('{} and ({})'.format(conditions, ' or '.join(chunk)), 0))
+                chunk = []
+                chunk_len = len(conditions) + len(' and ()')
+            chunk.append(gap)
+            chunk_len += len(gap) + len(' or ')
+        if chunk:
+            ret.append(('{} and ({})'.format(conditions, ' or '.join(chunk)), 0))
+        ret.append((conditions, page_bounds[-1][1] if page_bounds else 0))
         return ret
 
+    def _drop_seen_tickets(self, page, seen_ids):
+        ''' pages can overlap when tickets move between them - every ticket is returned once '''
+        ret = []
+        for ticket in page:
+            if ticket.get('id') not in seen_ids:
+                seen_ids.add(ticket.get('id'))
+                ret.append(ticket)
+        return ret
+
+    def _iter_tickets_after_id(self, conditions, last_id=0):
+        ''' sequential fallback - every page starts after the last id seen, so changes while paging cannot skip tickets '''
+        while True:
+            r = self._get_fields(self._make_tickets_after_id_url(conditions, last_id), 'tickets')
+            rr = self._parse_tickets_page(r, last_id)
+            if not rr:
+                break
+            yield rr
+            last_id = rr[-1].get('id', 0)
+            if len(rr) < self.tickets_page_size:
+                break
+
     def create_ticket(self, ticket_summary, company_name, board_name='', event_score=0, stellar_case_number=None):
         new_ticket_id = 0
-        tenant_name = company_name
         company_id = self.get_company(company_name)
+        if self.cw_use_default_board:
+            board_id = self.get_board(self.cw_default_board)
+        else:
+            board_id = self.get_board(board_name)
+        ticket_data = self._make_ticket_data(ticket_summary, company_name, company_id, board_id, event_score,
+                                             stellar_case_number)
+
+        url = '{}{}'.format(self.base_url, '/service/tickets')
+        r = self._post(url, data=ticket_data)
+        if 200 <= r.status_code <= 299:
+            rr = json.loads(r.text)
+            new_ticket_id = int(rr['id'])
+            self.l.info("New ticket created: [{}]".format(new_ticket_id))
+        else:
+            self.l.error("Error creating ticket: [{}: {}]".format(r.status_code, r.text))
+
+        return new_ticket_id
+
+    def _make_ticket_data(self, ticket_summary, tenant_name, company_id, board_id, event_score=0, stellar_case_number=None):
         (priority_name, priority_id) = self.get_ticket_priority(event_score)
         summary_string = ticket_summary
         if self.ticket_prefix:
@@ -154,36 +435,22 @@ class ConnectWise:
             # added 20220721.000 to support ticket status
             'status': {
                 'name': '{}'.format(self.cw_ticket_status)
+            },
+            'board': {
+                'id': board_id
             }
         }
 
-        if self.cw_use_default_board:
-            ticket_data['board'] = {"id": self.get_board(self.cw_default_board)}
-            # ticket_data['board'] = {"name": '{}'.format(self.cw_default_board)}
-        else:
-            ticket_data['board'] = {"id": self.get_board(board_name)}
-
         # support for event_score and priority_id added 20230301
         if priority_id:
             ticket_data['priority'] = {'id': priority_id}
-        ticket_data = json.dumps(ticket_data)
-
-        url = '{}{}'.format(self.base_url, '/service/tickets')
-        r = requests.post(url=url, headers=self.headers, auth=self.auth, data=ticket_data)
-        if 200 <= r.status_code <= 299:
-            rr = json.loads(r.text)
-            new_ticket_id = int(rr['id'])
-            self.l.info("New ticket created: [{}]".format(new_ticket_id))
-        else:
-            self.l.error("Error creating ticket: [{}: {}]".format(r.status_code, r.text))
-
-        return new_ticket_id
+        return json.dumps(ticket_data)
 
     def get_companies(self):
         url = '{}/company/companies?fields=id,name,status&pageSize=1000'.format(self.base_url)
         # url = '{}/company/companies?name="Microsoft"'.format(_URL_)
         # url = '{}/company/companies?conditions=name="Microsoft"&fields=id,name,status'.format(_URL_)
-        r = requests.get(url=url, headers=self.headers, auth=self.auth)
+        r = self._get(url)
         if 200 <= r.status_code <= 299:
             rr = json.loads(r.text)
             printable_r = json.dumps(rr, indent=4, sort_keys=True)
@@ -208,29 +475,11 @@ class ConnectWise:
             ret_id = self.cw_default_company_id
         else:
             self.l.info("Finding company name: [{}]".format(company_name))
-            if self.tenant_map and company_name in self.tenant_map:
-                mapped_company_name = self.tenant_map[company_name]
-                self.l.info("Tenant name: [{}] mapped to CW company: [{}]".format(company_name, mapped_company_name))
-                company_name = mapped_company_name
-            if all_fields:
-                url = '{}/company/companies?conditions=name="{}"'.format(self.base_url, company_name)
-            else:
-                url = '{}/company/companies?conditions=name="{}"&fields=id,name,status,deletedFlag'.format(self.base_url,
-                                                                                                           company_name)
-            r = requests.get(url=url, headers=self.headers, auth=self.auth)
-            if 200 <= r.status_code <= 299:
-                rr = json.loads(r.text)
-                for c in rr:
-                    if 'id' in c:
-                        df = c['deletedFlag']
-                        if df:
-                            self.l.warning("Company: [{} / {}] is flagged as deleted - skipping".format(c['id'], company_name))
-                            continue
-                        ret_id = c['id']
-                        self.l.info("Found company id: [{}]".format(ret_id))
-                        break
-            else:
-                self.l.error("Error querying companies: [{}: {}]".format(r.status_code, r.text))
+            company_name = self._map_company_name(company_name)
+            ret_id = self._find_company_in_directory(company_name)
+            if ret_id is None:
+                ret_id = self._query_company(company_name, all_fields=all_fields)
+                self._add_company_to_directory(company_name, ret_id)
 
             if not ret_id:
                 self.l.warning("Company name [{}] could not be found. Using default company: [{}/{}]".format(
@@ -239,13 +488,126 @@ class ConnectWise:
 
         return ret_id
 
+    def load_company_directory(self, since_ts_epoch=0):
+        '''
+        bulk load companies into the name -> id directory used by get_company
+        :param since_ts_epoch: only load companies updated since this time (incremental refresh) - 0 loads everything
+        :return: number of companies loaded
+        '''
+        ts_start = time()
+        conditions = ''
+        if since_ts_epoch:
+            conditions = 'conditions=lastUpdated > "{}"&'.format(self._epoch_to_datestring(since_ts_epoch))
+        company_cnt = 0
+        companies = self._get_all_pages('{}/company/companies?{}fields=id,name,deletedFlag&orderBy=id asc'.format(
+            self.base_url, conditions))
+        if companies is None:
+            with self.company_directory_lock:
+                # the refresh was claimed by _find_company_in_directory - the next lookup tries again from the same time
+                self.company_directory_ts = since_ts_epoch
+            return company_cnt
+
+        with self.company_directory_lock:
+            if not since_ts_epoch:
+                self.company_directory_ids = {}
+            for c in companies:
+                if c.get('deletedFlag', False):
+                    self.company_directory_ids.pop(c.get('id'), None)
+                    continue
+                self.company_directory_ids[c.get('id')] = self._get_name_key(c.get('name', ''))
+                company_cnt += 1
+            self._rebuild_company_directory()
+            self.company_directory_misses = set()
+            # start of this load, so nothing updated while paging is missed by the next refresh
+            self.company_directory_ts = ts_start
+        self.l.info("Company directory loaded: [{} companies] [total: {}]".format(company_cnt, len(self.company_directory)))
+        return company_cnt
+
+    def _rebuild_company_directory(self):
+        ''' name key -> id, same as the name query: the lowest id that is not deleted wins (call with the lock held) '''
+        company_directory = {}
+        for company_id in sorted(self.company_directory_ids):
+            company_directory.setdefault(self.company_directory_ids[company_id], company_id)
+        self.company_directory = company_directory
+
+    def _map_company_name(self, company_name):
+        if self.tenant_map and company_name in self.tenant_map:
+            mapped_company_name = self.tenant_map[company_name]
+            self.l.info("Tenant name: [{}] mapped to CW company: [{}]".format(company_name, mapped_company_name))
+            company_name = mapped_company_name
+        return company_name
+
+    def _get_name_key(self, company_name):
+        return ' '.join(str(company_name).split()).lower()
+
+    def _find_company_in_directory(self, company_name):
+        '''
+        :return: company id, 0 if the name already failed a query since the last refresh, None if it needs a query
+        '''
+        if not self.company_directory_refresh:
+            return None
+        with self.company_directory_lock:
+            # only one worker refreshes - the others keep using the current directory meanwhile
+            since_ts_epoch = self.company_directory_ts
+            refresh_due = time() - since_ts_epoch > self.company_directory_refresh
+            if refresh_due:
+                self.company_directory_ts = time()
+        if refresh_due:
+            self.load_company_directory(since_ts_epoch=int(since_ts_epoch))
+        company_key = self._get_name_key(company_name)
+        with self.company_directory_lock:
+            ret_id = self.company_directory.get(company_key)
+            if ret_id:
+                self.l.info("Found company id: [{}]".format(ret_id))
+            elif company_key in self.company_directory_misses:
+                ret_id = 0
+        return ret_id
+
+    def _add_company_to_directory(self, company_name, company_id):
+        if not self.company_directory_refresh:
+            return
+        company_key = self._get_name_key(company_name)
+        with self.company_directory_lock:
+            if company_id:
+                self.company_directory_ids[company_id] = company_key
+                self.company_directory[company_key] = company_id
+            else:
+                self.company_directory_misses.add(company_key)
+
+    def _query_company(self, company_name, all_fields=False):
+        ret_id = 0
+        if all_fields:
+            url = '{}/company/companies?conditions=name="{}"'.format(self.base_url, company_name)
+        else:
+            url = '{}/company/companies?conditions=name="{}"&fields=id,name,status,deletedFlag'.format(self.base_url,
+                                                                                                       company_name)
+        r = self._get(url)
+        if 200 <= r.status_code <= 299:
+            ret_id = self._parse_company_id(json.loads(r.text), company_name)
+        else:
+            self.l.error("Error querying companies: [{}: {}]".format(r.status_code, r.text))
+        return ret_id
+
+    def _parse_company_id(self, companies, company_name):
+        ret_id = 0
+        for c in companies:
+            if 'id' in c:
+                df = c['deletedFlag']
+                if df:
+                    self.l.warning("Company: [{} / {}] is flagged as deleted - skipping".format(c['id'], company_name))
+                    continue
+                ret_id = c['id']
+                self.l.info("Found company id: [{}]".format(ret_id))
+                break
+        return ret_id
+
     def get_default_company_id(self):
         ret_id = 0
         company_name = self.cw_default_company
         if company_name:
             self.l.info("Finding default company name: [{}]".format(company_name))
             url = '{}/company/companies?conditions=name="{}"&fields=id,name,status,deletedFlag'.format(self.base_url, company_name)
-            r = requests.get(url=url, headers=self.headers, auth=self.auth)
+            r = self._get(url)
             if 200 <= r.status_code <= 299:
                 rr = json.loads(r.text)
                 for c in rr:
@@ -269,7 +631,7 @@ class ConnectWise:
     def get_boards(self):
         self.l.info("Getting all board names")
         url = '{}/service/boards?fields=id,name,status&pageSize=1000'.format(self.base_url)
-        r = requests.get(url=url, headers=self.headers, auth=self.auth)
+        r = self._get(url)
         if 200 <= r.status_code <= 299:
             rr = json.loads(r.text)
             item_cnt = 0
@@ -291,38 +653,70 @@ class ConnectWise:
         return
 
     def get_board(self, board_name, last_try=False):
+        ''' served from the cached boards - unknown names fall back to the default board '''
         self.l.info("Finding board name: [{}]".format(board_name))
-        ret_id = 0
-        url = '{}/service/boards?conditions=name="{}"&fields=id,name,status'.format(self.base_url, board_name)
-        r = requests.get(url=url, headers=self.headers, auth=self.auth)
-        if 200 <= r.status_code <= 299:
-            rr = json.loads(r.text)
-            for c in rr:
-                if 'id' in c:
-                    ret_id = c['id']
-                    self.l.info("Found board id: [{}]".format(ret_id))
-                    break
-        # printable_r = json.dumps(rr, indent=4, sort_keys=True)
-        # l.debug(printable_r)
-        # print(printable_r)
+        self._refresh_reference_data()
+        ret_id = self.boards.get(self._get_name_key(board_name), 0)
+        if ret_id:
+            self.l.info("Found board id: [{}]".format(ret_id))
         else:
-            self.l.error("Error querying boards: [{}: {}]".format(r.status_code, r.text))
+            ret_id = self.boards.get(self._get_name_key(self.cw_default_board), 0)
+            if not ret_id:
+                raise Exception("Service Board Name lookup failure: [{}]. Cannot create ticket.".format(self.cw_default_board))
+            if board_name:
+                self.l.warning("Board name [{}] could not be found. Using the default board: [{}/{}]".format(
+                    board_name, self.cw_default_board, ret_id))
+        return ret_id
 
-        if not ret_id:
-            if last_try:
-                raise Exception("Service Board Name lookup failure: [{}]. Cannot create ticket.".format(board_name))
-            else:
-                # lookup the default company
-                self.l.warning("Board name [{}] could not be found. Looking up the default board: [{}]".format(board_name,
-                                                                                                          self.cw_default_board))
-                ret_id = self.get_board(self.cw_default_board, last_try=True)
+    def _refresh_reference_data(self):
+        ''' only one worker reloads a due refresh - the others keep using the cached boards meanwhile '''
+        with self.reference_data_lock:
+            refresh_due = time() - self.reference_data_ts > self.reference_data_refresh
+            if refresh_due:
+                self.reference_data_ts = time()
+        if refresh_due:
+            self.load_reference_data()
 
-        return ret_id
+    def load_reference_data(self):
+        ''' (re)load boards, priorities and the statuses of the default board '''
+        boards = self._get_all_pages('{}/service/boards?fields=id,name,inactiveFlag'.format(self.base_url))
+        priorities = self._get_all_pages('{}/service/priorities?fields=id,name'.format(self.base_url))
+        if boards is None or priorities is None:
+            # keep what we have - the reload is tried again in reference_data_retry seconds
+            with self.reference_data_lock:
+                self.reference_data_ts = time() - self.reference_data_refresh + self.reference_data_retry
+            self.l.warning("Reference data could not be loaded - retrying in [{}s]".format(self.reference_data_retry))
+            return
+        self.boards = {self._get_name_key(b.get('name', '')): b.get('id') for b in boards if not b.get('inactiveFlag', False)}
+        self.priorities = {p.get('id'): p.get('name', '') for p in priorities}
+        statuses = {}
+        default_board_id = self.boards.get(self._get_name_key(self.cw_default_board), 0)
+        if default_board_id:
+            board_statuses = self._get_all_pages('{}/service/boards/{}/statuses?fields=id,name'.format(self.base_url, default_board_id))
+            for status in board_statuses or []:
+                statuses[self._get_name_key(status.get('name', ''))] = status.get('id')
+        self.statuses = statuses
+        with self.reference_data_lock:
+            self.reference_data_ts = time()
+        self.l.info("Reference data loaded: [boards: {}] [priorities: {}] [default board statuses: {}]".format(
+            len(self.boards), len(self.priorities), len(self.statuses)))
+
+    def validate_reference_data(self):
+        ''' fail at startup instead of on every ticket when the ticket config does not match CW '''
+        if not self._get_name_key(self.cw_default_board) in self.boards:
+            raise Exception("Default board not identified: [{}] - cannot proceed".format(self.cw_default_board))
+        for (sla_name, sla_config) in self.sla.items():
+            priority_id = sla_config.get('cw_priority_id', 0)
+            if priority_id and priority_id not in self.priorities:
+                raise Exception("SLA [{}] cw_priority_id not identified: [{}] - cannot proceed".format(sla_name, priority_id))
+        if self.cw_ticket_status and not self._get_name_key(self.cw_ticket_status) in self.statuses:
+            raise Exception("Ticket status [{}] not found on default board [{}] - cannot proceed".format(
+                self.cw_ticket_status, self.cw_default_board))
 
     def get_priorities(self):
         self.l.info("Getting all priorities")
         url = '{}/service/priorities?fields=id,name,status&pageSize=1000'.format(self.base_url)
-        r = requests.get(url=url, headers=self.headers, auth=self.auth)
+        r = self._get(url)
         if 200 <= r.status_code <= 299:
             rr = json.loads(r.text)
             item_cnt = 0
@@ -364,25 +758,46 @@ class ConnectWise:
         self.l.info("Setting ticket priority: [{}: {}]".format(ticket_priority_id, ticket_sev))
         return (ticket_sev, ticket_priority_id)
 
-    def get_ticket_notes(self, ticket_id):
-        _URL_ = self.base_url
-        _AUTH_ = self.auth
-        _HEADERS_ = self.headers
-        l = self.l
-        l.info("Getting ticket notes: [{}]".format(ticket_id))
-        # url = "{}/service/tickets/{}/notes".format(_URL_, ticket_id)
-        url = "{}/service/tickets/{}/allNotes".format(_URL_, ticket_id)
-        r = requests.get(url=url, headers=_HEADERS_, auth=_AUTH_)
-        if 200 <= r.status_code <= 299:
-            rr = json.loads(r.text)
-        else:
+    def get_ticket_notes(self, ticket_id, cursor=None):
+        '''
+        :param cursor: from get_note_cursor - when given, only notes updated since it are paged through
+        :return: list of notes ([] on error)
+        '''
+        rr = []
+        self.l.info("Getting ticket notes: [{}]".format(ticket_id))
+        notes = self._get_all_pages(self._make_notes_url(ticket_id, cursor), page_size=self.notes_page_size, field_site='notes')
+        if notes is None:
             self.l.error("Problem getting ticket notes: [{}]".format(ticket_id))
+        else:
+            rr = self._filter_ticket_notes(notes, cursor)
         return rr
 
+    def get_note_cursor(self, ticket_notes, cursor=None):
+        '''
+        cursor for the next incremental get_ticket_notes call: the newest lastUpdated seen and the ids of
+        the notes updated at that exact time
+        :return: {"ts": epoch ms, "keys": [...]} - the given cursor if there are no newer notes
+        '''
+        return self._advance_cursor(ticket_notes, cursor,
+                                    lambda n: n.get('_info', {}).get('lastUpdated', "1970-01-01T00:00:00Z"),
+                                    lambda n: str(n.get('id', '')))
+
+    def _make_notes_url(self, ticket_id, cursor):
+        # url = "{}/service/tickets/{}/notes".format(_URL_, ticket_id)
+        conditions = ''
+        if cursor:
+            conditions = 'conditions=lastUpdated >= "{}"'.format(self._epoch_to_datestring(cursor['ts'] / 1000))
+        return '{}/service/tickets/{}/allNotes?{}'.format(self.base_url, ticket_id, conditions)
+
+    def _filter_ticket_notes(self, ticket_notes, cursor):
+        ''' drop notes that were already returned at the cursor timestamp '''
+        if not cursor:
+            return ticket_notes
+        seen_keys = set(cursor.get('keys', []))
+        return [n for n in ticket_notes if str(n.get('id', '')) not in seen_keys]
+
     def create_ticket_note(self, ticket_id, ticket_note_text):
         _URL_ = self.base_url
-        _AUTH_ = self.auth
-        _HEADERS_ = self.headers
         l = self.l
         note_data = json.dumps(
             {
@@ -396,7 +811,7 @@ class ConnectWise:
             }
         )
         url = '{}/service/tickets/{}/notes'.format(_URL_, ticket_id)
-        r = requests.post(url=url, headers=_HEADERS_, auth=_AUTH_, data=note_data)
+        r = self._post(url, data=note_data)
         if 200 <= r.status_code <= 299:
             rr = json.loads(r.text)
             ticket_note_id = int(rr['id'])
@@ -406,24 +821,90 @@ class ConnectWise:
 
         return ticket_note_id
 
-    def get_audit_records(self, ticket_id):
+    def get_audit_records(self, ticket_id, cursor=None):
+        '''
+        fetched once per ticket per cycle - owner change detection and audit sync share the same result
+        :param cursor: from get_audit_cursor - when given, only records entered after it are paged through
+        :return: list of audit records
+        '''
         _URL_ = self.base_url
-        _AUTH_ = self.auth
-        _HEADERS_ = self.headers
+        rr = self._get_cached_audit_records(ticket_id)
+        if rr is not None:
+            return rr
         rr = {}
         self.l.info("Getting audit records: [{}]".format(ticket_id))
+        if cursor:
+            records = self._get_all_pages(self._make_audit_url(ticket_id, cursor), page_size=self.audit_page_size, field_site='audit')
+            if records is not None:
+                rr = self._filter_audit_records(records, cursor)
+                self._cache_audit_records(ticket_id, rr)
+            return rr
         # url = "{}/service/tickets/{}/notes".format(_URL_, ticket_id)
         url = "{}/system/audittrail?type=Ticket&id={}".format(_URL_, ticket_id)
-        r = requests.get(url=url, headers=_HEADERS_, auth=_AUTH_)
-        if 200 <= r.status_code <= 299:
-            rr = json.loads(r.text)
+        # paged as well - a single GET only returns CW's default page of 25 records
+        records = self._get_all_pages(url, page_size=self.audit_page_size, field_site='audit')
+        if records is not None:
+            rr = records
+            self._cache_audit_records(ticket_id, rr)
         else:
             self.l.error("Problem getting audit records: [{}]".format(ticket_id))
         return rr
 
-    def get_ticket_ownership_change(self, ticket_id):
+    def get_audit_cursor(self, audit_records, cursor=None):
+        '''
+        cursor for the next incremental get_audit_records call: the newest enteredDate seen and the keys of
+        the records entered at that exact time (the next query includes that second, so those are dropped)
+        :return: {"ts": epoch ms, "keys": [...]} - the given cursor if there are no newer records
+        '''
+        return self._advance_cursor(audit_records, cursor,
+                                    lambda ar: ar.get('enteredDate', "1970-01-01T00:00:00Z"),
+                                    self._get_audit_key)
+
+    def _advance_cursor(self, records, cursor, get_datestring, get_key):
+        ret = dict(cursor) if cursor else None
+        for record in records:
+            record_ts = self.datestring_to_epoch(get_datestring(record))
+            if not ret or record_ts > ret['ts']:
+                ret = {"ts": record_ts, "keys": []}
+            if record_ts == ret['ts']:
+                ret['keys'] = ret['keys'] + [get_key(record)]
+        return ret
+
+    def _make_audit_url(self, ticket_id, cursor):
+        since_ts_str = self._epoch_to_datestring(cursor['ts'] / 1000)
+        return '{}/system/audittrail?type=Ticket&id={}&conditions=enteredDate >= "{}"'.format(self.base_url, ticket_id, since_ts_str)
+
+    def _filter_audit_records(self, audit_records, cursor):
+        ''' drop records that were already returned at the cursor timestamp '''
+        seen_keys = set(cursor.get('keys', []))
+        return [ar for ar in audit_records if self._get_audit_key(ar) not in seen_keys]
+
+    def _get_audit_key(self, audit_record):
+        ''' audit records have no id - identify them by their content '''
+        key_data = json.dumps([audit_record.get(k, '') for k in ['enteredDate', 'auditType', 'auditSubType', 'enteredBy', 'text']])
+        return hashlib.sha1(key_data.encode('utf-8')).hexdigest()[:16]
+
+    def clear_audit_cache(self):
+        ''' call at the start of every sync cycle '''
+        with self.audit_cache_lock:
+            self.audit_cache = {}
+
+    def release_audit_records(self, ticket_id):
+        ''' call once the ticket is synced - keeps the cache from holding every audit trail of a large pass '''
+        with self.audit_cache_lock:
+            self.audit_cache.pop(str(ticket_id), None)
+
+    def _get_cached_audit_records(self, ticket_id):
+        with self.audit_cache_lock:
+            return self.audit_cache.get(str(ticket_id))
+
+    def _cache_audit_records(self, ticket_id, audit_records):
+        with self.audit_cache_lock:
+            self.audit_cache[str(ticket_id)] = audit_records
+
+    def get_ticket_ownership_change(self, ticket_id, cursor=None):
         ret = {}
-        audit_records = self.get_audit_records(ticket_id)
+        audit_records = self.get_audit_records(ticket_id, cursor=cursor)
         # pick out only ownership record changes
         for ar in audit_records:
             if ar.get('auditType', '') == "Resource" and ar.get('auditSubType', '') == "Owner":
@@ -433,21 +914,65 @@ class ConnectWise:
 
     def get_member_email_via_link(self, member_link):
         ''' the direct member link is obtained from the ticket response json - owner '''
-        _AUTH_ = self.auth
-        _HEADERS_ = self.headers
+        member_key = self._get_member_key(member_link)
+        email = self.member_cache.get(member_key)
+        # '' is cached too - a member without an email is not looked up again until the entry expires
+        if email is not None:
+            return email
         email = ''
         l = self.l
         l.info("Getting email for member via direct link: [{}]".format(member_link))
         rr = {}
         url = member_link
-        r = requests.get(url=url, headers=_HEADERS_, auth=_AUTH_)
+        r = self._get_fields(url, 'member')
         if 200 <= r.status_code <= 299:
             rr = json.loads(r.text)
             email = rr.get('primaryEmail', '')
+            self.member_cache.put(member_key, email)
         else:
             l.error("Error retrieving direct member link: [{}]".format(member_link))
         return email
 
+    def warm_member_cache(self):
+        ''' bulk load member emails so owner sync does not need a lookup per ticket '''
+        member_cnt = 0
+        members = self._get_all_pages('{}/system/members?fields=id,primaryEmail'.format(self.base_url))
+        for member in members or []:
+            self.member_cache.put(str(member.get('id')), member.get('primaryEmail') or '')
+            member_cnt += 1
+        self.l.info("Member email cache warmed: [{}]".format(member_cnt))
+        return member_cnt
+
+    def save_member_cache(self):
+        if self.member_cache_file:
+            self.member_cache.save(self.member_cache_file)
+
+    def get_member_cache_stats(self):
+        return self.member_cache.get_stats()
+
+    def _get_all_pages(self, url, page_size=1000, field_site=None):
+        ''' follows pagination for a list endpoint (url already has its query string) - returns None on error '''
+        ret = []
+        page_cnt = 1
+        while True:
+            r = self._get_fields('{}&pageSize={}&page={}'.format(url, page_size, page_cnt), field_site)
+            if not 200 <= r.status_code <= 299:
+                self.l.error("Error retrieving: [{}] [{}: {}]".format(url, r.status_code, r.text))
+                return None
+            rr = json.loads(r.text)
+            ret.extend(rr)
+            if len(rr) < page_size:
+                break
+            page_cnt += 1
+        return ret
+
+    def _get_member_key(self, member_link):
+        ''' member links end with /system/members/<id> - key on the id so warm-up entries match '''
+        member_id = str(member_link).rstrip('/').rsplit('/', 1)[-1]
+        if member_id.isdigit():
+            return member_id
+        return member_link
+
     def create_ticket_note_text(self, case_summary :str, case_tenant_name :str, case_url :str, alerts=[]):
         ticket_note_text = "{}\n\n{}\n\n{}\n\n".format(case_summary, case_tenant_name, case_url)
         for alert in alerts:
@@ -476,11 +1001,150 @@ class ConnectWise:
 
         return ts_string
 
+    def get_pool_stats(self):
+        ''' request / connection counters for the session pool - reuse is the share of requests that did not open a new connection '''
+        connections = 0
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool:
+                    connections += pool.num_connections
+        reuse = 0.0
+        if self.request_cnt:
+            reuse = max(0.0, 1 - connections / self.request_cnt)
+        return {"requests": self.request_cnt, "connections": connections, "reuse": round(reuse, 3)}
+
+    def close(self):
+        self.session.close()
+
+    def _make_session(self):
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.auth = self.auth
+        adapter = HTTPAdapter(pool_connections=self.cw_pool_size, pool_maxsize=self.cw_pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _send(self, method, url, **kwargs):
+        '''
+        429/5xx responses, connection errors and timeouts are retried with jittered exponential backoff (Retry-After is honored)
+        POST is only retried on 429 and when the connection could not be opened - a replay could duplicate a ticket / note
+        :return: requests response (the last one when retries are exhausted)
+        '''
+        attempt = 0
+        while True:
+            with self.request_lock:
+                self.request_cnt += 1
+            try:
+                r = self.session.request(method, url, timeout=self.cw_request_timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # a read timeout is retried like a connection reset - for idempotent methods only
+                if attempt >= self.cw_max_retries or not (method in IDEMPOTENT_METHODS or self._is_connect_error(e)):
+                    raise
+                delay = self._get_retry_delay(attempt)
+                self.l.warning("{} connection error: [{}] [{}] - retry {} in {:.1f}s".format(method, url, e, attempt + 1, delay))
+            else:
+                if not self._is_retry_status(method, r.status_code) or attempt >= self.cw_max_retries:
+                    return r
+                delay = self._get_retry_delay(attempt, retry_after=r.headers.get('Retry-After'))
+                self.l.warning("{} returned [{}]: [{}] - retry {} in {:.1f}s".format(method, r.status_code, url, attempt + 1, delay))
+            attempt += 1
+            sleep(delay)
+
+    def _is_retry_status(self, method, status_code):
+        if method in IDEMPOTENT_METHODS:
+            return status_code in RETRY_STATUS_CODES
+        return status_code == 429
+
+    def _is_connect_error(self, e):
+        ''' True if the connection could not be opened, i.e. nothing was sent '''
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def _get_retry_delay(self, attempt, retry_after=None):
+        delay = 0
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time()
+                except (TypeError, ValueError):
+                    delay = 0
+        if delay <= 0:
+            # full jitter
+            delay = random.uniform(0, self.cw_retry_backoff * (2 ** attempt))
+        return min(max(delay, 0), self.cw_retry_max_wait)
+
+    def _get(self, url):
+        return self._send('GET', url)
+
+    def _post(self, url, data=None):
+        return self._send('POST', url, data=data)
+
+    def _get_fields(self, url, field_site):
+        ''' GET with the fields= projection configured for the call site (none for an unknown / empty site) '''
+        fields = self.fields.get(field_site, '') if field_site else ''
+        if not fields:
+            return self._get(url)
+        r = self._get(self._add_fields(url, fields))
+        if 200 <= r.status_code <= 299 and self._count_payload(field_site, r):
+            full_r = self._get(url)
+            if 200 <= full_r.status_code <= 299:
+                self._set_payload_ratio(field_site, r, full_r)
+        return r
+
+    def _add_fields(self, url, fields):
+        return '{}{}fields={}'.format(url, '&' if '?' in url else '?', fields)
+
+    def _get_response_size(self, r):
+        ''' bytes on the wire (Content-Length) - the size of the decoded body when the header is missing '''
+        try:
+            return int(r.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            return len(r.text.encode('utf-8'))
+
+    def _count_payload(self, field_site, r):
+        ''' adds a projected response to the call site's counters - True when it should be compared with the full response '''
+        with self.payload_lock:
+            stats = self.payload_stats.setdefault(field_site, {"responses": 0, "bytes": 0, "ratio": None})
+            stats['responses'] += 1
+            stats['bytes'] += self._get_response_size(r)
+            if self.fields_measure and stats['ratio'] is None:
+                # only the first response per call site is measured
+                stats['ratio'] = 0
+                return True
+        return False
+
+    def _set_payload_ratio(self, field_site, projected_r, full_r):
+        full_size = self._get_response_size(full_r)
+        projected_size = self._get_response_size(projected_r)
+        with self.payload_lock:
+            self.payload_stats[field_site]['ratio'] = full_size / max(projected_size, 1)
+
+    def get_payload_stats(self):
+        '''
+        projected response bytes per call site - the estimated bytes saved are only known with cw_fields_measure
+        (from the measured full / projected ratio)
+        '''
+        ret = {}
+        with self.payload_lock:
+            for (field_site, stats) in self.payload_stats.items():
+                site_stats = {"responses": stats['responses'], "bytes": stats['bytes']}
+                if stats['ratio']:
+                    site_stats['saved'] = int(stats['bytes'] * (stats['ratio'] - 1))
+                ret[field_site] = site_stats
+        return ret
+
     def _get_company_info(self):
         ret = ''
         url = 'https://{}/login/companyinfo/{}'.format(self.cw_host, self.cw_company_id)
         self.l.info("Obtaining codebase from: [{}]".format(url))
-        r = requests.get(url=url, headers=self.headers)
+        r = self._get(url)
         rr = json.loads(r.text)
         printable_r = json.dumps(rr, indent=4, sort_keys=True)
         self.l.debug(printable_r)
@@ -491,3 +1155,375 @@ class ConnectWise:
             self.l.error("No codebase returned - cannot continue")
             raise Exception("No codebase returned - cannot continue")
         return ret
+
+
+class AsyncConnectWise(ConnectWise):
+
+    def __init__(self, logger, config={}, session=None, optional_data_path=None):
+        '''
+        asyncio counterpart of ConnectWise for the operations used by the sync loop
+        the blocking setup (codebase / default company lookups) still runs once in ConnectWise.__init__
+        :param session: aiohttp.ClientSession - can be shared with AsyncStellarUtil so both use one connection pool
+        '''
+        if aiohttp is None:
+            raise Exception("aiohttp is required for AsyncConnectWise - see requirements.txt")
+        super().__init__(logger, config=config, optional_data_path=optional_data_path)
+        self.async_session = session
+        self.async_auth = aiohttp.BasicAuth(self.auth[0], self.auth[1])
+        # per socket operation like AsyncStellarUtil - a total timeout raises a bare TimeoutError
+        self.async_timeout = aiohttp.ClientTimeout(sock_connect=self.cw_request_timeout, sock_read=self.cw_request_timeout)
+
+    def get_pool_stats(self):
+        connector = self.async_session.connector
+        return {"requests": self.request_cnt, "limit": connector.limit if connector else 0}
+
+    async def _async_send(self, method, url, data=None):
+        ''' same retry behavior as ConnectWise._send '''
+        attempt = 0
+        while True:
+            with self.request_lock:
+                self.request_cnt += 1
+            try:
+                async with self.async_session.request(method, url, headers=self.headers, auth=self.async_auth,
+                                                      data=data, timeout=self.async_timeout) as response:
+                    text = await response.text()
+                    r = AsyncResponse(response.status, text, response.headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # a timeout is handled like a read error - only retried for idempotent methods
+                connect_error = isinstance(e, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+                if attempt >= self.cw_max_retries or not (method in IDEMPOTENT_METHODS or connect_error):
+                    raise
+                delay = self._get_retry_delay(attempt)
+                self.l.warning("{} connection error: [{}] [{}] - retry {} in {:.1f}s".format(method, url, e, attempt + 1, delay))
+            else:
+                if not self._is_retry_status(method, r.status_code) or attempt >= self.cw_max_retries:
+                    return r
+                delay = self._get_retry_delay(attempt, retry_after=r.headers.get('Retry-After'))
+                self.l.warning("{} returned [{}]: [{}] - retry {} in {:.1f}s".format(method, r.status_code, url, attempt + 1, delay))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _async_get(self, url):
+        return await self._async_send('GET', url)
+
+    async def _async_post(self, url, data=None):
+        return await self._async_send('POST', url, data=data)
+
+    async def _async_get_fields(self, url, field_site):
+        ''' same as ConnectWise._get_fields '''
+        fields = self.fields.get(field_site, '') if field_site else ''
+        if not fields:
+            return await self._async_get(url)
+        r = await self._async_get(self._add_fields(url, fields))
+        if 200 <= r.status_code <= 299 and self._count_payload(field_site, r):
+            full_r = await self._async_get(url)
+            if 200 <= full_r.status_code <= 299:
+                self._set_payload_ratio(field_site, r, full_r)
+        return r
+
+    async def _async_get_all_pages(self, url, page_size=1000, field_site=None):
+        ''' same as ConnectWise._get_all_pages '''
+        ret = []
+        page_cnt = 1
+        while True:
+            r = await self._async_get_fields('{}&pageSize={}&page={}'.format(url, page_size, page_cnt), field_site)
+            if not 200 <= r.status_code <= 299:
+                self.l.error("Error retrieving: [{}] [{}: {}]".format(url, r.status_code, r.text))
+                return None
+            rr = json.loads(r.text)
+            ret.extend(rr)
+            if len(rr) < page_size:
+                break
+            page_cnt += 1
+        return ret
+
+    async def test_connection(self):
+        url = "{}{}".format(self.base_url, '/system/info')
+        self.l.info("Testing connection to: [{}]".format(url))
+        r = await self._async_get(url)
+        rr = json.loads(r.text)
+        if 'version' in rr:
+            self.l.info("Successful connectivity test. Connectwise version: [{}]".format(rr['version']))
+        else:
+            self.l.error("Connectivity test FAILED - cannot continue")
+            self.l.error("{} {}".format(r.status_code, rr))
+            raise Exception("Connectivity test FAILED - cannot continue")
+        return True
+
+    async def get_tickets(self, since_ts_epoch, ticket_ids=None):
+        return [ticket async for ticket in self.iter_tickets(since_ts_epoch, ticket_ids=ticket_ids)]
+
+    async def iter_tickets(self, since_ts_epoch, ticket_ids=None):
+        ''' async generator version of ConnectWise.iter_tickets '''
+        since_ts_str = self._epoch_to_datestring(since_ts_epoch)
+        if not since_ts_str:
+            self.l.error("Cannot get ticket - epoch to string broken: [{}]".format(since_ts_epoch))
+            return
+        self.l.info("Getting tickets since: [{}] UTC".format(since_ts_str))
+        conditions = self._make_tickets_conditions(since_ts_str)
+        if ticket_ids is not None:
+            for id_conditions in self._make_ticket_id_conditions(conditions, ticket_ids):
+                async for ticket in self._async_iter_tickets_after_id(id_conditions):
+                    yield ticket
+            return
+        r = await self._async_get('{}/service/tickets/count?conditions={}'.format(self.base_url, conditions))
+        ticket_cnt = self._parse_ticket_count(r)
+        seen_ids = set()
+        page_bounds = []
+        complete = False
+        if ticket_cnt is not None:
+            complete = True
+
+            async def get_page(page_cnt):
+                r = await self._async_get_fields(self._make_tickets_page_url(conditions, page_cnt), 'tickets')
+                return self._parse_tickets_page(r, page_cnt)
+
+            page_numbers = iter(range(1, math.ceil(ticket_cnt / self.tickets_page_size) + 1))
+            pending = deque()
+            for page_cnt in page_numbers:
+                pending.append(asyncio.ensure_future(get_page(page_cnt)))
+                if len(pending) >= self.tickets_page_workers:
+                    break
+            try:
+                while pending:
+                    page = await pending.popleft()
+                    if page is None:
+                        complete = False
+                        break
+                    next_page_cnt = next(page_numbers, None)
+                    if next_page_cnt:
+                        pending.append(asyncio.ensure_future(get_page(next_page_cnt)))
+                    self._add_page_bounds(page, page_bounds)
+                    for ticket in self._drop_seen_tickets(page, seen_ids):
+                        yield ticket
+            finally:
+                for task in pending:
+                    task.cancel()
+        if ticket_cnt is None or not complete or len(seen_ids) < ticket_cnt:
+            if ticket_cnt is not None:
+                self.l.warning("CW ticket pages drifted while fetching: [{} of {}] - retrieving the gaps by id".format(
+                    len(seen_ids), ticket_cnt))
+            for (missed_conditions, last_id) in self._make_missed_tickets_queries(conditions, page_bounds):
+                async for ticket in self._async_iter_tickets_after_id(missed_conditions, last_id):
+                    if ticket.get('id') not in seen_ids:
+                        seen_ids.add(ticket.get('id'))
+                        yield ticket
+
+    async def _async_iter_tickets_after_id(self, conditions, last_id=0):
+        ''' same as ConnectWise._iter_tickets_after_id but yields single tickets '''
+        while True:
+            r = await self._async_get_fields(self._make_tickets_after_id_url(conditions, last_id), 'tickets')
+            rr = self._parse_tickets_page(r, last_id)
+            if not rr:
+                break
+            for ticket in rr:
+                yield ticket
+            last_id = rr[-1].get('id', 0)
+            if len(rr) < self.tickets_page_size:
+                break
+
+    async def create_ticket(self, ticket_summary, company_name, board_name='', event_score=0, stellar_case_number=None):
+        new_ticket_id = 0
+        if self.cw_use_default_board:
+            board_name = self.cw_default_board
+        company_id = await self.get_company(company_name)
+        board_id = await self.get_board(board_name)
+        ticket_data = self._make_ticket_data(ticket_summary, company_name, company_id, board_id, event_score,
+                                             stellar_case_number)
+        url = '{}{}'.format(self.base_url, '/service/tickets')
+        r = await self._async_post(url, data=ticket_data)
+        if 200 <= r.status_code <= 299:
+            rr = json.loads(r.text)
+            new_ticket_id = int(rr['id'])
+            self.l.info("New ticket created: [{}]".format(new_ticket_id))
+        else:
+            self.l.error("Error creating ticket: [{}: {}]".format(r.status_code, r.text))
+        return new_ticket_id
+
+    async def get_company(self, company_name, last_try=False, all_fields=False):
+        ret_id = 0
+        if self.cw_avoid_company_lookup:
+            self.l.info("Using default company for all tickets as optioned: [{}/{}]".format(self.cw_default_company, self.cw_default_company_id))
+            ret_id = self.cw_default_company_id
+        else:
+            self.l.info("Finding company name: [{}]".format(company_name))
+            company_name = self._map_company_name(company_name)
+            # a due directory refresh is a blocking request - it runs in the executor, not on the event loop
+            ret_id = await asyncio.get_running_loop().run_in_executor(None, self._find_company_in_directory, company_name)
+            if ret_id is None:
+                if all_fields:
+                    url = '{}/company/companies?conditions=name="{}"'.format(self.base_url, company_name)
+                else:
+                    url = '{}/company/companies?conditions=name="{}"&fields=id,name,status,deletedFlag'.format(
+                        self.base_url, company_name)
+                ret_id = 0
+                r = await self._async_get(url)
+                if 200 <= r.status_code <= 299:
+                    ret_id = self._parse_company_id(json.loads(r.text), company_name)
+                else:
+                    self.l.error("Error querying companies: [{}: {}]".format(r.status_code, r.text))
+                self._add_company_to_directory(company_name, ret_id)
+
+            if not ret_id:
+                self.l.warning("Company name [{}] could not be found. Using default company: [{}/{}]".format(
+                        company_name, self.cw_default_company, self.cw_default_company_id))
+                ret_id = self.cw_default_company_id
+        return ret_id
+
+    async def get_board(self, board_name, last_try=False):
+        # boards are cached - a due reference data reload is a blocking request, so it runs in the executor
+        if time() - self.reference_data_ts < self.reference_data_refresh:
+            return ConnectWise.get_board(self, board_name, last_try=last_try)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: ConnectWise.get_board(self, board_name, last_try=last_try))
+
+    async def get_ticket_notes(self, ticket_id, cursor=None):
+        rr = []
+        self.l.info("Getting ticket notes: [{}]".format(ticket_id))
+        notes = await self._async_get_all_pages(self._make_notes_url(ticket_id, cursor), page_size=self.notes_page_size,
+                                                field_site='notes')
+        if notes is None:
+            self.l.error("Problem getting ticket notes: [{}]".format(ticket_id))
+        else:
+            rr = self._filter_ticket_notes(notes, cursor)
+        return rr
+
+    async def create_ticket_note(self, ticket_id, ticket_note_text):
+        ticket_note_id = 0
+        note_data = json.dumps(
+            {
+                'text': '{}'.format(ticket_note_text),
+                'ticketId': ticket_id,
+                'internalFlag': True,
+                'externalFlag': False,
+                "detailDescriptionFlag": True,
+                "internalAnalysisFlag": False,
+                "resolutionFlag": False
+            }
+        )
+        url = '{}/service/tickets/{}/notes'.format(self.base_url, ticket_id)
+        r = await self._async_post(url, data=note_data)
+        if 200 <= r.status_code <= 299:
+            rr = json.loads(r.text)
+            ticket_note_id = int(rr['id'])
+            self.l.info("New ticket note created: [ticket id: {} | note id: {}]".format(ticket_id, ticket_note_id))
+        else:
+            self.l.error("Error creating note for ticket: [{}: {}]".format(r.status_code, r.text))
+        return ticket_note_id
+
+    async def get_audit_records(self, ticket_id, cursor=None):
+        rr = self._get_cached_audit_records(ticket_id)
+        if rr is not None:
+            return rr
+        rr = {}
+        self.l.info("Getting audit records: [{}]".format(ticket_id))
+        if cursor:
+            records = await self._async_get_all_pages(self._make_audit_url(ticket_id, cursor), page_size=self.audit_page_size,
+                                                      field_site='audit')
+            if records is not None:
+                rr = self._filter_audit_records(records, cursor)
+                self._cache_audit_records(ticket_id, rr)
+            return rr
+        url = "{}/system/audittrail?type=Ticket&id={}".format(self.base_url, ticket_id)
+        records = await self._async_get_all_pages(url, page_size=self.audit_page_size, field_site='audit')
+        if records is not None:
+            rr = records
+            self._cache_audit_records(ticket_id, rr)
+        else:
+            self.l.error("Problem getting audit records: [{}]".format(ticket_id))
+        return rr
+
+    async def get_ticket_ownership_change(self, ticket_id, cursor=None):
+        ret = {}
+        audit_records = await self.get_audit_records(ticket_id, cursor=cursor)
+        for ar in audit_records:
+            if ar.get('auditType', '') == "Resource" and ar.get('auditSubType', '') == "Owner":
+                ret = ar
+                break
+        return ret
+
+    async def get_member_email_via_link(self, member_link):
+        member_key = self._get_member_key(member_link)
+        email = self.member_cache.get(member_key)
+        if email is not None:
+            return email
+        email = ''
+        self.l.info("Getting email for member via direct link: [{}]".format(member_link))
+        r = await self._async_get_fields(member_link, 'member')
+        if 200 <= r.status_code <= 299:
+            rr = json.loads(r.text)
+            email = rr.get('primaryEmail', '')
+            self.member_cache.put(member_key, email)
+        else:
+            self.l.error("Error retrieving direct member link: [{}]".format(member_link))
+        return email
+
+
+class lru_ttl_cache():
+
+    def __init__(self, max_size=500, ttl=3600):
+        '''
+        thread safe LRU cache whose entries expire ttl seconds after they were stored
+        :param max_size: entries kept before the least recently used one is dropped
+        :param ttl: seconds an entry is valid (0 = never expires)
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and (not self.ttl or time() - entry[1] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, ts=None):
+        with self.lock:
+            self.entries[key] = (value, ts or time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            hit_rate = round(self.hits / lookups, 3) if lookups else 0.0
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "hit_rate": hit_rate}
+
+    def save(self, file_path):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = [[key, value, ts] for (key, (value, ts)) in self.entries.items()]
+            self.dirty = False
+        # written next to the file and renamed over it - a crash mid-write leaves the previous file intact
+        tmp_file_path = "{}.tmp".format(file_path)
+        with open(tmp_file_path, "w") as fh:
+            json.dump(data, fh)
+        os.replace(tmp_file_path, file_path)
+
+    def load(self, file_path):
+        ''' restores saved entries that have not expired - returns the number loaded '''
+        try:
+            with open(file_path, "r") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return 0
+        loaded_cnt = 0
+        for (key, value, ts) in data:
+            if not self.ttl or time() - ts < self.ttl:
+                self.put(key, value, ts=ts)
+                loaded_cnt += 1
+        self.dirty = False
+        return loaded_cnt
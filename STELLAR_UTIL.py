@@ -1,4 +1,4 @@
-__version__ = '20251208.000'
+__version__ = '20261017.018'
 
 """
 Provides utilitarian methods for general stellar cyber usage.
@@ -42,6 +42,35 @@ Provides utilitarian methods for general stellar cyber usage.
                 20251027.000    added new STELLAR_UTIL method to return all case activities as a list (get_case_activities)
                 20251029.000    updated get_case_activities to summerize by type   
                 20251208.000    added method STELLAR_UTIL.cancel_stellar_case        
+                20261017.000    request helpers share one pooled session with timeouts and jittered retries (429/5xx/connection resets)
+                20261017.001    added token_manager class - cached / background refreshed access token (fixes refresh on every request)
+                20261017.002    local_db can be shared between threads - statements are serialized on a lock
+                20261017.003    added AsyncStellarUtil - asyncio (aiohttp) versions of the operations used by the sync loop
+                20261017.004    local_db sync cursors per remote ticket (get_sync_cursor / put_sync_cursor)
+                20261017.005    added STELLAR_UTIL.iter_stellar_cases - yields cases page by page (limit / skip)
+                20261017.006    local_db schema versioning (schema_version table) - indexes on case id / ticket id / state
+                                added local_db.get_ticket_linkages for batch lookups
+                20261017.007    local_db statements are parameterized, WAL journal with configurable synchronous
+                                added local_db.unit_of_work - the writes made inside commit in one transaction
+                20261017.008    optional write-through in-memory linkage index in local_db (linkage_index)
+                20261017.009    local_db schema 2 - unique case / ticket ids, integer ticket ids, put_ticket_linkage upserts
+                                added local_db.archive_closed_linkages - moves old closed linkages to the archive table
+                20261017.010    iter_stellar_cases fetches the pages after the first one concurrently (stellar_cases_page_workers)
+                                get_stellar_cases returns all pages instead of the first one
+                20261017.011    case alerts are paged with a configurable page size (stellar_case_alerts_page_size) - the pages
+                                after the first one are fetched concurrently when the total is known, the page size is halved
+                                when a page cannot be retrieved. optional projection for get_case_alerts alert names
+                20261017.012    added STELLAR_UTIL.get_stellar_interflows - batched _id lookups grouped by index
+                                get_security_alert_names / get_security_alert_enrichment use it instead of one lookup per alert
+                20261017.013    added interflow_cache class - bounded LRU cache of interflow records keyed by (index, id) with
+                                optional spill to disk, invalidated when an alert is updated (get_interflow_cache_stats)
+                20261017.014    added iter_stellar_security_alerts / iter_stellar_es_query - yield scroll batches, clear the
+                                scroll when done and optionally scroll slices in parallel. the list versions are built on them
+                20261017.015    POST requests are only retried on 429 and on connection failures before the request was sent
+                20261017.016    AsyncStellarUtil refreshes a due access token in the executor instead of on the event loop
+                20261017.017    a case alerts page that cannot be retrieved is retried once, then raised instead of cutting the list short
+                20261017.018    added local_db.get_archived_case_ids (indexed) - put_ticket_linkage refuses a ticket id already
+                                linked to another case instead of archiving that case's linkage
 """
 
 import os, sys
@@ -49,16 +78,58 @@ import time
 from time import strftime, localtime
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+import random
 import base64
+import hashlib
+import threading
+import asyncio
+try:
+    import aiohttp
+except ImportError:
+    # only needed for AsyncStellarUtil
+    aiohttp = None
 import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
 import urllib3
 from enum import Enum
 import sqlite3 as sl
+from contextlib import contextmanager
 import zipfile
 import gzip, shutil
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# response codes that are retried by STELLAR_UTIL._send
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+# methods that can be replayed safely - the others (POST) are only retried when the server cannot have applied them
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'PATCH']
+
+# the alert fields get_case_alerts reads when only the alert names are returned
+CASE_ALERT_NAME_FIELDS = 'xdr_event.display_name,event_score'
+
+
+def is_retry_status(method, status_code):
+    ''' 429 means the request was not processed - the other retry codes may come after a POST was applied '''
+    if method in IDEMPOTENT_METHODS:
+        return status_code in RETRY_STATUS_CODES
+    return status_code == 429
+
+
+def is_connect_error(e):
+    ''' True if the connection could not be opened, i.e. nothing was sent (requests or aiohttp exception) '''
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError):
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    if aiohttp is not None:
+        return isinstance(e, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+    return False
+
 
 class CASE_STATUS(Enum):
     Escalated = "Escalated"
@@ -89,6 +160,29 @@ class STELLAR_UTIL:
             - stellar_min_alert_cnt     threshold of minimum number of alerts for cases query (default: disabled)
             - stellar_min_score         minimim case score for cases query (default: 0)
             - initial_run_lookback      on first run, how far back to retrieve cases in days (default: 7)
+            - stellar_pool_size         pooled keep-alive connections to the stellar DP (default: 10)
+            - stellar_connect_timeout   connect timeout in seconds (default: 10)
+            - stellar_read_timeout      read timeout in seconds (default: 60)
+            - stellar_max_retries       retries for 429/5xx responses and connection resets (default: 3)
+            - stellar_retry_backoff     base delay in seconds for exponential backoff (default: 1)
+            - stellar_verify_cert       verify the DP certificate (default: false)
+            - stellar_token_refresh_margin  seconds before expiry that the access token is refreshed (default: 60)
+            - stellar_persist_token     keep the access token in the data path across restarts (default: false)
+            - stellar_cases_page_size   cases per request for iter_stellar_cases (default: 100)
+            - stellar_cases_page_workers    case pages fetched concurrently by iter_stellar_cases (default: 4)
+            - stellar_case_alerts_page_size     alerts per request for get_case_alerts / close_case_alerts (default: 100)
+            - stellar_case_alerts_page_workers  case alert pages fetched concurrently (default: 4)
+            - stellar_case_alerts_projection    only request the alert name / score when get_case_alerts returns names (default: false)
+            - stellar_interflow_batch_size  alert ids per get_stellar_interflows query (default: 100)
+            - stellar_interflow_workers     get_stellar_interflows queries run concurrently (default: 4)
+            - stellar_max_query_length      longest get_stellar_interflows query string in characters (default: 4000)
+            - stellar_interflow_cache_size  interflow records kept in memory (default: 1000, 0 = no cache)
+            - stellar_interflow_cache_bytes     memory limit of the cached records in bytes (default: 50000000)
+            - stellar_interflow_cache_ttl   seconds a cached record is used (default: 3600, 0 = until evicted)
+            - stellar_interflow_cache_spill     records evicted from memory are kept in a db on the data path (default: false)
+            - stellar_interflow_cache_spill_size    records kept in the spill db (default: 100000)
+            - stellar_scroll_batch_size     hits per scroll request of the ES query helpers (default: 100)
+            - stellar_scroll_slices         scroll slices run in parallel by the ES query helpers (default: 1)
         """
 
         self.l = logger
@@ -104,14 +198,36 @@ class STELLAR_UTIL:
         self.stellar_fb_api_key = config.get('stellar_api_key', '')
         self.stellar_saas = config.get('stellar_saas', True)
         self.stellar_new_auth = config.get('stellar_new_rbac_user_auth', False)
-        self.oauth = {"token": '', "expires": 0}
+        self.basic_auth = base64.b64encode(bytes(self.stellar_fb_user + ":" + self.stellar_fb_api_key, "utf-8")).decode("utf-8")
+        self.token_manager = None
         self.stellar_case_tag = config.get('stellar_case_tag', 'ticket_opened')
         self.stellar_min_alert_cnt = config.get('stellar_min_alert_cnt', 0)
         self.stellar_min_score = config.get('stellar_min_score', 0)
         self.initial_run_lookback = config.get('initial_run_lookback', 7)
+        self.cases_page_size = int(config.get('stellar_cases_page_size', 100))
+        self.cases_page_workers = max(int(config.get('stellar_cases_page_workers', 4)), 1)
+        self.case_alerts_page_size = max(int(config.get('stellar_case_alerts_page_size', 100)), 1)
+        self.case_alerts_page_workers = max(int(config.get('stellar_case_alerts_page_workers', 4)), 1)
+        self.case_alerts_projection = config.get('stellar_case_alerts_projection', False)
+        self.interflow_batch_size = max(int(config.get('stellar_interflow_batch_size', 100)), 1)
+        self.interflow_workers = max(int(config.get('stellar_interflow_workers', 4)), 1)
+        self.max_query_length = int(config.get('stellar_max_query_length', 4000))
+        self.scroll_batch_size = max(int(config.get('stellar_scroll_batch_size', 100)), 1)
+        self.scroll_slices = max(int(config.get('stellar_scroll_slices', 1)), 1)
         self.httpjson_forwarder_url = config.get('httpjson_forwarder_url', '')
         self.httpjson_forwarder_onprem = config.get('onprem_logforwarder', True)
 
+        ''' shared transport for all API requests '''
+        self.pool_size = int(config.get('stellar_pool_size', 10))
+        self.request_timeout = (config.get('stellar_connect_timeout', 10), config.get('stellar_read_timeout', 60))
+        self.max_retries = int(config.get('stellar_max_retries', 3))
+        self.retry_backoff = float(config.get('stellar_retry_backoff', 1))
+        self.retry_max_wait = 60
+        self.verify_cert = config.get('stellar_verify_cert', False)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+
         ''' set persistent data path for containerization support '''
         self.data_path = self.get_script_path()
         if optional_data_path:
@@ -125,11 +241,45 @@ class STELLAR_UTIL:
             raise Exception(
                 "Data path specified in config does not exist: [{}] - cannot continue".format(self.data_path))
 
+        ''' interflow records are effectively immutable apart from status / tags, which are invalidated on update '''
+        self.interflow_cache = None
+        if int(config.get('stellar_interflow_cache_size', 1000)):
+            spill_file_path = ''
+            if config.get('stellar_interflow_cache_spill', False):
+                spill_file_path = "{}/stellar_interflow_cache.db".format(self.data_path)
+            self.interflow_cache = interflow_cache(max_size=int(config.get('stellar_interflow_cache_size', 1000)),
+                                                   max_bytes=int(config.get('stellar_interflow_cache_bytes', 50000000)),
+                                                   ttl=int(config.get('stellar_interflow_cache_ttl', 3600)),
+                                                   spill_file_path=spill_file_path,
+                                                   spill_max_size=int(config.get('stellar_interflow_cache_spill_size', 100000)))
+
+        ''' access tokens are only used for the saas and user (rbac) api key auth methods '''
+        if self.stellar_new_auth or self.stellar_saas:
+            if self.stellar_new_auth:
+                token_headers = {"Authorization": "Bearer {}".format(self.stellar_fb_api_key)}
+            else:
+                token_headers = {"Authorization": "Basic {}".format(self.basic_auth),
+                                 "Content-Type": "application/x-www-form-urlencoded"}
+            token_file_path = ''
+            if config.get('stellar_persist_token', False):
+                token_file_path = "{}/stellar_token".format(self.data_path)
+            self.token_manager = token_manager(logger=self.l, session=self.session,
+                                               url='https://{}/connect/api/v1/access_token'.format(self.stellar_dp),
+                                               headers=token_headers, verify_cert=self.verify_cert,
+                                               timeout=self.request_timeout,
+                                               refresh_margin=int(config.get('stellar_token_refresh_margin', 60)),
+                                               token_file_path=token_file_path,
+                                               key_id="{}:{}".format(self.stellar_fb_user, self.stellar_fb_api_key))
+
     def get_version(self):
         return __version__
 
     def get_stellar_interflow(self, stellar_index, stellar_id):
         # headers = {'Accept': 'application/json', 'Content-type': 'application/json'}
+        if self.interflow_cache:
+            hit = self.interflow_cache.get((stellar_index, stellar_id))
+            if hit is not None:
+                return hit
         path = '/connect/api/data/{}/_search?q=_id:{}'.format(stellar_index, stellar_id)
         interflow = self._request_get(path)
         hit = {}
@@ -139,8 +289,72 @@ class STELLAR_UTIL:
             hit = hit.get('_source', {})
             stellar_url = self.make_stellar_url(event_index=stellar_index, event_id=stellar_id)
             hit['stellar_url'] = stellar_url
+            if self.interflow_cache:
+                self.interflow_cache.put((stellar_index, stellar_id), hit)
         return hit
 
+    def get_stellar_interflows(self, security_alerts=[]):
+        '''
+        batch version of get_stellar_interflow - the ids are grouped by index and looked up with _id:(a OR b ...)
+        queries of up to stellar_interflow_batch_size ids, stellar_interflow_workers queries at a time
+        :param security_alerts: list of {"_id": ..., "_index": ...}
+        :return: dict of (index, id): interflow - {} for records that were not found
+        '''
+        ret = {}
+        ids_by_index = {}
+        for sec_alert in security_alerts:
+            id = sec_alert.get('_id', None)
+            index = sec_alert.get('_index', None)
+            if id and index and (index, id) not in ret:
+                ret[(index, id)] = {}
+                if self.interflow_cache:
+                    interflow = self.interflow_cache.get((index, id))
+                    if interflow is not None:
+                        ret[(index, id)] = interflow
+                        continue
+                ids_by_index.setdefault(index, []).append(id)
+        queries = []
+        for index, ids in ids_by_index.items():
+            queries.extend((index, chunk) for chunk in self._chunk_interflow_ids(index, ids))
+        if not queries:
+            return ret
+        with ThreadPoolExecutor(max_workers=min(self.interflow_workers, len(queries))) as executor:
+            for interflows in executor.map(lambda query: self._get_interflow_batch(*query), queries):
+                ret.update(interflows)
+                if self.interflow_cache:
+                    for key, interflow in interflows.items():
+                        self.interflow_cache.put(key, interflow)
+        return ret
+
+    def _make_interflow_batch_path(self, stellar_index, stellar_ids):
+        return '/connect/api/data/{}/_search?size={}&q=_id:({})'.format(
+            stellar_index, len(stellar_ids), ' OR '.join('"{}"'.format(stellar_id) for stellar_id in stellar_ids))
+
+    def _chunk_interflow_ids(self, stellar_index, stellar_ids):
+        ''' splits the ids so no query has more than stellar_interflow_batch_size ids or exceeds stellar_max_query_length '''
+        chunks = []
+        chunk = []
+        for stellar_id in stellar_ids:
+            if chunk and (len(chunk) >= self.interflow_batch_size or
+                          len(self._make_interflow_batch_path(stellar_index, chunk + [stellar_id])) > self.max_query_length):
+                chunks.append(chunk)
+                chunk = []
+            chunk.append(stellar_id)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _get_interflow_batch(self, stellar_index, stellar_ids):
+        ret = {}
+        r = self._request_get(self._make_interflow_batch_path(stellar_index, stellar_ids))
+        for hit in r.get('hits', {}).get('hits', []):
+            stellar_id = hit.get('_id')
+            if stellar_id in stellar_ids:
+                interflow = hit.get('_source', {})
+                interflow['stellar_url'] = self.make_stellar_url(event_index=stellar_index, event_id=stellar_id)
+                ret[(stellar_index, stellar_id)] = interflow
+        return ret
+
     def update_stellar_record(self, comment, event_index, event_id):
         ''' only works for onprem versions of stellar - why?? '''
         path = '/connect/api/update_ser'
@@ -152,6 +366,7 @@ class STELLAR_UTIL:
             "comments": "{}".format(comment)
         }
         r = self._request_post(path=path, data=update_rec_data)
+        self.invalidate_interflow(event_index, event_id)
         return
 
     def update_stellar_record_status(self, event_index, event_id, status=None, comment=None):
@@ -166,6 +381,7 @@ class STELLAR_UTIL:
         if comment:
             update_rec_data['comments'] = "{}".format(comment)
         r = self._request_post(path=path, data=update_rec_data)
+        self.invalidate_interflow(event_index, event_id)
         return
 
     def update_stellar_record_comment(self, event_index, event_id, comment):
@@ -173,8 +389,19 @@ class STELLAR_UTIL:
         path = '/connect/api/v1/security_events/{}/{}'.format(event_index, event_id)
         update_rec_data = {"comments": "{}".format(comment)}
         r = self._request_post(path=path, data=update_rec_data)
+        self.invalidate_interflow(event_index, event_id)
         return
 
+    def invalidate_interflow(self, event_index, event_id):
+        ''' drops a record from the interflow cache after it was updated '''
+        if self.interflow_cache:
+            self.interflow_cache.invalidate((event_index, event_id))
+
+    def get_interflow_cache_stats(self):
+        if self.interflow_cache:
+            return self.interflow_cache.get_stats()
+        return {}
+
     def make_stellar_url(self, event_index, event_id):
         if self.stellar_saas:
             ret = "https://{}/alerts/alert/{}/_doc/{}".format(self.stellar_dp, event_index, event_id)
@@ -191,7 +418,6 @@ class STELLAR_UTIL:
 
     def get_stellar_cases(self, from_ts=0, from_ts_checkpoint_file='', tenant_id='', use_modified_at=False,
                           ignore_case_tag=True, ignore_api_user_mods=False, status=None):
-        path = "/connect/api/v1/cases?"
         from_cp_file_path = ''
         # from_cp_file is a switch used to force reading timestamp from checkpoint file and takes priority
         if from_ts_checkpoint_file:
@@ -201,6 +427,88 @@ class STELLAR_UTIL:
         if not from_ts:
             days_ago = 86400 * self.initial_run_lookback * 1000
             from_ts = self._get_ts() - days_ago
+        # the checkpoint is taken before the query so cases modified while paging are picked up next time
+        checkpoint_ts = self._get_ts()
+        try:
+            cases = list(self.iter_stellar_cases(from_ts=from_ts, tenant_id=tenant_id, use_modified_at=use_modified_at,
+                                                 ignore_case_tag=ignore_case_tag,
+                                                 ignore_api_user_mods=ignore_api_user_mods, status=status))
+        except Exception as e:
+            self.l.error("Cannot get cases: [{}]".format(e))
+            return {}
+        r = {'total': len(cases), 'cases': cases}
+        if from_cp_file_path:
+            self.checkpoint_write(filepath=from_cp_file_path, val=checkpoint_ts)
+        return r
+
+    def iter_stellar_cases(self, from_ts=0, tenant_id='', use_modified_at=False, ignore_case_tag=True,
+                           ignore_api_user_mods=False, status=None):
+        '''
+        same query as get_stellar_cases but yields the cases page by page (stellar_cases_page_size per request)
+        so processing starts with the first page. the first page gives the total, the pages after it are fetched
+        up to stellar_cases_page_workers at a time. cases missed because pages shifted while fetching are
+        picked up by walking the pages again
+        '''
+        if not from_ts:
+            days_ago = 86400 * self.initial_run_lookback * 1000
+            from_ts = self._get_ts() - days_ago
+        path = self._make_cases_path(from_ts=from_ts, tenant_id=tenant_id, use_modified_at=use_modified_at,
+                                     ignore_case_tag=ignore_case_tag, ignore_api_user_mods=ignore_api_user_mods,
+                                     status=status)
+        self.l.info("Getting cases from ts: [{}]".format(from_ts))
+        seen_ids = set()
+        r = self._get_cases_page(path, 0)
+        case_total = r.get('total', 0)
+        for case in self._drop_seen_cases(r.get('cases', []), seen_ids):
+            yield case
+        page_skips = iter(range(self.cases_page_size, case_total, self.cases_page_size))
+        with ThreadPoolExecutor(max_workers=self.cases_page_workers) as executor:
+            pending = deque()
+            for skip in page_skips:
+                pending.append(executor.submit(self._get_cases_page, path, skip))
+                if len(pending) >= self.cases_page_workers:
+                    break
+            try:
+                while pending:
+                    r = pending.popleft().result()
+                    next_skip = next(page_skips, None)
+                    if next_skip is not None:
+                        pending.append(executor.submit(self._get_cases_page, path, next_skip))
+                    for case in self._drop_seen_cases(r.get('cases', []), seen_ids):
+                        yield case
+            finally:
+                for future in pending:
+                    future.cancel()
+        if len(seen_ids) < case_total:
+            self.l.warning("Stellar case pages shifted while fetching: [{} of {}] - walking the pages again".format(len(seen_ids), case_total))
+            skip = 0
+            while True:
+                cases = self._get_cases_page(path, skip).get('cases', [])
+                skip += len(cases)
+                for case in self._drop_seen_cases(cases, seen_ids):
+                    yield case
+                if len(cases) < self.cases_page_size:
+                    break
+        self.l.info("Retrieved case count: [{}]".format(len(seen_ids)))
+
+    def _get_cases_page(self, path, skip):
+        r = self._request_get(path="{}&limit={}&skip={}".format(path, self.cases_page_size, skip))
+        if 'cases' not in r.get('data', {}):
+            # stop here so the caller does not move its checkpoint past the missing cases
+            raise Exception("Cannot retrieve cases page: [skip: {}]".format(skip))
+        return r.get('data', {})
+
+    def _drop_seen_cases(self, cases, seen_ids):
+        ret = []
+        for case in cases:
+            if case.get('_id') not in seen_ids:
+                seen_ids.add(case.get('_id'))
+                ret.append(case)
+        return ret
+
+    def _make_cases_path(self, from_ts, tenant_id='', use_modified_at=False, ignore_case_tag=True,
+                         ignore_api_user_mods=False, status=None):
+        path = "/connect/api/v1/cases?"
         if use_modified_at:
             path += "FROM~modified_at={}".format(from_ts)
         else:
@@ -223,16 +531,7 @@ class STELLAR_UTIL:
                 stellar_fb_user_data = self.get_user(self.stellar_fb_user)
                 self.stellar_fb_user_id = stellar_fb_user_data.get('user_id', '')
             path += "&NOT~modified_by={}".format(self.stellar_fb_user_id)
-
-        self.l.info("Getting cases from ts: [{}]".format(from_ts))
-        r = self._request_get(path=path)
-
-        r = r.get('data', {})
-        case_count = r.get('total', 0)
-        self.l.info("Retrieved case count: [{}]".format(case_count))
-        if from_cp_file_path and r:
-            self.checkpoint_write(filepath=from_cp_file_path, val=self._get_ts())
-        return r
+        return path
 
     def get_stellar_case(self, ticket_id, printit=False):
         path = "/connect/api/v1/cases?"
@@ -424,33 +723,107 @@ class STELLAR_UTIL:
         :param case_id: stellar case id
         :return: list of security alert interflows
         """
-        path = "/connect/api/v1/cases/{}/alerts".format(case_id)
         self.l.info("Getting alerts associated with case: [{}]".format(case_id))
-        limit = 10
-        skip = 0
+        fields = CASE_ALERT_NAME_FIELDS if return_only_alert_names and self.case_alerts_projection else ''
         alerts = []
+        doc_cnt = 0
+        for doc in self._iter_case_alert_docs(case_id, fields=fields):
+            doc_cnt += 1
+            alert = self._make_case_alert(doc, return_only_alert_names)
+            if alert:
+                alerts.append(alert)
+        self.l.info("Retrieved alerts: [{}]".format(doc_cnt))
+        return alerts
+
+    def _iter_case_alert_docs(self, case_id, fields=''):
+        '''
+        yields the alert docs of a case, stellar_case_alerts_page_size per request. when the first page gives the
+        total, the pages after it are fetched up to stellar_case_alerts_page_workers at a time. raises when a page
+        cannot be retrieved, so callers never act on a partial list
+        :param fields: only request these alert fields (comma separated)
+        '''
+        path = "/connect/api/v1/cases/{}/alerts".format(case_id)
+        limit = self.case_alerts_page_size
         while True:
-            loop_path = "{}?limit={}&skip={}".format(path, limit, skip)
-            r = self._request_get(path=loop_path)
-            docs = r.get('data', {}).get('docs')
-            returned_cnt = len(docs)
-            skip += returned_cnt
-            for doc in docs:
-                interflow = doc.get('_source')
-                if return_only_alert_names:
-                    alert_name = interflow.get('xdr_event', {}).get('display_name', None)
-                    alert_score = interflow.get('event_score', '')
-                    if alert_name:
-                        alerts.append("{} [{}]".format(alert_name, alert_score))
-                else:
-                    interflow['_id'] = doc.get('_id', '')
-                    interflow['_index'] = doc.get('_index', '')
-                    alerts.append(interflow)
-            if returned_cnt < limit:
+            r = self._get_case_alerts_page(path, limit, 0, fields)
+            if r is not None:
                 break
+            if fields:
+                self.l.warning("Cannot retrieve projected alerts for case: [{}] - disabling projection".format(case_id))
+                self.case_alerts_projection = False
+                fields = ''
+            elif limit > 10:
+                # large pages can time out on big cases
+                limit = max(limit // 2, 10)
+                self.l.warning("Cannot retrieve alerts for case: [{}] - retrying with page size: [{}]".format(case_id, limit))
+            else:
+                raise Exception("Cannot retrieve alerts for case: [{}]".format(case_id))
+        docs = r.get('docs', [])
+        for doc in docs:
+            yield doc
+        if len(docs) < limit:
+            return
+        total = r.get('total')
+        if total is None:
+            skip = len(docs)
+            while True:
+                docs = self._get_next_case_alerts_page(case_id, path, limit, skip, fields).get('docs', [])
+                skip += len(docs)
+                for doc in docs:
+                    yield doc
+                if len(docs) < limit:
+                    return
+        page_skips = iter(range(limit, total, limit))
+        with ThreadPoolExecutor(max_workers=self.case_alerts_page_workers) as executor:
+            pending = deque()
+            for skip in page_skips:
+                pending.append(executor.submit(self._get_next_case_alerts_page, case_id, path, limit, skip, fields))
+                if len(pending) >= self.case_alerts_page_workers:
+                    break
+            try:
+                while pending:
+                    r = pending.popleft().result()
+                    next_skip = next(page_skips, None)
+                    if next_skip is not None:
+                        pending.append(executor.submit(self._get_next_case_alerts_page, case_id, path, limit, next_skip,
+                                                       fields))
+                    for doc in r.get('docs', []):
+                        yield doc
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _get_next_case_alerts_page(self, case_id, path, limit, skip, fields=''):
+        ''' a page after the first one - retried once, then raised so a partial alert list is never returned '''
+        r = self._get_case_alerts_page(path, limit, skip, fields)
+        if r is None:
+            self.l.warning("Cannot retrieve alerts page for case: [{}] [skip: {}] - retrying".format(case_id, skip))
+            r = self._get_case_alerts_page(path, limit, skip, fields)
+        if r is None:
+            raise Exception("Cannot retrieve alerts page for case: [{}] [skip: {}]".format(case_id, skip))
+        return r
 
-        self.l.info("Retrieved alerts: [{}]".format(skip))
-        return alerts
+    def _get_case_alerts_page(self, path, limit, skip, fields=''):
+        ''' returns the data of one page of case alerts - None if it could not be retrieved '''
+        page_path = "{}?limit={}&skip={}".format(path, limit, skip)
+        if fields:
+            page_path += "&fields={}".format(fields)
+        r = self._request_get(path=page_path)
+        if not isinstance(r.get('data', {}).get('docs'), list):
+            return None
+        return r.get('data', {})
+
+    def _make_case_alert(self, doc, return_only_alert_names=False):
+        interflow = doc.get('_source', {})
+        if return_only_alert_names:
+            alert_name = interflow.get('xdr_event', {}).get('display_name', None)
+            alert_score = interflow.get('event_score', '')
+            if alert_name:
+                return "{} [{}]".format(alert_name, alert_score)
+            return None
+        interflow['_id'] = doc.get('_id', '')
+        interflow['_index'] = doc.get('_index', '')
+        return interflow
 
     def close_case_alerts(self, case_id):
         """
@@ -459,28 +832,16 @@ class STELLAR_UTIL:
         :param case_id: stellar case id
         :return: None
         """
-        path = "/connect/api/v1/cases/{}/alerts".format(case_id)
         self.l.info("Getting alerts associated with case: [{}]".format(case_id))
-        limit = 10
-        skip = 0
-        alerts = []
-        while True:
-            loop_path = "{}?limit={}&skip={}".format(path, limit, skip)
-            r = self._request_get(path=loop_path)
-            docs = r.get('data', {}).get('docs')
-            returned_cnt = len(docs)
-            skip += returned_cnt
-            for doc in docs:
-                interflow = {"_id": doc.get('_id', ''), "_index": doc.get('_index', '')}
-                alerts.append(interflow)
-            if returned_cnt < limit:
-                break
+        # only the ids are needed to close the alerts
+        alerts = [{"_id": doc.get('_id', ''), "_index": doc.get('_index', '')}
+                  for doc in self._iter_case_alert_docs(case_id, fields='_id')]
 
         for alert in alerts:
             ''' close each alert '''
             self.update_stellar_record_status(event_index=alert['_index'], event_id=alert['_id'])
 
-        self.l.info("Closed alerts: [{}] for case: [{}]".format(skip, case_id))
+        self.l.info("Closed alerts: [{}] for case: [{}]".format(len(alerts), case_id))
         return
 
     def get_open_cases(self):
@@ -500,44 +861,55 @@ class STELLAR_UTIL:
 
     def get_stellar_security_alerts(self, from_ts=0, seconds_ago=0, tenant_id="", from_ts_checkpoint_file='', query=''):
         hits_total = 0
-        hits_returned = 0
         ret = []
-        path = "/connect/api/data/aella-ser-*/_search?scroll=10m&size=100&q="
-        scroll_path = "/connect/api/data/_search/scroll"
+        totals = {}
+        try:
+            for hits in self.iter_stellar_security_alerts(from_ts=from_ts, seconds_ago=seconds_ago, tenant_id=tenant_id,
+                                                          from_ts_checkpoint_file=from_ts_checkpoint_file, query=query,
+                                                          totals=totals):
+                ret.extend(hits)
+            hits_total = totals.get('hits_total', 0)
+
+        except Exception as e:
+            self.l.error("Problem running \"get_stellar_security_alerts\": [{}]".format(e))
+            pass
+
+        return hits_total, ret
+
+    def iter_stellar_security_alerts(self, from_ts=0, seconds_ago=0, tenant_id="", from_ts_checkpoint_file='', query='',
+                                     batch_size=None, slices=None, totals=None):
+        '''
+        same query as get_stellar_security_alerts but yields the hits one scroll batch (list of hits) at a time
+        the checkpoint file is only written once all batches were retrieved
+        :param batch_size: hits per request (default: stellar_scroll_batch_size)
+        :param slices: scroll slices retrieved in parallel (default: stellar_scroll_slices) - batches arrive out of order
+        :param totals: optional dict that receives hits_total (and failed when a request failed)
+        '''
         from_cp_file_path = ''
         # from_cp_file is a switch used to force reading timestamp from checkpoint file and takes priority
         if from_ts_checkpoint_file:
             from_cp_file_path = from_ts_checkpoint_file
             from_ts = self.checkpoint_read(filepath=from_cp_file_path)
-        # on first run, checkpoint file will be empty and return zero timestamp
-        if from_ts:
-            pass
-        elif seconds_ago:
-            time_ago = seconds_ago * 1000
-            from_ts = self._get_ts() - time_ago
-        else:
-            days_ago = 86400 * self.initial_run_lookback * 1000
-            from_ts = self._get_ts() - days_ago
-        path += "(write_time:>{}".format(from_ts)
-        if tenant_id:
-            path += " AND tenantid:{}".format(tenant_id)
-        if query:
-            path += " AND {}".format(query)
-        path += ")"
+        checkpoint_ts = self._get_ts()
+        if totals is None:
+            totals = {}
+        q = self._make_write_time_query(from_ts=from_ts, seconds_ago=seconds_ago, tenant_id=tenant_id, query=query)
+        for hits in self._iter_scroll("aella-ser-*", q, batch_size=batch_size, slices=slices, totals=totals):
+            yield hits
+        # not moved past alerts that could not be retrieved
+        if from_cp_file_path and not totals.get('failed'):
+            self.checkpoint_write(filepath=from_cp_file_path, val=checkpoint_ts)
+
+    def get_stellar_es_query(self, stellar_index="aella-syslog", from_ts=0, to_ts=0, seconds_ago=0, tenant_id="", query=''):
+        hits_total = 0
+        ret = []
+        totals = {}
         try:
-            r = self._request_get(path=path)
-            hits_total = r.get('hits', {}).get('total', {}).get('value', 0)
-            ret = r.get('hits', {}).get('hits', [])
-            hits_returned = len(ret)
-            scroll_id = r.get('_scroll_id', 0)
-            scroll_query = self._get_scroll_query(scroll_id)
-            while hits_returned < hits_total:
-                r = self._request_get(path=scroll_path, data=scroll_query)
-                rr = r.get('hits', {}).get('hits', [])
-                hits_returned += len(rr)
-                ret.extend(rr)
-            if from_cp_file_path and r:
-                self.checkpoint_write(filepath=from_cp_file_path, val=self._get_ts())
+            for hits in self.iter_stellar_es_query(stellar_index=stellar_index, from_ts=from_ts, to_ts=to_ts,
+                                                   seconds_ago=seconds_ago, tenant_id=tenant_id, query=query,
+                                                   totals=totals):
+                ret.extend(hits)
+            hits_total = totals.get('hits_total', 0)
 
         except Exception as e:
             self.l.error("Problem running \"get_stellar_security_alerts\": [{}]".format(e))
@@ -545,12 +917,17 @@ class STELLAR_UTIL:
 
         return hits_total, ret
 
-    def get_stellar_es_query(self, stellar_index="aella-syslog", from_ts=0, to_ts=0, seconds_ago=0, tenant_id="", query=''):
-        hits_total = 0
-        hits_returned = 0
-        ret = []
-        path = "/connect/api/data/{}-*/_search?scroll=10m&size=100&q=".format(stellar_index)
-        scroll_path = "/connect/api/data/_search/scroll"
+    def iter_stellar_es_query(self, stellar_index="aella-syslog", from_ts=0, to_ts=0, seconds_ago=0, tenant_id="",
+                              query='', batch_size=None, slices=None, totals=None):
+        ''' same query as get_stellar_es_query but yields the hits one scroll batch at a time (see iter_stellar_security_alerts) '''
+        q = self._make_write_time_query(from_ts=from_ts, to_ts=to_ts, seconds_ago=seconds_ago, tenant_id=tenant_id,
+                                        query=query)
+        for hits in self._iter_scroll("{}-*".format(stellar_index), q, batch_size=batch_size, slices=slices,
+                                      totals=totals):
+            yield hits
+
+    def _make_write_time_query(self, from_ts=0, to_ts=0, seconds_ago=0, tenant_id="", query=''):
+        # on first run, checkpoint file will be empty and return zero timestamp
         if from_ts:
             pass
         elif seconds_ago:
@@ -559,32 +936,103 @@ class STELLAR_UTIL:
         else:
             days_ago = 86400 * self.initial_run_lookback * 1000
             from_ts = self._get_ts() - days_ago
-        path += "(write_time:>{}".format(from_ts)
+        q = "(write_time:>{}".format(from_ts)
         if to_ts:
-            path += " AND write_time:<{}".format(to_ts)
+            q += " AND write_time:<{}".format(to_ts)
         if tenant_id:
-            path += " AND tenantid:{}".format(tenant_id)
+            q += " AND tenantid:{}".format(tenant_id)
         if query:
-            path += " AND {}".format(query)
-        path += ")"
+            q += " AND {}".format(query)
+        q += ")"
+        return q
+
+    def _iter_scroll(self, index_pattern, q, batch_size=None, slices=None, totals=None):
+        '''
+        yields the hits of a query string search one scroll batch at a time - with more than one slice, each
+        slice is scrolled in its own thread and the batches are yielded as they arrive
+        '''
+        batch_size = batch_size or self.scroll_batch_size
+        slices = slices or self.scroll_slices
+        if totals is None:
+            totals = {}
+        totals['hits_total'] = 0
+        totals['failed'] = False
+        if slices <= 1:
+            for hits in self._scroll_slice(index_pattern, q, batch_size, totals):
+                yield hits
+            return
+        batches = queue.Queue(maxsize=slices * 2)
+        stop = threading.Event()
+        totals_lock = threading.Lock()
+
+        def run_slice(slice_id):
+            slice_totals = {}
+            try:
+                for hits in self._scroll_slice(index_pattern, q, batch_size, slice_totals, slice_id=slice_id,
+                                               slice_max=slices, stop=stop):
+                    while not stop.is_set():
+                        try:
+                            batches.put(hits, timeout=1)
+                            break
+                        except queue.Full:
+                            pass
+            finally:
+                with totals_lock:
+                    totals['hits_total'] += slice_totals.get('hits_total', 0)
+                    totals['failed'] = totals['failed'] or slice_totals.get('failed', True)
+                batches.put(None)
+
+        with ThreadPoolExecutor(max_workers=slices) as executor:
+            futures = [executor.submit(run_slice, slice_id) for slice_id in range(slices)]
+            try:
+                done_cnt = 0
+                while done_cnt < slices:
+                    hits = batches.get()
+                    if hits is None:
+                        done_cnt += 1
+                        continue
+                    yield hits
+            finally:
+                # also reached when the caller stops early - the slices clear their scrolls and exit
+                stop.set()
+                while not all(future.done() for future in futures):
+                    try:
+                        batches.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+        for future in futures:
+            if future.exception():
+                raise future.exception()
+
+    def _scroll_slice(self, index_pattern, q, batch_size, totals, slice_id=None, slice_max=None, stop=None):
+        path = "/connect/api/data/{}/_search?scroll=10m&size={}&q={}".format(index_pattern, batch_size, q)
+        scroll_path = "/connect/api/data/_search/scroll"
+        data = None
+        if slice_max:
+            data = json.dumps({"slice": {"id": slice_id, "max": slice_max}})
+        scroll_id = None
         try:
-            r = self._request_get(path=path)
+            r = self._request_get(path=path, data=data)
+            totals['failed'] = 'hits' not in r
             hits_total = r.get('hits', {}).get('total', {}).get('value', 0)
-            ret = r.get('hits', {}).get('hits', [])
-            hits_returned = len(ret)
-            scroll_id = r.get('_scroll_id', 0)
-            scroll_query = self._get_scroll_query(scroll_id)
-            while hits_returned < hits_total:
-                r = self._request_get(path=scroll_path, data=scroll_query)
-                rr = r.get('hits', {}).get('hits', [])
-                hits_returned += len(rr)
-                ret.extend(rr)
-
-        except Exception as e:
-            self.l.error("Problem running \"get_stellar_security_alerts\": [{}]".format(e))
-            pass
-
-        return hits_total, ret
+            totals['hits_total'] = hits_total
+            hits = r.get('hits', {}).get('hits', [])
+            hits_returned = len(hits)
+            scroll_id = r.get('_scroll_id')
+            if hits:
+                yield hits
+            while hits and hits_returned < hits_total and scroll_id and not (stop and stop.is_set()):
+                r = self._request_get(path=scroll_path, data=self._get_scroll_query(scroll_id))
+                totals['failed'] = 'hits' not in r
+                hits = r.get('hits', {}).get('hits', [])
+                hits_returned += len(hits)
+                scroll_id = r.get('_scroll_id', scroll_id)
+                if hits:
+                    yield hits
+        finally:
+            # the scroll context is held on the server until it expires otherwise
+            if scroll_id:
+                self._request_delete(path=scroll_path, data={"scroll_id": [scroll_id]})
 
     def get_security_alert_names(self, security_alerts=[]):
         '''
@@ -596,11 +1044,12 @@ class STELLAR_UTIL:
         :return: security_alert_names as a list
         '''
         security_alert_names = []
+        interflows = self.get_stellar_interflows(security_alerts)
         for sec_alert in security_alerts:
             id = sec_alert.get('_id', None)
             index = sec_alert.get('_index', None)
             if id and index:
-                interflow = self.get_stellar_interflow(stellar_index=index, stellar_id=id)
+                interflow = interflows.get((index, id), {})
                 alert_name = interflow.get('xdr_event', {}).get('display_name', None)
                 alert_score = interflow.get('event_score', '')
                 if alert_name:
@@ -617,6 +1066,7 @@ class STELLAR_UTIL:
         :return: security_alert_names as a list
         '''
 
+        interflows = self.get_stellar_interflows(security_alerts)
         for sec_alert in security_alerts:
             id = sec_alert.get('_id', None)
             index = sec_alert.get('_index', None)
@@ -627,7 +1077,7 @@ class STELLAR_UTIL:
                                  'engid_device_class': '', 'engid_name': '', 'srcip_usersid': '', 'username': '',
                                  'receive_time': 0}
             if id and index:
-                interflow = self.get_stellar_interflow(stellar_index=index, stellar_id=id)
+                interflow = interflows.get((index, id), {})
                 alert_name = interflow.get('xdr_event', {}).get('display_name', None)
                 alert_score = interflow.get('event_score', '')
                 if alert_name:
@@ -660,6 +1110,7 @@ class STELLAR_UTIL:
             r = self._request_post(path=path, data=data)
         except:
             ret = False
+        self.invalidate_interflow(index, id)
         return ret
 
     def add_case_comment(self, case_id, comment):
@@ -1003,81 +1454,23 @@ class STELLAR_UTIL:
             self.l.error("Problem with send_json_to_sensor: [{}]".format(e))
 
     def _get_auth_header(self):
-        return_code = 0
         header_string = ''
-        auth = base64.b64encode(bytes(self.stellar_fb_user + ":" + self.stellar_fb_api_key, "utf-8")).decode("utf-8")
-        if self.stellar_new_auth:
-            ts = self._get_epoch()
-            current_token = self.oauth.get('token', '')
-            current_exp = int(self.oauth.get('exp', 0))
-            if ts < current_exp and current_token:
-                pass
-            else:
-                path = '/connect/api/v1/access_token'
-                url = 'https://{}{}'.format(self.stellar_dp, path)
-                headers = {
-                    "Authorization": "Bearer {}".format(self.stellar_fb_api_key),
-                }
-                # r = self._request_post(headers=headers, path=path)
-                try:
-                    r = requests.post(url, verify=False, headers=headers, timeout=10)
-                    return_code = r.status_code
-                    if 200 <= r.status_code <= 299:
-                        response = r.json()
-                        current_token = response.get('access_token', '')
-                        current_exp = int(response.get('exp', 0))
-                        header_string = "Bearer {}".format(current_token)
-                        self.oauth = {"token": current_token, "expires": current_exp}
-                    else:
-                        response = r.text
-                        raise Exception("{}".format(response))
-                except Exception as e:
-                    self.l.error("Cannot get stellar access token (user api key): [{} {}]".format(return_code, e))
-        elif self.stellar_saas:
-            ts = self._get_epoch()
-            current_token = self.oauth.get('token', '')
-            current_exp = int(self.oauth.get('exp', 0))
-            if ts < current_exp and current_token:
-                pass
-            else:
-                path = '/connect/api/v1/access_token'
-                url = 'https://{}{}'.format(self.stellar_dp, path)
-                headers = {
-                    "Authorization": "Basic {}".format(auth),
-                    "Content-Type": "application/x-www-form-urlencoded",
-                }
-                # r = self._request_post(headers=headers, path=path)
-                try:
-                    r = requests.post(url, verify=False, headers=headers, timeout=10)
-                    return_code = r.status_code
-                    if 200 <= r.status_code <= 299:
-                        response = r.json()
-                        current_token = response.get('access_token', '')
-                        current_exp = int(response.get('exp', 0))
-                        header_string = "Bearer {}".format(current_token)
-                        self.oauth = {"token": current_token, "expires": current_exp}
-                    else:
-                        response = r.text
-                        raise Exception("{}".format(response))
-                except Exception as e:
-                    self.l.error("Cannot get stellar access token: [{} {}]".format(return_code, e))
+        if self.token_manager:
+            token = self.token_manager.get_token()
+            if token:
+                header_string = "Bearer {}".format(token)
         else:
-            header_string = "Basic {}".format(auth)
-
+            header_string = "Basic {}".format(self.basic_auth)
         return header_string
 
     def _request_get(self, path, headers=None, data=None):
         return_code = 500
         ret = {}
-        if not headers:
-            headers = self.headers
+        # copy so concurrent requests never share the Authorization entry
+        headers = dict(headers or self.headers)
         return_code = 0
         try:
-            url = 'https://{}{}'.format(self.stellar_dp, path)
-            headers['Authorization'] = self._get_auth_header()
-            if not headers['Authorization']:
-                raise Exception("Authorization failed")
-            r = requests.get(url, verify=False, headers=headers, data=data)
+            r = self._send('GET', path, headers=headers, data=data)
             return_code = r.status_code
             if 200 <= r.status_code <= 299:
                 ret = r.json()
@@ -1094,17 +1487,13 @@ class STELLAR_UTIL:
     def _request_post(self, path, data={}, headers=None):
         return_code = 500
         ret = None
-        if not headers:
-            headers = self.headers
+        # copy so concurrent requests never share the Authorization entry
+        headers = dict(headers or self.headers)
         try:
             if not self.stellar_fb_user or not self.stellar_fb_api_key:
                 raise Exception("Cannot perform POST request due to stellar user or api key not configured")
 
-            url = 'https://{}{}'.format(self.stellar_dp, path)
-            headers['Authorization'] = self._get_auth_header()
-            if not headers['Authorization']:
-                raise Exception("Authorization failed")
-            r = requests.post(url, verify=False, headers=headers, json=data)
+            r = self._send('POST', path, headers=headers, json=data)
             return_code = r.status_code
             if 200 <= r.status_code <= 299:
                 if r.text:
@@ -1121,17 +1510,13 @@ class STELLAR_UTIL:
     def _request_put(self, path, data={}, headers=None):
         return_code = 500
         ret = None
-        if not headers:
-            headers = self.headers
+        # copy so concurrent requests never share the Authorization entry
+        headers = dict(headers or self.headers)
         try:
             if not self.stellar_fb_user or not self.stellar_fb_api_key:
                 raise Exception("Cannot perform PUT request due to stellar user or api key not configured")
 
-            url = 'https://{}{}'.format(self.stellar_dp, path)
-            headers['Authorization'] = self._get_auth_header()
-            if not headers['Authorization']:
-                raise Exception("Authorization failed")
-            r = requests.put(url, verify=False, headers=headers, json=data)
+            r = self._send('PUT', path, headers=headers, json=data)
             return_code = r.status_code
             if 200 <= r.status_code <= 299:
                 ret = r.json()
@@ -1147,17 +1532,13 @@ class STELLAR_UTIL:
     def _request_patch(self, path, data={}, headers=None):
         return_code = 500
         ret = None
-        if not headers:
-            headers = self.headers
+        # copy so concurrent requests never share the Authorization entry
+        headers = dict(headers or self.headers)
         try:
             if not self.stellar_fb_user or not self.stellar_fb_api_key:
                 raise Exception("Cannot perform PATCH request due to stellar user or api key not configured")
 
-            url = 'https://{}{}'.format(self.stellar_dp, path)
-            headers['Authorization'] = self._get_auth_header()
-            if not headers['Authorization']:
-                raise Exception("Authorization failed")
-            r = requests.patch(url, verify=False, headers=headers, json=data)
+            r = self._send('PATCH', path, headers=headers, json=data)
             return_code = r.status_code
             if 200 <= r.status_code <= 299:
                 ret = r.json()
@@ -1173,17 +1554,13 @@ class STELLAR_UTIL:
     def _request_delete(self, path, data={}, headers=None):
         return_code = 500
         ret = None
-        if not headers:
-            headers = self.headers
+        # copy so concurrent requests never share the Authorization entry
+        headers = dict(headers or self.headers)
         try:
             if not self.stellar_fb_user or not self.stellar_fb_api_key:
                 raise Exception("Cannot perform DELETE request due to stellar user or api key not configured")
 
-            url = 'https://{}{}'.format(self.stellar_dp, path)
-            headers['Authorization'] = self._get_auth_header()
-            if not headers['Authorization']:
-                raise Exception("Authorization failed")
-            r = requests.delete(url, verify=False, headers=headers, json=data)
+            r = self._send('DELETE', path, headers=headers, json=data)
             return_code = r.status_code
             if 200 <= r.status_code <= 299:
                 ret = r.json()
@@ -1196,6 +1573,58 @@ class STELLAR_UTIL:
 
         return ret
 
+    def _send(self, method, path, headers, **kwargs):
+        '''
+        single transport for the _request_* helpers
+        429/5xx responses and connection resets are retried with jittered exponential backoff (Retry-After is honored)
+        POST is not idempotent - it is only retried on 429 and when the connection failed before the request was sent
+        read timeouts are not retried so a slow DP cannot multiply the cycle time
+        :return: requests response (the last one when retries are exhausted)
+        '''
+        url = 'https://{}{}'.format(self.stellar_dp, path)
+        attempt = 0
+        token_retried = False
+        while True:
+            headers['Authorization'] = self._get_auth_header()
+            if not headers['Authorization']:
+                raise Exception("Authorization failed")
+            try:
+                r = self.session.request(method, url, verify=self.verify_cert, headers=headers,
+                                         timeout=self.request_timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= self.max_retries or not (method in IDEMPOTENT_METHODS or is_connect_error(e)):
+                    raise
+                delay = self._get_retry_delay(attempt)
+                self.l.warning("{} connection error: [{}] [{}] - retry {} in {:.1f}s".format(method, path, e, attempt + 1, delay))
+            else:
+                if r.status_code == 401 and self.token_manager and not token_retried:
+                    # cached (or persisted) token was rejected - get a fresh one and try again
+                    self.l.warning("Access token rejected: [{}] - refreshing".format(path))
+                    self.token_manager.invalidate()
+                    token_retried = True
+                    continue
+                if not is_retry_status(method, r.status_code) or attempt >= self.max_retries:
+                    return r
+                delay = self._get_retry_delay(attempt, retry_after=r.headers.get('Retry-After'))
+                self.l.warning("{} returned [{}]: [{}] - retry {} in {:.1f}s".format(method, r.status_code, path, attempt + 1, delay))
+            attempt += 1
+            time.sleep(delay)
+
+    def _get_retry_delay(self, attempt, retry_after=None):
+        delay = 0
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = 0
+        if delay <= 0:
+            # full jitter
+            delay = random.uniform(0, self.retry_backoff * (2 ** attempt))
+        return min(max(delay, 0), self.retry_max_wait)
+
     def _get_scroll_query(self, scroll_id):
         ret_query = json.dumps(
             {
@@ -1233,14 +1662,524 @@ class STELLAR_UTIL:
             pass
         return ret
 
+class AsyncStellarUtil(STELLAR_UTIL):
+
+    def __init__(self, logger, config={}, optional_data_path=None, session=None):
+        """asyncio counterpart of STELLAR_UTIL for the operations used by the sync loop.
+
+        session -- aiohttp.ClientSession - can be shared with AsyncConnectWise so both use one connection pool
+        the retry / timeout / token settings are the same as STELLAR_UTIL
+        """
+        if aiohttp is None:
+            raise Exception("aiohttp is required for AsyncStellarUtil - see requirements.txt")
+        super().__init__(logger, config=config, optional_data_path=optional_data_path)
+        self.async_session = session
+        self.async_timeout = aiohttp.ClientTimeout(sock_connect=self.request_timeout[0],
+                                                   sock_read=self.request_timeout[1])
+        # False disables certificate verification, None is the aiohttp default
+        self.async_ssl = None if self.verify_cert else False
+
+    async def _async_send(self, method, path, headers, **kwargs):
+        ''' same retry behavior as STELLAR_UTIL._send - returns (status, text) '''
+        url = 'https://{}{}'.format(self.stellar_dp, path)
+        attempt = 0
+        token_retried = False
+        while True:
+            headers['Authorization'] = await self._async_get_auth_header()
+            if not headers['Authorization']:
+                raise Exception("Authorization failed")
+            try:
+                async with self.async_session.request(method, url, headers=headers, ssl=self.async_ssl,
+                                                      timeout=self.async_timeout, **kwargs) as r:
+                    status = r.status
+                    text = await r.text()
+                    retry_after = r.headers.get('Retry-After')
+            except aiohttp.ClientConnectionError as e:
+                # read timeouts are not retried (see STELLAR_UTIL._send)
+                if attempt >= self.max_retries or (isinstance(e, aiohttp.ServerTimeoutError) and
+                                                   not isinstance(e, aiohttp.ConnectionTimeoutError)):
+                    raise
+                if method not in IDEMPOTENT_METHODS and not is_connect_error(e):
+                    raise
+                delay = self._get_retry_delay(attempt)
+                self.l.warning("{} connection error: [{}] [{}] - retry {} in {:.1f}s".format(method, path, e, attempt + 1, delay))
+            else:
+                if status == 401 and self.token_manager and not token_retried:
+                    self.l.warning("Access token rejected: [{}] - refreshing".format(path))
+                    self.token_manager.invalidate()
+                    token_retried = True
+                    continue
+                if not is_retry_status(method, status) or attempt >= self.max_retries:
+                    return status, text
+                delay = self._get_retry_delay(attempt, retry_after=retry_after)
+                self.l.warning("{} returned [{}]: [{}] - retry {} in {:.1f}s".format(method, status, path, attempt + 1, delay))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _async_get_auth_header(self):
+        ''' a due token refresh is a blocking request - it runs in the executor so the event loop keeps going '''
+        if self.token_manager and not self.token_manager.is_fresh():
+            return await asyncio.get_running_loop().run_in_executor(None, self._get_auth_header)
+        return self._get_auth_header()
+
+    async def _async_request(self, method, path, data=None):
+        ''' mirrors the _request_* helpers: errors are logged, GET returns {} and the others None on failure '''
+        return_code = 0
+        ret = {} if method == 'GET' else None
+        headers = dict(self.headers)
+        try:
+            if method != 'GET' and (not self.stellar_fb_user or not self.stellar_fb_api_key):
+                raise Exception("Cannot perform {} request due to stellar user or api key not configured".format(method))
+            if method == 'GET':
+                return_code, text = await self._async_send(method, path, headers=headers, data=data)
+            else:
+                return_code, text = await self._async_send(method, path, headers=headers, json=data)
+            if 200 <= return_code <= 299:
+                if text:
+                    ret = json.loads(text)
+            else:
+                ret = {"data": {"error": text}}
+                raise Exception("{}".format(text))
+        except Exception as e:
+            self.l.error("Cannot perform {} request: [{} {}]".format(method, return_code, e))
+        return ret
+
+    async def get_stellar_cases(self, from_ts=0, tenant_id='', use_modified_at=False, ignore_case_tag=True,
+                                ignore_api_user_mods=False, status=None):
+        if not from_ts:
+            days_ago = 86400 * self.initial_run_lookback * 1000
+            from_ts = self._get_ts() - days_ago
+        try:
+            cases = [case async for case in self.iter_stellar_cases(
+                from_ts=from_ts, tenant_id=tenant_id, use_modified_at=use_modified_at, ignore_case_tag=ignore_case_tag,
+                ignore_api_user_mods=ignore_api_user_mods, status=status)]
+        except Exception as e:
+            self.l.error("Cannot get cases: [{}]".format(e))
+            return {}
+        return {'total': len(cases), 'cases': cases}
+
+    async def iter_stellar_cases(self, from_ts=0, tenant_id='', use_modified_at=False, ignore_case_tag=True,
+                                 ignore_api_user_mods=False, status=None):
+        ''' async generator version of STELLAR_UTIL.iter_stellar_cases '''
+        if not from_ts:
+            days_ago = 86400 * self.initial_run_lookback * 1000
+            from_ts = self._get_ts() - days_ago
+        path = self._make_cases_path(from_ts=from_ts, tenant_id=tenant_id, use_modified_at=use_modified_at,
+                                     ignore_case_tag=ignore_case_tag, ignore_api_user_mods=ignore_api_user_mods,
+                                     status=status)
+        self.l.info("Getting cases from ts: [{}]".format(from_ts))
+        seen_ids = set()
+        r = await self._async_get_cases_page(path, 0)
+        case_total = r.get('total', 0)
+        for case in self._drop_seen_cases(r.get('cases', []), seen_ids):
+            yield case
+        page_skips = iter(range(self.cases_page_size, case_total, self.cases_page_size))
+        pending = deque()
+        for skip in page_skips:
+            pending.append(asyncio.ensure_future(self._async_get_cases_page(path, skip)))
+            if len(pending) >= self.cases_page_workers:
+                break
+        try:
+            while pending:
+                r = await pending.popleft()
+                next_skip = next(page_skips, None)
+                if next_skip is not None:
+                    pending.append(asyncio.ensure_future(self._async_get_cases_page(path, next_skip)))
+                for case in self._drop_seen_cases(r.get('cases', []), seen_ids):
+                    yield case
+        finally:
+            for task in pending:
+                task.cancel()
+        if len(seen_ids) < case_total:
+            self.l.warning("Stellar case pages shifted while fetching: [{} of {}] - walking the pages again".format(len(seen_ids), case_total))
+            skip = 0
+            while True:
+                cases = (await self._async_get_cases_page(path, skip)).get('cases', [])
+                skip += len(cases)
+                for case in self._drop_seen_cases(cases, seen_ids):
+                    yield case
+                if len(cases) < self.cases_page_size:
+                    break
+        self.l.info("Retrieved case count: [{}]".format(len(seen_ids)))
+
+    async def _async_get_cases_page(self, path, skip):
+        r = await self._async_request('GET', "{}&limit={}&skip={}".format(path, self.cases_page_size, skip))
+        if 'cases' not in r.get('data', {}):
+            raise Exception("Cannot retrieve cases page: [skip: {}]".format(skip))
+        return r.get('data', {})
+
+    async def get_case_summary(self, case_id):
+        path = "/connect/api/v1/cases/{}/summary?formatted=true".format(case_id)
+        self.l.debug("Getting case summary: [{}]".format(case_id))
+        r = await self._async_request('GET', path)
+        return r.get('data', '')
+
+    async def get_case_alerts(self, case_id, return_only_alert_names=False):
+        self.l.info("Getting alerts associated with case: [{}]".format(case_id))
+        fields = CASE_ALERT_NAME_FIELDS if return_only_alert_names and self.case_alerts_projection else ''
+        alerts = []
+        doc_cnt = 0
+        async for doc in self._async_iter_case_alert_docs(case_id, fields=fields):
+            doc_cnt += 1
+            alert = self._make_case_alert(doc, return_only_alert_names)
+            if alert:
+                alerts.append(alert)
+        self.l.info("Retrieved alerts: [{}]".format(doc_cnt))
+        return alerts
+
+    async def _async_iter_case_alert_docs(self, case_id, fields=''):
+        ''' async generator version of STELLAR_UTIL._iter_case_alert_docs '''
+        path = "/connect/api/v1/cases/{}/alerts".format(case_id)
+        limit = self.case_alerts_page_size
+        while True:
+            r = await self._async_get_case_alerts_page(path, limit, 0, fields)
+            if r is not None:
+                break
+            if fields:
+                self.l.warning("Cannot retrieve projected alerts for case: [{}] - disabling projection".format(case_id))
+                self.case_alerts_projection = False
+                fields = ''
+            elif limit > 10:
+                limit = max(limit // 2, 10)
+                self.l.warning("Cannot retrieve alerts for case: [{}] - retrying with page size: [{}]".format(case_id, limit))
+            else:
+                raise Exception("Cannot retrieve alerts for case: [{}]".format(case_id))
+        docs = r.get('docs', [])
+        for doc in docs:
+            yield doc
+        if len(docs) < limit:
+            return
+        total = r.get('total')
+        if total is None:
+            skip = len(docs)
+            while True:
+                docs = (await self._async_get_next_case_alerts_page(case_id, path, limit, skip, fields)).get('docs', [])
+                skip += len(docs)
+                for doc in docs:
+                    yield doc
+                if len(docs) < limit:
+                    return
+        page_skips = iter(range(limit, total, limit))
+        pending = deque()
+        for skip in page_skips:
+            pending.append(asyncio.ensure_future(self._async_get_next_case_alerts_page(case_id, path, limit, skip, fields)))
+            if len(pending) >= self.case_alerts_page_workers:
+                break
+        try:
+            while pending:
+                r = await pending.popleft()
+                next_skip = next(page_skips, None)
+                if next_skip is not None:
+                    pending.append(asyncio.ensure_future(self._async_get_next_case_alerts_page(case_id, path, limit,
+                                                                                               next_skip, fields)))
+                for doc in r.get('docs', []):
+                    yield doc
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _async_get_next_case_alerts_page(self, case_id, path, limit, skip, fields=''):
+        r = await self._async_get_case_alerts_page(path, limit, skip, fields)
+        if r is None:
+            self.l.warning("Cannot retrieve alerts page for case: [{}] [skip: {}] - retrying".format(case_id, skip))
+            r = await self._async_get_case_alerts_page(path, limit, skip, fields)
+        if r is None:
+            raise Exception("Cannot retrieve alerts page for case: [{}] [skip: {}]".format(case_id, skip))
+        return r
+
+    async def _async_get_case_alerts_page(self, path, limit, skip, fields=''):
+        page_path = "{}?limit={}&skip={}".format(path, limit, skip)
+        if fields:
+            page_path += "&fields={}".format(fields)
+        r = await self._async_request('GET', page_path)
+        if not isinstance(r.get('data', {}).get('docs'), list):
+            return None
+        return r.get('data', {})
+
+    async def update_stellar_case(self, case_id, case_comment='', case_status=CASE_STATUS.In_Progress.value, update_tag=True):
+        if case_comment:
+            path = "/connect/api/v1/cases/{}/comments".format(case_id)
+            await self._async_request('POST', path, data={"comment": case_comment})
+        if case_status and case_status in [item.value for item in CASE_STATUS]:
+            path = "/connect/api/v1/cases/{}".format(case_id)
+            await self._async_request('PUT', path, data={"status": case_status})
+        if update_tag:
+            path = "/connect/api/v1/cases/{}".format(case_id)
+            await self._async_request('PUT', path, data={"tags": {"add": [self.stellar_case_tag]}})
+        return
+
+    async def resolve_stellar_case(self, case_id, update_alerts=True, resolution=None):
+        status_data = {"status": "Resolved"}
+        if update_alerts:
+            status_data['update_alerts'] = update_alerts
+        if resolution and resolution in ["False Positive", "Benign", "True Positive"]:
+            status_data['resolution'] = resolution
+        await self._async_request('PUT', "/connect/api/v1/cases/{}".format(case_id), data=status_data)
+        return
+
+    async def cancel_stellar_case(self, case_id, update_alerts=True):
+        status_data = {"status": "Cancelled"}
+        if update_alerts:
+            status_data['update_alerts'] = update_alerts
+        await self._async_request('PUT', "/connect/api/v1/cases/{}".format(case_id), data=status_data)
+        return
+
+    async def update_stellar_case_assignee(self, case_id, case_assignee=''):
+        path = "/connect/api/v1/cases/{}".format(case_id)
+        return await self._async_request('PUT', path, data={"assignee": "{}".format(case_assignee)})
+
+    async def add_case_comment(self, case_id, comment):
+        path = "/connect/api/v1/cases/{}/comments".format(case_id)
+        await self._async_request('POST', path, data={"comment": "{}".format(comment)})
+        return True
+
+
+class interflow_cache():
+
+    def __init__(self, max_size=1000, max_bytes=50000000, ttl=3600, spill_file_path='', spill_max_size=100000):
+        '''
+        thread safe LRU cache of interflow records keyed by (index, id) - records are kept as json so every get
+        returns a copy the caller can change
+        :param max_size: records kept in memory before the least recently used one is evicted
+        :param max_bytes: size of the json of the records kept in memory
+        :param ttl: seconds a record is valid (0 = until evicted)
+        :param spill_file_path: optional sqlite db that records evicted from memory are moved to
+        :param spill_max_size: records kept in the spill db - the oldest are deleted
+        '''
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_max_size = spill_max_size
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spill_con = None
+        self.spill_cnt = 0
+        if spill_file_path:
+            self.spill_con = sl.connect(spill_file_path, check_same_thread=False)
+            self.spill_con.execute('CREATE TABLE IF NOT EXISTS interflow (idx TEXT, id TEXT, doc TEXT, ts INTEGER, '
+                                   'PRIMARY KEY (idx, id));')
+            self.spill_con.execute('CREATE INDEX IF NOT EXISTS interflow_ts_idx ON interflow (ts);')
+            self.spill_con.commit()
+            self.spill_cnt = self.spill_con.execute('SELECT count(*) FROM interflow;').fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and self._is_valid(entry[2]):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(entry[0])
+            if entry:
+                self._remove(key)
+            if self.spill_con:
+                r = self.spill_con.execute('SELECT doc, ts FROM interflow WHERE idx = ? AND id = ?;', key).fetchone()
+                if r:
+                    self._unspill(key)
+                    if self._is_valid(r[1]):
+                        self.spill_hits += 1
+                        self._store(key, r[0], r[1])
+                        return json.loads(r[0])
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        doc = json.dumps(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self._store(key, doc, time.time())
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if self.spill_con:
+                self._unspill(key)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.spill_hits + self.misses
+            hit_rate = round((self.hits + self.spill_hits) / lookups, 3) if lookups else 0.0
+            return {"size": len(self.entries), "bytes": self.bytes, "hits": self.hits, "spill_hits": self.spill_hits,
+                    "misses": self.misses, "evictions": self.evictions, "spill_size": self.spill_cnt,
+                    "hit_rate": hit_rate}
+
+    def _is_valid(self, ts):
+        return not self.ttl or time.time() - ts < self.ttl
+
+    def _store(self, key, doc, ts):
+        # a record larger than the whole cache is not kept
+        if len(doc) > self.max_bytes:
+            return
+        self.entries[key] = (doc, len(doc), ts)
+        self.bytes += len(doc)
+        while len(self.entries) > self.max_size or self.bytes > self.max_bytes:
+            evicted_key, (evicted_doc, evicted_len, evicted_ts) = self.entries.popitem(last=False)
+            self.bytes -= evicted_len
+            self.evictions += 1
+            if self.spill_con:
+                self._spill(evicted_key, evicted_doc, evicted_ts)
+
+    def _remove(self, key):
+        doc, doc_len, ts = self.entries.pop(key)
+        self.bytes -= doc_len
+
+    def _spill(self, key, doc, ts):
+        cur = self.spill_con.execute('INSERT OR REPLACE INTO interflow (idx, id, doc, ts) VALUES (?, ?, ?, ?);',
+                                     (key[0], key[1], doc, ts))
+        self.spill_cnt += 1
+        # pruned in steps of 10% so the count is not rechecked on every spill
+        if self.spill_cnt > self.spill_max_size * 1.1:
+            self.spill_con.execute('DELETE FROM interflow WHERE rowid IN '
+                                   '(SELECT rowid FROM interflow ORDER BY ts LIMIT ?);',
+                                   (self.spill_cnt - self.spill_max_size,))
+            self.spill_cnt = self.spill_con.execute('SELECT count(*) FROM interflow;').fetchone()[0]
+        self.spill_con.commit()
+
+    def _unspill(self, key):
+        cur = self.spill_con.execute('DELETE FROM interflow WHERE idx = ? AND id = ?;', key)
+        self.spill_cnt -= cur.rowcount
+        self.spill_con.commit()
+
+
+class token_manager():
+
+    def __init__(self, logger, session, url, headers, verify_cert=False, timeout=10, refresh_margin=60,
+                 token_file_path='', key_id=''):
+        """Caches the stellar access token and refreshes it before it expires.
+
+        logger -- logger object
+        session -- requests session used for the token request
+        url -- access token endpoint
+        headers -- headers for the token request (basic or api key auth)
+        refresh_margin -- seconds before expiry that the token is considered stale
+        token_file_path -- optional file to keep the token across restarts
+        key_id -- credentials the token belongs to (only a hash is persisted, to ignore tokens of old keys)
+        """
+        self.l = logger
+        self.session = session
+        self.url = url
+        self.headers = headers
+        self.verify_cert = verify_cert
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.token_file_path = token_file_path
+        self.key_hash = hashlib.sha256(key_id.encode("utf-8")).hexdigest()
+        # (token, exp) - replaced as a whole so readers never see a mixed pair
+        self.token = ('', 0)
+        self.lock = threading.Lock()
+        self.timer = None
+        self.refresh_cnt = 0
+        if self.token_file_path:
+            self._load()
+
+    def is_fresh(self):
+        ''' True if get_token returns without a refresh '''
+        token, exp = self.token
+        return bool(token) and time.time() < exp - self.refresh_margin
+
+    def get_token(self):
+        token, exp = self.token
+        if token and time.time() < exp - self.refresh_margin:
+            return token
+        with self.lock:
+            # another caller may have refreshed while we waited
+            token, exp = self.token
+            if token and time.time() < exp - self.refresh_margin:
+                return token
+            return self._refresh()
+
+    def refresh(self):
+        with self.lock:
+            return self._refresh()
+
+    def invalidate(self):
+        with self.lock:
+            self.token = ('', 0)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+
+    def _refresh(self):
+        ''' must be called with the lock held - on failure the old token is returned while it is still valid '''
+        return_code = 0
+        token, exp = self.token
+        try:
+            r = self.session.post(self.url, verify=self.verify_cert, headers=self.headers, timeout=self.timeout)
+            return_code = r.status_code
+            if 200 <= r.status_code <= 299:
+                response = r.json()
+                token = response.get('access_token', '')
+                exp = int(response.get('exp', 0))
+                if exp > 100000000000:
+                    # milliseconds
+                    exp = exp / 1000
+                self.token = (token, exp)
+                self.refresh_cnt += 1
+                self.l.debug("Refreshed stellar access token [expires: {}]".format(exp))
+                self._save()
+                self._schedule_refresh()
+            else:
+                raise Exception("{}".format(r.text))
+        except Exception as e:
+            self.l.error("Cannot get stellar access token: [{} {}]".format(return_code, e))
+            if time.time() >= exp:
+                token = ''
+        return token
+
+    def _schedule_refresh(self):
+        token, exp = self.token
+        if self.timer:
+            self.timer.cancel()
+        delay = exp - self.refresh_margin - time.time()
+        if token and delay > 0:
+            self.timer = threading.Timer(delay, self.refresh)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _save(self):
+        if not self.token_file_path:
+            return
+        token, exp = self.token
+        try:
+            fd = os.open(self.token_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as fh:
+                json.dump({"token": token, "exp": exp, "key": self.key_hash}, fh)
+        except Exception as e:
+            self.l.warning("Cannot persist stellar access token: [{}]".format(e))
+
+    def _load(self):
+        try:
+            with open(self.token_file_path, "r") as fh:
+                saved = json.load(fh)
+        except Exception:
+            return
+        if saved.get('key') == self.key_hash and time.time() < saved.get('exp', 0) - self.refresh_margin:
+            self.token = (saved.get('token', ''), saved.get('exp', 0))
+            self.l.info("Using persisted stellar access token")
+            self._schedule_refresh()
+
+
 class local_db():
 
-    def __init__(self, dbname='stellar_sync.db', ticket_table_name='tickets', optional_db_dir=None):
+    def __init__(self, dbname='stellar_sync.db', ticket_table_name='tickets', optional_db_dir=None,
+                 journal_mode='WAL', synchronous='NORMAL', linkage_index=False, logger=None):
         """General Stellar SQLite Class for tracking case syncroniozation with remote ticketing systems.
 
         dbname -- name of the local db file
         ticket_table_name -- name of the ticket table within the local db
+        journal_mode -- sqlite journal mode (WAL, DELETE, ...)
+        synchronous -- sqlite synchronous setting (OFF, NORMAL, FULL)
+        linkage_index -- serve linkage lookups by case id / ticket id from memory (only if this is the only writer)
+        logger -- optional logger object for migration / linkage conflict messages
         """
+        self.l = logger
 
         # set default data directory to current directory
         path_to_data = "{}".format(os.path.dirname(os.path.realpath(sys.argv[0])))
@@ -1254,19 +2193,74 @@ class local_db():
         if not os.path.exists(path_to_data):
             raise Exception("Path to data does not exist: [{}]".format(path_to_data))
         db_path = "{}/{}".format(path_to_data, dbname)
-        self.con = sl.connect(db_path)
+        # shared by the sync worker threads - every statement runs under self.lock
+        self.con = sl.connect(db_path, check_same_thread=False)
+        self.lock = threading.RLock()
+        # open unit_of_work blocks - writes are only committed when the outermost one ends
+        self.uow_depth = 0
+        self.con.execute('PRAGMA journal_mode = {};'.format(journal_mode))
+        self.con.execute('PRAGMA synchronous = {};'.format(synchronous))
         self.ticket_table_name = ticket_table_name
+        self.cursor_table_name = "{}_cursors".format(ticket_table_name)
+        self.archive_table_name = "{}_archive".format(ticket_table_name)
         self._create_ticket_table()
+        self._create_cursor_table()
+        self._create_archive_table()
+        duplicate_cnt = self._migrate()
+        if duplicate_cnt and self.l:
+            self.l.warning("Moved duplicate linkages to [{}]: [{}]".format(self.archive_table_name, duplicate_cnt))
+        # case id -> linkage and ticket id -> case id, kept up to date by the write methods (None = disabled)
+        self.linkage_index = None
+        self.ticket_index = None
+        if linkage_index:
+            self._load_linkage_index()
 
     def checktable(self):
         """ does the default table exist ? """
         # sql = 'select exists(select 1 from sqlite_master where type="table" and name="remote_ticket");'
-        sql = 'select name from sqlite_master where type="table";'
+        sql = "select name from sqlite_master where type='table';"
         # sql = '.tables;'
-        with self.con:
-            cur = self.con.cursor()
-            r = cur.execute(sql).fetchall()
-            print(r)
+        r = self._read(sql)
+        print(r)
+
+    @contextmanager
+    def unit_of_work(self):
+        '''
+        the writes made inside the block (from any thread) are committed together when it ends - one disk sync
+        instead of one per statement. nested blocks join the outermost one. the writes are committed even if the
+        block raises, as they record changes that have already been made on the remote systems
+        '''
+        with self.lock:
+            self.uow_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.uow_depth -= 1
+                if not self.uow_depth:
+                    self.con.commit()
+
+    def _read(self, sql, params=()):
+        ''' :return: all rows - fetched under the lock as the connection is shared '''
+        with self.lock:
+            return self.con.execute(sql, params).fetchall()
+
+    def _read_one(self, sql, params=()):
+        rows = self._read(sql, params)
+        return rows[0] if rows else None
+
+    def _write(self, sql, params=(), commit=False):
+        ''' commits right away unless a unit of work is open (or commit is forced) '''
+        with self.lock:
+            try:
+                cur = self.con.execute(sql, params)
+            except Exception:
+                if not self.uow_depth:
+                    self.con.rollback()
+                raise
+            if commit or not self.uow_depth:
+                self.con.commit()
+            return cur
 
     def put_ticket_linkage(self, stellar_case_id, stellar_case_number, remote_ticket_id, stellar_tenant_id='',
                            stellar_last_modified=None, remote_ticket_last_modified=None, state="new"):
@@ -1276,21 +2270,33 @@ class local_db():
         if not remote_ticket_last_modified:
             remote_ticket_last_modified = ts
 
-        sql = """INSERT INTO {0}
-        (stellar_case_id, stellar_case_number, remote_ticket_id, stellar_tenant_id, stellar_last_modified, remote_ticket_last_modified, state, ts)
-        VALUES("{1}", {2}, "{3}", "{4}", {5}, {6}, "{7}", {8});""".format(
-            self.ticket_table_name,
-            stellar_case_id,
-            stellar_case_number,
-            remote_ticket_id,
-            stellar_tenant_id,
-            stellar_last_modified,
-            remote_ticket_last_modified,
-            state,
-            ts)
-        with self.con:
-            cur = self.con.cursor()
-            r = cur.execute(sql)
+        remote_ticket_id = self._to_ticket_id(remote_ticket_id)
+        with self.lock:
+            # the ticket id is unique as well - a ticket linked to another case means the local db is inconsistent,
+            # the write is refused so the other case keeps its linkage (and does not get a second ticket)
+            r = self._read_one('SELECT stellar_case_id FROM {} WHERE remote_ticket_id = ? AND stellar_case_id != ?;'.format(
+                self.ticket_table_name), (remote_ticket_id, stellar_case_id))
+            if r:
+                raise Exception("Ticket [{}] is already linked to case [{}] - not linking it to case [{}]".format(
+                    remote_ticket_id, r[0], stellar_case_id))
+            self._upsert_ticket_linkage(stellar_case_id, stellar_case_number, remote_ticket_id, stellar_tenant_id,
+                                        stellar_last_modified, remote_ticket_last_modified, state, ts)
+
+    def _upsert_ticket_linkage(self, stellar_case_id, stellar_case_number, remote_ticket_id, stellar_tenant_id,
+                               stellar_last_modified, remote_ticket_last_modified, state, ts):
+        # a retry for the same case replaces its linkage instead of adding a second one
+        sql = 'INSERT INTO {} (stellar_case_id, stellar_case_number, remote_ticket_id, stellar_tenant_id, ' \
+              'stellar_last_modified, remote_ticket_last_modified, state, ts) ' \
+              'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ' \
+              'ON CONFLICT (stellar_case_id) DO UPDATE SET stellar_case_number = excluded.stellar_case_number, ' \
+              'remote_ticket_id = excluded.remote_ticket_id, stellar_tenant_id = excluded.stellar_tenant_id, ' \
+              'stellar_last_modified = excluded.stellar_last_modified, ' \
+              'remote_ticket_last_modified = excluded.remote_ticket_last_modified, ' \
+              'state = excluded.state, ts = excluded.ts;'.format(self.ticket_table_name)
+        # committed right away even inside a unit of work - losing it would mean a duplicate ticket
+        self._write(sql, (stellar_case_id, stellar_case_number, remote_ticket_id, stellar_tenant_id,
+                          stellar_last_modified, remote_ticket_last_modified, state, ts), commit=True)
+        self._index_linkage((stellar_case_id, stellar_case_number, remote_ticket_id, remote_ticket_last_modified, state))
 
     def get_ticket_linkage(self, stellar_case_id=None, stellar_case_number=None, remote_ticket_id=None):
         ret = {}
@@ -1304,76 +2310,302 @@ class local_db():
             field_val = stellar_case_number
         elif remote_ticket_id:
             field = "remote_ticket_id"
-            field_val = remote_ticket_id
+            field_val = str(remote_ticket_id)
+        if field and field != "stellar_case_number" and self.linkage_index is not None:
+            with self.lock:
+                return dict(self._get_indexed_linkage(field, field_val) or {})
         if field:
             sql = 'SELECT stellar_case_id, stellar_case_number, remote_ticket_id, remote_ticket_last_modified, state ' \
-                  'FROM {} WHERE {} = "{}";'.format(self.ticket_table_name, field, field_val)
-            with self.con:
-                cur = self.con.cursor()
-                r = cur.execute(sql).fetchone()
-                if r:
-                    stellar_case_id = r[0]
-                    stellar_case_number = r[1]
-                    remote_ticket_id = r[2]
-                    remote_ticket_last_modifed = r[3]
-                    state = r[4]
-                    ret = {"stellar_case_id": stellar_case_id,
-                           "stellar_case_number": stellar_case_number,
-                           "remote_ticket_id": remote_ticket_id,
-                           "remote_ticket_last_modified": remote_ticket_last_modifed,
-                           "state": state}
+                  'FROM {} WHERE {} = ?;'.format(self.ticket_table_name, field)
+            if field == "remote_ticket_id":
+                field_val = self._to_ticket_id(field_val)
+            r = self._read_one(sql, (field_val,))
+            if r:
+                ret = self._make_linkage(r)
+        return ret
+
+    def get_ticket_linkages(self, stellar_case_ids=None, remote_ticket_ids=None):
+        '''
+        batch version of get_ticket_linkage - one query per 500 ids
+        :return: linkages keyed by str(stellar case id) or str(remote ticket id) - ids without a linkage are left out
+        '''
+        ret = {}
+        field = "stellar_case_id" if stellar_case_ids is not None else "remote_ticket_id"
+        ids = [str(i) for i in (stellar_case_ids if stellar_case_ids is not None else remote_ticket_ids or [])]
+        if self.linkage_index is not None:
+            with self.lock:
+                for field_val in ids:
+                    linkage = self._get_indexed_linkage(field, field_val)
+                    if linkage:
+                        ret[field_val] = dict(linkage)
+            return ret
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            if field == "remote_ticket_id":
+                chunk = [self._to_ticket_id(ticket_id) for ticket_id in chunk]
+            sql = 'SELECT stellar_case_id, stellar_case_number, remote_ticket_id, remote_ticket_last_modified, state ' \
+                  'FROM {} WHERE {} IN ({}) ORDER BY rowid;'.format(self.ticket_table_name, field, ','.join('?' * len(chunk)))
+            records = self._read(sql, chunk)
+            for r in records:
+                linkage = self._make_linkage(r)
+                ret[str(linkage[field])] = linkage
+        return ret
+
+    def get_archived_case_ids(self, stellar_case_ids):
+        '''
+        the case ids that only have an archived linkage (see archive_closed_linkages) - one query per 500 ids
+        :return: set of str(stellar case id)
+        '''
+        ret = set()
+        ids = [str(i) for i in stellar_case_ids]
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            sql = 'SELECT DISTINCT stellar_case_id FROM {} WHERE stellar_case_id IN ({});'.format(
+                self.archive_table_name, ','.join('?' * len(chunk)))
+            ret.update(str(r[0]) for r in self._read(sql, chunk))
         return ret
 
+    def _to_ticket_id(self, remote_ticket_id):
+        ''' ticket ids are stored as integers (ids that are not numeric are kept as they are) '''
+        if str(remote_ticket_id).isdigit():
+            return int(remote_ticket_id)
+        return remote_ticket_id
+
+    def _make_linkage(self, r):
+        ''' r: stellar_case_id, stellar_case_number, remote_ticket_id, remote_ticket_last_modified, state '''
+        return {"stellar_case_id": r[0],
+                "stellar_case_number": r[1],
+                "remote_ticket_id": r[2],
+                "remote_ticket_last_modified": r[3],
+                "state": r[4]}
+
+    def _load_linkage_index(self):
+        sql = 'SELECT stellar_case_id, stellar_case_number, remote_ticket_id, remote_ticket_last_modified, state ' \
+              'FROM {} ORDER BY rowid;'.format(self.ticket_table_name)
+        with self.lock:
+            self.linkage_index = {}
+            self.ticket_index = {}
+            for r in self._read(sql):
+                self._index_linkage(r)
+
+    def _index_linkage(self, r):
+        if self.linkage_index is None:
+            return
+        with self.lock:
+            linkage = self._make_linkage(r)
+            old_linkage = self.linkage_index.get(linkage['stellar_case_id'])
+            if old_linkage:
+                self.ticket_index.pop(str(old_linkage['remote_ticket_id']), None)
+            self.linkage_index[linkage['stellar_case_id']] = linkage
+            self.ticket_index[str(linkage['remote_ticket_id'])] = linkage['stellar_case_id']
+
+    def _unindex_linkage(self, stellar_case_id):
+        if self.linkage_index is None:
+            return
+        with self.lock:
+            linkage = self.linkage_index.pop(stellar_case_id, None)
+            if linkage:
+                self.ticket_index.pop(str(linkage['remote_ticket_id']), None)
+
+    def _update_indexed_linkage(self, stellar_case_id, **changes):
+        if self.linkage_index is None:
+            return
+        with self.lock:
+            linkage = self.linkage_index.get(stellar_case_id)
+            if linkage:
+                linkage.update(changes)
+
+    def _get_indexed_linkage(self, field, field_val):
+        if field == "stellar_case_id":
+            return self.linkage_index.get(field_val)
+        return self.linkage_index.get(self.ticket_index.get(field_val))
+
     def get_open_tickets(self):
         ret = []
         sql = 'SELECT stellar_case_id, stellar_case_number, remote_ticket_id, state, remote_ticket_last_modified, stellar_last_modified ' \
-              'FROM {} WHERE state != "closed" ORDER BY ts asc;'.format(self.ticket_table_name)
-        with self.con:
-            cur = self.con.cursor()
-            records = cur.execute(sql).fetchall()
-            if records:
-                for r in records:
-                    stellar_case_id = r[0]
-                    stellar_case_number = r[1]
-                    remote_ticket_id = r[2]
-                    state = r[3]
-                    remote_ticket_last_modified = r[4]
-                    stellar_last_modified = r[5]
-                    ret.append({"stellar_case_id": stellar_case_id, "stellar_case_number": stellar_case_number,
-                                "remote_ticket_id": remote_ticket_id, "state": state,
-                                "remote_ticket_last_modified": remote_ticket_last_modified,
-                                "stellar_last_modified": stellar_last_modified})
+              'FROM {} WHERE state != ? ORDER BY ts asc;'.format(self.ticket_table_name)
+        records = self._read(sql, ("closed",))
+        if records:
+            for r in records:
+                stellar_case_id = r[0]
+                stellar_case_number = r[1]
+                remote_ticket_id = r[2]
+                state = r[3]
+                remote_ticket_last_modified = r[4]
+                stellar_last_modified = r[5]
+                ret.append({"stellar_case_id": stellar_case_id, "stellar_case_number": stellar_case_number,
+                            "remote_ticket_id": remote_ticket_id, "state": state,
+                            "remote_ticket_last_modified": remote_ticket_last_modified,
+                            "stellar_last_modified": stellar_last_modified})
         return ret
 
     def close_ticket_linkage(self, stellar_case_id):
         ts = int(time.time()) * 1000
-        sql = 'UPDATE {} SET state = "closed", ts = {} WHERE stellar_case_id = "{}"'.format(self.ticket_table_name, ts,
-                                                                                            stellar_case_id)
-        with self.con:
-            cur = self.con.cursor()
-            r = cur.execute(sql)
+        sql = 'UPDATE {} SET state = ?, ts = ? WHERE stellar_case_id = ?;'.format(self.ticket_table_name)
+        self._write(sql, ("closed", ts, stellar_case_id))
+        self._update_indexed_linkage(stellar_case_id, state="closed")
 
     def reopen_ticket_linkage(self, stellar_case_id):
         ts = int(time.time()) * 1000
-        sql = 'UPDATE {} SET state = "reopen", ts = {} WHERE stellar_case_id = "{}"'.format(self.ticket_table_name, ts,
-                                                                                            stellar_case_id)
-        with self.con:
-            cur = self.con.cursor()
-            r = cur.execute(sql)
+        sql = 'UPDATE {} SET state = ?, ts = ? WHERE stellar_case_id = ?;'.format(self.ticket_table_name)
+        self._write(sql, ("reopen", ts, stellar_case_id))
+        self._update_indexed_linkage(stellar_case_id, state="reopen")
 
     def update_remote_ticket_timestamp(self, stellar_case_id, rt_ticket_ts=None, state=None):
         ts = int(time.time()) * 1000
         if not rt_ticket_ts:
             rt_ticket_ts = ts
-        sql = 'UPDATE {} SET remote_ticket_last_modified = {}, ts = {}'.format(self.ticket_table_name, rt_ticket_ts, ts)
+        sql = 'UPDATE {} SET remote_ticket_last_modified = ?, ts = ?'.format(self.ticket_table_name)
+        params = [rt_ticket_ts, ts]
+        if state:
+            sql += ', state = ?'
+            params.append(state)
+        sql += ' WHERE stellar_case_id = ?;'
+        params.append(stellar_case_id)
+        self._write(sql, params)
         if state:
-            sql += ', state="{}"'.format(state)
-        sql += ' WHERE stellar_case_id = "{}"'.format(stellar_case_id)
-        with self.con:
+            self._update_indexed_linkage(stellar_case_id, remote_ticket_last_modified=rt_ticket_ts, state=state)
+        else:
+            self._update_indexed_linkage(stellar_case_id, remote_ticket_last_modified=rt_ticket_ts)
+
+    def archive_closed_linkages(self, older_than_days):
+        '''
+        moves linkages closed more than older_than_days ago (and their sync cursors) out of the ticket table
+        :return: number of archived linkages
+        '''
+        ts = int(time.time()) * 1000
+        cutoff_ts = ts - int(older_than_days * 86400 * 1000)
+        columns = 'stellar_case_id, stellar_case_number, stellar_tenant_id, stellar_last_modified, ' \
+                  'remote_ticket_id, remote_ticket_last_modified, state, ts'
+        with self.lock:
+            records = self._read('SELECT stellar_case_id, remote_ticket_id FROM {} WHERE state = ? AND ts < ?;'.format(
+                self.ticket_table_name), ("closed", cutoff_ts))
+            if not records:
+                return 0
+            self._write('INSERT INTO {0} ({1}, archived_ts) SELECT {1}, ? FROM {2} WHERE state = ? AND ts < ?;'.format(
+                self.archive_table_name, columns, self.ticket_table_name), (ts, "closed", cutoff_ts))
+            self._write('DELETE FROM {} WHERE state = ? AND ts < ?;'.format(self.ticket_table_name), ("closed", cutoff_ts))
+            for (stellar_case_id, remote_ticket_id) in records:
+                self._write('DELETE FROM {} WHERE remote_ticket_id = ?;'.format(self.cursor_table_name), (str(remote_ticket_id),))
+                self._unindex_linkage(stellar_case_id)
+            if not self.uow_depth:
+                self.con.commit()
+        return len(records)
+
+    def get_sync_cursor(self, remote_ticket_id, cursor_type):
+        '''
+        position of an incremental remote ticket sync (e.g. audit records)
+        :return: {"ts": epoch ms, "keys": [ids already seen at ts]} or None if there is no cursor yet
+        '''
+        ret = None
+        sql = 'SELECT cursor_ts, cursor_keys FROM {} WHERE remote_ticket_id = ? AND cursor_type = ?;'.format(self.cursor_table_name)
+        r = self._read_one(sql, (str(remote_ticket_id), cursor_type))
+        if r:
+            ret = {"ts": r[0], "keys": json.loads(r[1] or '[]')}
+        return ret
+
+    def put_sync_cursor(self, remote_ticket_id, cursor_type, cursor):
+        ts = int(time.time()) * 1000
+        sql = 'INSERT OR REPLACE INTO {} (remote_ticket_id, cursor_type, cursor_ts, cursor_keys, ts) ' \
+              'VALUES (?, ?, ?, ?, ?);'.format(self.cursor_table_name)
+        self._write(sql, (str(remote_ticket_id), cursor_type, cursor.get('ts', 0), json.dumps(cursor.get('keys', [])), ts))
+
+    def _migrate(self):
+        '''
+        brings an existing ticket table up to date - the schema_version table holds its version
+        :return: number of duplicate linkages moved to the archive table
+        '''
+        duplicate_cnt = 0
+        with self.lock, self.con:
+            cur = self.con.cursor()
+            # explicit transaction - sqlite3 does not open one for DDL, so a crash mid-rebuild would leave half of it
+            cur.execute('BEGIN;')
+            cur.execute('CREATE TABLE IF NOT EXISTS schema_version (table_name TEXT PRIMARY KEY, version INTEGER);')
+            r = cur.execute('SELECT version FROM schema_version WHERE table_name = ?;', (self.ticket_table_name,)).fetchone()
+            version = r[0] if r else 0
+            if version < 1:
+                # indexes for the linkage lookups done for every CW ticket / stellar case
+                for column in ["stellar_case_id", "remote_ticket_id", "state"]:
+                    cur.execute('CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {0} ({1});'.format(self.ticket_table_name, column))
+                version = 1
+            if version < 2:
+                duplicate_cnt = self._migrate_unique_ids(cur)
+                version = 2
+            cur.execute('INSERT OR REPLACE INTO schema_version (table_name, version) VALUES (?, ?);',
+                        (self.ticket_table_name, version))
+        return duplicate_cnt
+
+    def _migrate_unique_ids(self, cur):
+        '''
+        schema 2: one row per case id / ticket id and integer ticket ids - the table is rebuilt, the first row for
+        a case / ticket is kept (the one the lookups returned) and later duplicates are moved to the archive table
+        :return: number of duplicates moved
+        '''
+        columns = 'stellar_case_id, stellar_case_number, stellar_tenant_id, stellar_last_modified, ' \
+                  'remote_ticket_id, remote_ticket_last_modified, state, ts'
+        new_table_name = "{}_v2".format(self.ticket_table_name)
+        # left over by databases rebuilt before the migration ran in a single transaction
+        cur.execute('DROP TABLE IF EXISTS {};'.format(new_table_name))
+        cur.execute("""CREATE TABLE {} (
+            stellar_case_id TEXT NOT NULL UNIQUE,
+            stellar_case_number INTEGER,
+            stellar_tenant_id TEXT,
+            stellar_last_modified INTEGER,
+            remote_ticket_id INTEGER UNIQUE,
+            remote_ticket_last_modified INTEGER,
+            state TEXT,
+            ts INTEGER);""".format(new_table_name))
+        archived_ts = int(time.time()) * 1000
+        duplicate_cnt = 0
+        for r in cur.execute('SELECT {} FROM {} ORDER BY rowid;'.format(columns, self.ticket_table_name)).fetchall():
+            r = list(r)
+            r[4] = self._to_ticket_id(r[4])
+            try:
+                cur.execute('INSERT INTO {} ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?);'.format(new_table_name, columns), r)
+            except sl.IntegrityError:
+                cur.execute('INSERT INTO {} ({}, archived_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);'.format(
+                    self.archive_table_name, columns), r + [archived_ts])
+                duplicate_cnt += 1
+        cur.execute('DROP TABLE {};'.format(self.ticket_table_name))
+        cur.execute('ALTER TABLE {} RENAME TO {};'.format(new_table_name, self.ticket_table_name))
+        # case id / ticket id are covered by their unique indexes
+        cur.execute('CREATE INDEX IF NOT EXISTS {0}_state_idx ON {0} (state);'.format(self.ticket_table_name))
+        return duplicate_cnt
+
+    def _create_archive_table(self):
+        sql = """CREATE TABLE IF NOT EXISTS {} (
+            stellar_case_id TEXT,
+            stellar_case_number INTEGER,
+            stellar_tenant_id TEXT,
+            stellar_last_modified INTEGER,
+            remote_ticket_id INTEGER,
+            remote_ticket_last_modified INTEGER,
+            state TEXT,
+            ts INTEGER,
+            archived_ts INTEGER);
+            """.format(self.archive_table_name)
+        with self.lock, self.con:
+            cur = self.con.cursor()
+            r = cur.execute(sql)
+            # new cases are checked against the archive too (get_archived_case_ids)
+            cur.execute('CREATE INDEX IF NOT EXISTS {0}_stellar_case_id_idx ON {0} (stellar_case_id);'.format(
+                self.archive_table_name))
+
+    def _create_cursor_table(self):
+        sql = """CREATE TABLE IF NOT EXISTS {} (
+            remote_ticket_id TEXT,
+            cursor_type TEXT,
+            cursor_ts INTEGER,
+            cursor_keys TEXT,
+            ts INTEGER,
+            PRIMARY KEY (remote_ticket_id, cursor_type));
+            """.format(self.cursor_table_name)
+        with self.lock, self.con:
             cur = self.con.cursor()
             r = cur.execute(sql)
 
     def _create_ticket_table(self):
+        # schema 0 - _migrate brings new and existing tables to the current schema
         sql = """CREATE TABLE IF NOT EXISTS {} (
 	        stellar_case_id TEXT,
 	        stellar_case_number INTEGER,
@@ -1384,6 +2616,6 @@ class local_db():
 	        state TEXT,
 	        ts INTEGER);
             """.format(self.ticket_table_name)
-        with self.con:
+        with self.lock, self.con:
             cur = self.con.cursor()
             r = cur.execute(sql)
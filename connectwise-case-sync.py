@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 '''
-	version:		20251208.000
+	version:		20261017.019
 	description:	connectwise integration script used to create Manage Service Tickets
 
     20251201.000    forked branch for improved efficiency and updated syncs
@@ -14,17 +14,45 @@
                     added forced update for ownership
                     improved tracking for stellar cases
     20251208.000    improved case closure sync
+    20261017.000    log CW connection pool reuse each loop
+    20261017.001    optional worker pool for the CW ticket sync pass (cw_sync_workers)
+    20261017.002    new stellar cases split into prefetch / create / write back stages with an optional concurrent pipeline
+    20261017.003    added --async mode - the whole cycle runs on asyncio with one shared connection pool
+    20261017.004    CW member email cache stats / persistence each loop
+    20261017.005    audit records are fetched once per ticket per cycle
+    20261017.006    optional incremental audit record retrieval using a per-ticket cursor (cw_incremental_audit)
+    20261017.007    optional incremental note retrieval using a per-ticket cursor (cw_incremental_notes)
+    20261017.008    log CW projected payload bytes each loop
+    20261017.009    CW tickets and stellar cases are processed as their pages arrive (iter_tickets / iter_stellar_cases)
+    20261017.010    optional CW polling of only the tickets with an open linkage (cw_poll_tracked_only)
+    20261017.011    linkages are looked up in batches (ldb_batch_size) instead of once per ticket / case
+    20261017.012    the CW pass's local db writes are committed in one transaction - journal mode / synchronous configurable
+    20261017.013    linkage lookups are served from the local db's in-memory index (ldb_linkage_index)
+    20261017.014    closed linkages older than ldb_archive_closed_days are moved to the archive table each loop
+    20261017.015    log stellar interflow cache stats each loop
+    20261017.016    the ticket sync, new case stages and cycle are shared by both modes - --async runs the local db /
+                    checkpoint calls in the executor and closes its session on exit
+    20261017.017    cases with an archived linkage are not treated as new cases
+    20261017.018    a ticket's cached audit records are released once the ticket is synced
+    20261017.019    the CW pass's local db writes are committed per ldb_batch_size tickets instead of once per pass
 
 '''
 
 import argparse
 import yaml
-from ConnectWise import ConnectWise
+from ConnectWise import ConnectWise, AsyncConnectWise
 import STELLAR_UTIL
 from LOGGER_UTIL import logger_util
 from time import time, sleep
 import os, traceback
 import json
+import asyncio
+import functools
+import inspect
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-l', '--log-file', help='Write stdout to logfile', dest='logfile', default='')
@@ -35,6 +63,8 @@ parser.add_argument('-p', '--persistent-volume',
                     help='Path to persistent volume that contains the in-sync database and checkpoint timestamp files. \
                      If empty, then current directory is used and if not prepended with "/", relative paths are assumed. \
                      (NOTE: db and checkpoint files are created automatically) ', dest='data_volume', default='')
+parser.add_argument('-a', '--async', help='Run each sync cycle on asyncio (requires aiohttp)', dest='async_mode',
+                    action='store_true')
 args = parser.parse_args()
 l = logger_util(args)
 
@@ -68,8 +98,473 @@ def get_env():
     return env_config
 
 
+async def call(func, *args, **kwargs):
+    ''' calls a CW / stellar client method - the async clients return a coroutine, which is awaited '''
+    r = func(*args, **kwargs)
+    if inspect.isawaitable(r):
+        r = await r
+    return r
+
+
+async def call_blocking(func, *func_args, **func_kwargs):
+    ''' local db / checkpoint file access - runs in the default executor with --async so the event loop is not blocked '''
+    if args.async_mode:
+        return await asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *func_args, **func_kwargs))
+    return func(*func_args, **func_kwargs)
+
+
+async def call_all(*coros):
+    ''' awaits independent calls - concurrently with --async, one after another otherwise '''
+    if args.async_mode:
+        return await asyncio.gather(*coros)
+    return [await coro for coro in coros]
+
+
+def run_sync(func, *args, **kwargs):
+    '''
+    runs one of the shared coroutines below to completion without an event loop - with the sync clients nothing
+    in them is awaited for real, so the coroutine finishes on the first send
+    '''
+    coro = func(*args, **kwargs)
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("{} suspended outside of an event loop".format(func.__name__))
+
+
+def get_note_cursor(rt_ticket_number, rt_ticket_last_modified):
+    ''' a ticket without a stored cursor starts from its last sync - older notes are never pushed anyway '''
+    note_cursor = LDB.get_sync_cursor(remote_ticket_id=rt_ticket_number, cursor_type='notes')
+    if not note_cursor and rt_ticket_last_modified:
+        note_cursor = {"ts": rt_ticket_last_modified, "keys": []}
+    return note_cursor
+
+
+def put_note_cursor(rt_ticket_number, cw_ticket_notes, note_cursor):
+    new_note_cursor = CW.get_note_cursor(cw_ticket_notes, note_cursor)
+    if new_note_cursor and new_note_cursor != note_cursor:
+        LDB.put_sync_cursor(remote_ticket_id=rt_ticket_number, cursor_type='notes', cursor=new_note_cursor)
+
+
+def get_tracked_tickets():
+    ''' open linkages keyed by CW ticket id - None unless CW polling is limited to tracked tickets '''
+    if not CW_POLL_TRACKED_ONLY:
+        return None
+    return {str(t.get('remote_ticket_id')): t for t in LDB.get_open_tickets()}
+
+
+def get_open_ticket(cw_ticket_number, linkages=None):
+    if linkages is not None:
+        return linkages.get(str(cw_ticket_number), {})
+    return LDB.get_ticket_linkage(remote_ticket_id=cw_ticket_number)
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def aiter_batches(items, batch_size):
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_batch_linkages(cw_tickets, tracked_tickets=None):
+    ''' linkages for a batch of CW tickets in one local db query (the tracked tickets already are) '''
+    if tracked_tickets is not None:
+        return tracked_tickets
+    return LDB.get_ticket_linkages(remote_ticket_ids=[cw_ticket.get('id') for cw_ticket in cw_tickets])
+
+
+async def aiter_items(items):
+    for item in items:
+        yield item
+
+
+def get_unlinked_cases(cases):
+    ''' the cases in a batch that have no ticket yet - archived (closed) linkages count, so a reopened case is not ticketed again '''
+    stellar_case_ids = [case.get("_id") for case in cases]
+    linkages = LDB.get_ticket_linkages(stellar_case_ids=stellar_case_ids)
+    unlinked_ids = [case_id for case_id in stellar_case_ids if str(case_id) not in linkages]
+    archived_ids = LDB.get_archived_case_ids(unlinked_ids) if unlinked_ids else set()
+    return [case for case in cases if str(case.get("_id")) not in linkages and str(case.get("_id")) not in archived_ids]
+
+
+def iter_new_cases(cases):
+    for batch in iter_batches(cases, LDB_BATCH_SIZE):
+        for case in get_unlinked_cases(batch):
+            yield case
+
+
+async def aiter_new_cases(cases):
+    async for batch in aiter_batches(cases, LDB_BATCH_SIZE):
+        for case in await call_blocking(get_unlinked_cases, batch):
+            yield case
+
+
+async def sync_cw_ticket(cw_ticket, linkages=None):
+    '''
+    sync a single modified CW ticket to its linked stellar case - shared by both modes (see run_sync)
+    the calls run one after another so the ticket's stellar updates stay in order
+    '''
+    cw_ticket_number = cw_ticket.get('id', '')
+    cw_ticket_updated_str = cw_ticket.get('_info', {}).get('lastUpdated', '1970-01-01T00:00:00T')
+    cw_ticket_updated_ts = CW.datestring_to_epoch(cw_ticket_updated_str)
+    open_ticket = await call_blocking(get_open_ticket, cw_ticket_number, linkages)
+    if not open_ticket or open_ticket.get('state', '') == 'closed':
+        return
+    rt_ticket_number = cw_ticket_number
+    rt_ticket_last_modified = open_ticket.get('remote_ticket_last_modified', '')
+    stellar_case_id = open_ticket.get('stellar_case_id', '')
+    if cw_ticket_updated_ts <= rt_ticket_last_modified:
+        return
+    l.info("CW ticket has been modified since last sync: [{}] [ticket updated: {}] [last sync: {}]".format(rt_ticket_number, cw_ticket_updated_str, rt_ticket_last_modified))
+    audit_cursor = None
+    if CW_INCREMENTAL_AUDIT:
+        audit_cursor = await call_blocking(LDB.get_sync_cursor, remote_ticket_id=rt_ticket_number, cursor_type='audit')
+
+    ''' check on ticket resolution '''
+    if CW_SYNC_STATUS:
+        cw_status = cw_ticket.get('status', {}).get('name', '')
+        if cw_status in CW_SYNC_STATUS_MAP:
+            stellar_status = CW_SYNC_STATUS_MAP.get(cw_status, '')
+        else:
+            stellar_status = CW_SYNC_STATUS_MAP.get('default', '')
+        if stellar_status.lower() in ["resolved"]:
+            l.info("CW ticket in state [{} {}] | resolving related stellar case: [{}] [{}]".format(rt_ticket_number, cw_status, stellar_case_id, stellar_status))
+            await call(SU.resolve_stellar_case, case_id=stellar_case_id, update_alerts=True)
+            await call_blocking(LDB.close_ticket_linkage, stellar_case_id=stellar_case_id)
+        elif stellar_status.lower() in ["cancelled"]:
+            l.info("CW ticket in state [{} {}] | cencelling related stellar case: [{}] [{}]".format(rt_ticket_number, cw_status, stellar_case_id, stellar_status))
+            await call(SU.cancel_stellar_case, case_id=stellar_case_id, update_alerts=True)
+            await call_blocking(LDB.close_ticket_linkage, stellar_case_id=stellar_case_id)
+        else:
+            l.info("CW ticket in state [{} {}] | updating related stellar case: [{}] [{}]".format(rt_ticket_number, cw_status, stellar_case_id, stellar_status))
+            await call(SU.update_stellar_case, case_id=stellar_case_id, case_status=stellar_status, update_tag=False)
+            await call_blocking(LDB.update_remote_ticket_timestamp, stellar_case_id=stellar_case_id, rt_ticket_ts=cw_ticket_updated_ts)
+
+    ''' check on ticket ownership '''
+    if CW_SYNC_OWNER:
+        # forced, or only when the audit records show an ownership change since the last sync
+        owner_changed = CW_FORCE_OWNER_SYNC
+        if not CW_FORCE_OWNER_SYNC:
+            owner_record = await call(CW.get_ticket_ownership_change, rt_ticket_number, cursor=audit_cursor)
+            if owner_record:
+                owner_record_ts = CW.datestring_to_epoch(owner_record.get('enteredDate', "1970-01-01T00:00:00Z"))
+                owner_changed = owner_record_ts > rt_ticket_last_modified
+        owner_link = cw_ticket.get('owner', {}).get('_info', {}).get('member_href', '')
+        if owner_changed and owner_link:
+            new_owner_email = await call(CW.get_member_email_via_link, owner_link)
+            await call(SU.update_stellar_case_assignee, case_id=stellar_case_id, case_assignee=new_owner_email)
+            await call_blocking(LDB.update_remote_ticket_timestamp, stellar_case_id=stellar_case_id, rt_ticket_ts=cw_ticket_updated_ts)
+            l.info("Updated stellar case with assignee: [{}] [{}]".format(stellar_case_id, new_owner_email))
+
+    ''' check on new notes '''
+    if CW_SYNC_NOTES:
+        ''' pull notes '''
+        note_cursor = None
+        if CW_INCREMENTAL_NOTES:
+            note_cursor = await call_blocking(get_note_cursor, rt_ticket_number, rt_ticket_last_modified)
+        cw_ticket_notes = await call(CW.get_ticket_notes, ticket_id=rt_ticket_number, cursor=note_cursor)
+        for cw_ticket_note in cw_ticket_notes:
+            cw_note_id = cw_ticket_note.get('id', 0)
+            cw_note_text = cw_ticket_note.get('text')
+            cw_note_ts_str = cw_ticket_note.get('_info', {}).get('lastUpdated', "2025-01-01T00:00:00Z")
+            cw_note_ts = CW.datestring_to_epoch(cw_note_ts_str)
+            if cw_note_ts > rt_ticket_last_modified:
+                l.info("Updating stellar case: [{}] with ticket note id: [{}]".format(stellar_case_id, cw_note_id))
+                await call(SU.add_case_comment, case_id=stellar_case_id, comment=cw_note_text)
+                await call_blocking(LDB.update_remote_ticket_timestamp, stellar_case_id=stellar_case_id, rt_ticket_ts=cw_ticket_updated_ts)
+        if CW_INCREMENTAL_NOTES:
+            await call_blocking(put_note_cursor, rt_ticket_number, cw_ticket_notes, note_cursor)
+
+    ''' check on audit items '''
+    if CW_SYNC_AUDIT_RECORDS:
+        ''' pull audit records  '''
+        cw_audit_records = await call(CW.get_audit_records, ticket_id=rt_ticket_number, cursor=audit_cursor)
+        for cw_audit_record in cw_audit_records:
+            cw_ar_text = cw_audit_record.get('text', '')
+            cw_ar_entered_by = cw_audit_record.get('enteredBy', '')
+            cw_ar_audit_type = cw_audit_record.get('auditType', '')
+            cw_ar_audit_subtype = cw_audit_record.get('auditSubType', '')
+            cw_note_ts_str = cw_audit_record.get('enteredDate', "1970-01-01T00:00:00Z")
+            cw_note_ts = CW.datestring_to_epoch(cw_note_ts_str)
+            if cw_note_ts > rt_ticket_last_modified:
+                stellar_comment_string = 'CW audit record\nType: {} Subtype: {} Time: {} By: {}\n[{}]'.format(
+                    cw_ar_audit_type, cw_ar_audit_subtype, cw_note_ts_str, cw_ar_entered_by, cw_ar_text)
+                l.info("Updating stellar case: [{}] with ticket audit record: [{} / {}]".format(stellar_case_id, cw_note_ts_str, cw_ar_entered_by))
+                await call(SU.add_case_comment, case_id=stellar_case_id, comment=stellar_comment_string)
+                await call_blocking(LDB.update_remote_ticket_timestamp, stellar_case_id=stellar_case_id, rt_ticket_ts=cw_ticket_updated_ts)
+
+    ''' move the audit cursor past everything handled above '''
+    if CW_INCREMENTAL_AUDIT and CW_AUDIT_NEEDED:
+        cw_audit_records = await call(CW.get_audit_records, ticket_id=rt_ticket_number, cursor=audit_cursor)
+        new_audit_cursor = CW.get_audit_cursor(cw_audit_records, audit_cursor)
+        if new_audit_cursor and new_audit_cursor != audit_cursor:
+            await call_blocking(LDB.put_sync_cursor, remote_ticket_id=rt_ticket_number, cursor_type='audit', cursor=new_audit_cursor)
+
+    ''' the audit records are not read again for this ticket this cycle '''
+    CW.release_audit_records(rt_ticket_number)
+
+
+async def prefetch_new_case(case):
+    ''' new case stage 1: read everything the ticket needs from stellar (summary and alerts concurrently with --async) '''
+    stellar_case_id = case.get("_id")
+    (case_summary, event_names) = await call_all(
+        call(SU.get_case_summary, case_id=stellar_case_id),
+        call(SU.get_case_alerts, stellar_case_id, return_only_alert_names=True))
+    new_case = {
+        "stellar_case_id": stellar_case_id,
+        "stellar_case_number": case.get('ticket_id'),
+        "case_name": case.get('name', ''),
+        "case_score": case.get('score', 0),
+        "case_tenant_name": case.get('tenant_name'),
+        "case_summary": case_summary,
+        "event_names": event_names,
+        "stellar_url": SU.make_stellar_case_url(stellar_case_id)
+    }
+    return new_case
+
+
+async def create_new_case_ticket(new_case):
+    ''' new case stage 2: create the CW ticket, record the linkage and add the note - None if the ticket could not be created '''
+    stellar_case_id = new_case['stellar_case_id']
+    stellar_case_number = new_case['stellar_case_number']
+    l.info(
+        "Stellar Case ID: [{}] | Ticket Number: [{}] | URL: [{}]".format(stellar_case_id, stellar_case_number,
+                                                                         new_case['stellar_url']))
+    new_ticket_id = await call(CW.create_ticket, ticket_summary=new_case['case_name'],
+                               company_name=new_case['case_tenant_name'], event_score=new_case['case_score'],
+                               stellar_case_number=stellar_case_number)
+    if not new_ticket_id:
+        l.error("Failed to create Connectwise ticket - see log messages for more information")
+        return None
+    # recorded before anything else can fail - a case without its linkage gets a second ticket next cycle
+    await call_blocking(LDB.put_ticket_linkage, stellar_case_id=stellar_case_id,
+                        stellar_case_number=stellar_case_number, remote_ticket_id=new_ticket_id)
+    ticket_note_text = CW.create_ticket_note_text(case_summary=new_case['case_summary'],
+                                                  case_tenant_name=new_case['case_tenant_name'],
+                                                  case_url=new_case['stellar_url'], alerts=new_case['event_names'])
+    await call(CW.create_ticket_note, ticket_id=new_ticket_id, ticket_note_text=ticket_note_text)
+    new_case['new_ticket_id'] = new_ticket_id
+    return new_case
+
+
+async def write_back_new_case(new_case):
+    ''' new case stage 3: comment / tag the stellar case '''
+    stellar_case_id = new_case['stellar_case_id']
+    new_ticket_id = new_case['new_ticket_id']
+    stellar_comment = "Connectwise ticket created: [{}]".format(new_ticket_id)
+    await call(SU.update_stellar_case, case_id=stellar_case_id, case_comment=stellar_comment)
+    return new_case
+
+
+async def ingest_new_case(case):
+    ''' the three new case stages one after another for a single case '''
+    new_case = await prefetch_new_case(case)
+    new_case = await create_new_case_ticket(new_case)
+    if new_case:
+        await write_back_new_case(new_case)
+
+
+def run_new_case_pipeline(cases):
+    '''
+    runs the three new case stages concurrently, connected by bounded queues
+    a full queue blocks the stage feeding it (back-pressure) so prefetching never runs far ahead of ticket creation
+    failures are logged per case and raised once the pipeline has drained so the checkpoint is not advanced
+    '''
+    stages = [("prefetch", prefetch_new_case, STELLAR_INGEST_PREFETCH_WORKERS),
+              ("create", create_new_case_ticket, STELLAR_INGEST_CREATE_WORKERS),
+              ("write_back", write_back_new_case, STELLAR_INGEST_WRITEBACK_WORKERS)]
+    queues = [queue.Queue(maxsize=STELLAR_INGEST_QUEUE_SIZE) for _ in range(len(stages))]
+    timings = {name: 0.0 for (name, func, workers) in stages}
+    failures = []
+    stats_lock = threading.Lock()
+
+    def stage_worker(name, func, in_q, out_q):
+        while True:
+            item = in_q.get()
+            if item is None:
+                break
+            ts_start = time()
+            try:
+                item = run_sync(func, item)
+            except Exception:
+                l.error("New case pipeline [{}] failed: {}".format(name, traceback.format_exc()))
+                with stats_lock:
+                    failures.append(name)
+                item = None
+            with stats_lock:
+                timings[name] += time() - ts_start
+            if item and out_q is not None:
+                out_q.put(item)
+
+    ts_start_of_pipeline = time()
+    stage_threads = []
+    for i, (name, func, workers) in enumerate(stages):
+        out_q = queues[i + 1] if i + 1 < len(stages) else None
+        threads = [threading.Thread(target=stage_worker, args=(name, func, queues[i], out_q), daemon=True)
+                   for _ in range(workers)]
+        for thr in threads:
+            thr.start()
+        stage_threads.append(threads)
+
+    case_cnt = 0
+    try:
+        for case in cases:
+            case_cnt += 1
+            queues[0].put(case)
+    finally:
+        # also when listing the cases fails - the cases already fed finish before the error is raised
+        # shut the stages down in order - each stage is drained before the next one is told to stop
+        for i, threads in enumerate(stage_threads):
+            for _ in threads:
+                queues[i].put(None)
+            for thr in threads:
+                thr.join()
+
+    l.info("New case pipeline: [{} cases] [{:.1f}s] stage time: {}".format(
+        case_cnt, time() - ts_start_of_pipeline, {name: round(t, 1) for (name, t) in timings.items()}))
+    if failures:
+        raise Exception("New case pipeline failed for [{}] cases - see log messages for more information".format(len(failures)))
+
+
+def run_cw_ticket_pass(cw_tickets, tracked_tickets=None):
+    '''
+    linkages are looked up and their updates committed LDB_BATCH_SIZE tickets at a time - a batch is finished
+    before the next one starts, so a crash only loses the updates of the batch in flight
+    :return: number of CW tickets looked at
+    '''
+    cw_ticket_cnt = 0
+    # tickets are independent - each one is handled start to finish by one worker so its stellar updates stay in order
+    with ThreadPoolExecutor(max_workers=max(CW_SYNC_WORKERS, 1)) as executor:
+        for batch in iter_batches(cw_tickets, LDB_BATCH_SIZE):
+            linkages = get_batch_linkages(batch, tracked_tickets)
+            with LDB.unit_of_work():
+                if CW_SYNC_WORKERS > 1:
+                    futures = [executor.submit(run_sync, sync_cw_ticket, cw_ticket, linkages) for cw_ticket in batch]
+                    for future in futures:
+                        future.result()
+                else:
+                    for cw_ticket in batch:
+                        run_sync(sync_cw_ticket, cw_ticket, linkages)
+            cw_ticket_cnt += len(batch)
+    return cw_ticket_cnt
+
+
+def run_new_case_pass(cases):
+    new_cases = iter_new_cases(cases)
+    if STELLAR_INGEST_PIPELINE:
+        run_new_case_pipeline(new_cases)
+    else:
+        for case in new_cases:
+            run_sync(ingest_new_case, case)
+
+
+async def run_limited(items, func):
+    ''' --async: starts func for each item as soon as one of the async_concurrency slots is free '''
+    limiter = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    tasks = []
+    try:
+        async for item in items:
+            await limiter.acquire()
+            task = asyncio.ensure_future(func(item))
+            task.add_done_callback(lambda t: limiter.release())
+            tasks.append(task)
+    except Exception:
+        # the items already started finish before the listing error is raised
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    await asyncio.gather(*tasks)
+    return len(tasks)
+
+
+async def run_async_cw_ticket_pass(cw_tickets, tracked_tickets=None):
+    ''' same batches as run_cw_ticket_pass '''
+    cw_ticket_cnt = 0
+    async for batch in aiter_batches(cw_tickets, LDB_BATCH_SIZE):
+        linkages = await call_blocking(get_batch_linkages, batch, tracked_tickets)
+        with LDB.unit_of_work():
+            cw_ticket_cnt += await run_limited(aiter_items(batch), lambda cw_ticket: sync_cw_ticket(cw_ticket, linkages))
+    return cw_ticket_cnt
+
+
+async def run_async_new_case_pass(cases):
+    await run_limited(aiter_new_cases(cases), ingest_new_case)
+
+
+async def run_cycle_steps(cw_ticket_pass, new_case_pass):
+    ''' one pass of the CW -> stellar sync followed by ticket creation for new stellar cases - shared by both modes '''
+    ''''''
+    '''   get CW tickets since checkpoint and compare with DB to see if they are sync'd '''
+    ''''''
+    r = await call(CW.test_connection)
+    CW.clear_audit_cache()
+    NEW_CHECKPOINT_TS = int(time() * 1000)
+    CHECKPOINT_TS = round(int(await call_blocking(SU.checkpoint_read, filepath=CW_CHECKPOINT_FILENAME))/1000)
+    tracked_tickets = await call_blocking(get_tracked_tickets)
+    ticket_ids = list(tracked_tickets.keys()) if tracked_tickets is not None else None
+    cw_tickets = CW.iter_tickets(since_ts_epoch=CHECKPOINT_TS, ticket_ids=ticket_ids)
+    cw_ticket_cnt = await call(cw_ticket_pass, cw_tickets, tracked_tickets)
+    l.info("Found CW [{}] tickets modified since: [{}]".format(cw_ticket_cnt, CHECKPOINT_TS))
+
+    ''''''
+    ''' Complete CW loop                            '''
+    ''''''
+    await call_blocking(SU.checkpoint_write, filepath=CW_CHECKPOINT_FILENAME, val=NEW_CHECKPOINT_TS)
+
+
+    ''''''
+    ''' get all STELLAR cases since last checkpoint '''
+    ''''''
+    NEW_CHECKPOINT_TS = int(time() * 1000)
+    CHECKPOINT_TS = int(await call_blocking(SU.checkpoint_read, filepath=STELLAR_CHECKPOINT_FILENAME))
+
+    # cases = SU.get_stellar_cases(from_ts=1707541200000)
+    cases = SU.iter_stellar_cases(from_ts=CHECKPOINT_TS, use_modified_at=True)
+    ''' if the case is already sync'd - skip over '''
+    try:
+        await call(new_case_pass, cases)
+    except Exception as e:
+        # the cases are looked at again next cycle - the checkpoint is left where it is
+        l.error("Stellar case pass failed - checkpoint not advanced: [{}]".format(e))
+        return
+
+    await call_blocking(SU.checkpoint_write, filepath=STELLAR_CHECKPOINT_FILENAME, val=NEW_CHECKPOINT_TS)
+
+
+def run_cycle():
+    run_sync(run_cycle_steps, run_cw_ticket_pass, run_new_case_pass)
+
+
+async def run_async_cycle():
+    ''' --async: at most async_concurrency tickets / cases are in flight at once, sharing one connection pool '''
+    await run_cycle_steps(run_async_cw_ticket_pass, run_async_new_case_pass)
+
+
+async def make_async_session(pool_size):
+    ''' one aiohttp session (and connection pool) shared by AsyncConnectWise and AsyncStellarUtil '''
+    import aiohttp
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size))
+
+
 if __name__ == "__main__":
 
+    ASYNC_SESSION = None
     try:
         with open(args.yaml_config, 'r') as config_file:
             config = yaml.safe_load(config_file)
@@ -91,10 +586,43 @@ if __name__ == "__main__":
         if CW_SYNC_AUDIT_RECORDS:
             # disabling note sync as this would be redundant
             CW_SYNC_NOTES = False
+        # audit records are read by the audit sync and by owner sync (unless forced)
+        CW_AUDIT_NEEDED = CW_SYNC_AUDIT_RECORDS or (CW_SYNC_OWNER and not CW_FORCE_OWNER_SYNC)
+        # only retrieve audit records newer than the per-ticket cursor kept in the local db
+        CW_INCREMENTAL_AUDIT = config.get('cw_incremental_audit', False)
+        # only retrieve notes updated after the per-ticket cursor kept in the local db
+        CW_INCREMENTAL_NOTES = config.get('cw_incremental_notes', False)
+        # only ask CW for tickets with an open linkage in the local db
+        CW_POLL_TRACKED_ONLY = config.get('cw_poll_tracked_only', False)
+        # linkages are looked up in the local db this many tickets / cases at a time
+        LDB_BATCH_SIZE = int(config.get('ldb_batch_size', 100))
+        # closed linkages are moved out of the ticket table after this many days (0 = keep them)
+        LDB_ARCHIVE_CLOSED_DAYS = int(config.get('ldb_archive_closed_days', 30))
+        # number of CW tickets synced in parallel (1 = sequential)
+        CW_SYNC_WORKERS = int(config.get('cw_sync_workers', 1))
+        # staged pipeline for new stellar cases (all 1 = sequential)
+        STELLAR_INGEST_PREFETCH_WORKERS = int(config.get('stellar_ingest_prefetch_workers', 1))
+        STELLAR_INGEST_CREATE_WORKERS = int(config.get('stellar_ingest_create_workers', 1))
+        STELLAR_INGEST_WRITEBACK_WORKERS = int(config.get('stellar_ingest_writeback_workers', 1))
+        STELLAR_INGEST_QUEUE_SIZE = int(config.get('stellar_ingest_queue_size', 20))
+        STELLAR_INGEST_PIPELINE = max(STELLAR_INGEST_PREFETCH_WORKERS, STELLAR_INGEST_CREATE_WORKERS,
+                                      STELLAR_INGEST_WRITEBACK_WORKERS) > 1
 
-        CW = ConnectWise(logger=l, config=config)
-        SU = STELLAR_UTIL.STELLAR_UTIL(logger=l, config=config, optional_data_path=args.data_volume)
-        LDB = STELLAR_UTIL.local_db(ticket_table_name='cw_tickets', optional_db_dir=args.data_volume)
+        if args.async_mode:
+            ASYNC_CONCURRENCY = int(config.get('async_concurrency', 20))
+            ASYNC_LOOP = asyncio.new_event_loop()
+            asyncio.set_event_loop(ASYNC_LOOP)
+            ASYNC_SESSION = ASYNC_LOOP.run_until_complete(make_async_session(int(config.get('async_pool_size', 50))))
+            CW = AsyncConnectWise(logger=l, config=config, session=ASYNC_SESSION, optional_data_path=args.data_volume)
+            SU = STELLAR_UTIL.AsyncStellarUtil(logger=l, config=config, optional_data_path=args.data_volume,
+                                               session=ASYNC_SESSION)
+        else:
+            CW = ConnectWise(logger=l, config=config, optional_data_path=args.data_volume)
+            SU = STELLAR_UTIL.STELLAR_UTIL(logger=l, config=config, optional_data_path=args.data_volume)
+        LDB = STELLAR_UTIL.local_db(ticket_table_name='cw_tickets', optional_db_dir=args.data_volume,
+                                    journal_mode=config.get('ldb_journal_mode', 'WAL'),
+                                    synchronous=config.get('ldb_synchronous', 'NORMAL'),
+                                    linkage_index=config.get('ldb_linkage_index', True), logger=l)
 
         ''' testing goes here '''
         # test 1
@@ -104,152 +632,20 @@ if __name__ == "__main__":
 
             ts_start_of_loop = time()
 
-            ''''''
-            '''   get CW tickets since checkpoint and compare with DB to see if they are sync'd '''
-            ''''''
-            r = CW.test_connection()
-            NEW_CHECKPOINT_TS = int(time() * 1000)
-            CHECKPOINT_TS = round(int(SU.checkpoint_read(filepath=CW_CHECKPOINT_FILENAME))/1000)
-            cw_tickets = CW.get_tickets(since_ts_epoch=CHECKPOINT_TS)
-            l.info("Found CW [{}] tickets modified since: [{}]".format(len(cw_tickets), CHECKPOINT_TS))
-            for cw_ticket in cw_tickets:
-                cw_ticket_number = cw_ticket.get('id', '')
-                cw_ticket_updated_str = cw_ticket.get('_info', {}).get('lastUpdated', '1970-01-01T00:00:00T')
-                cw_ticket_updated_ts = CW.datestring_to_epoch(cw_ticket_updated_str)
-                open_ticket = LDB.get_ticket_linkage(remote_ticket_id=cw_ticket_number)
-                if open_ticket and not open_ticket.get('state', '') == 'closed':
-                    rt_ticket_number = cw_ticket_number
-                    rt_ticket_last_modified = open_ticket.get('remote_ticket_last_modified', '')
-                    stellar_case_id = open_ticket.get('stellar_case_id', '')
-                    if cw_ticket_updated_ts > rt_ticket_last_modified:
-                        l.info("CW ticket has been modified since last sync: [{}] [ticket updated: {}] [last sync: {}]".format(rt_ticket_number, cw_ticket_updated_str, rt_ticket_last_modified))
-
-                        ''' check on ticket resolution '''
-                        if CW_SYNC_STATUS:
-                            cw_status = cw_ticket.get('status', {}).get('name', '')
-                            stellar_status = ''
-                            if cw_status in CW_SYNC_STATUS_MAP:
-                                stellar_status = CW_SYNC_STATUS_MAP.get(cw_status, '')
-                            else:
-                                stellar_status = CW_SYNC_STATUS_MAP.get('default', '')
-                            if stellar_status.lower() in ["resolved"]:
-                                l.info("CW ticket in state [{} {}] | resolving related stellar case: [{}] [{}]".format(rt_ticket_number, cw_status, stellar_case_id, stellar_status))
-                                SU.resolve_stellar_case(case_id=stellar_case_id, update_alerts=True)
-                                LDB.close_ticket_linkage(stellar_case_id=stellar_case_id)
-                            elif stellar_status.lower() in ["cancelled"]:
-                                l.info("CW ticket in state [{} {}] | cencelling related stellar case: [{}] [{}]".format(rt_ticket_number, cw_status, stellar_case_id, stellar_status))
-                                SU.cancel_stellar_case(case_id=stellar_case_id, update_alerts=True)
-                                LDB.close_ticket_linkage(stellar_case_id=stellar_case_id)
-                            else:
-                                l.info("CW ticket in state [{} {}] | updating related stellar case: [{}] [{}]".format(rt_ticket_number, cw_status, stellar_case_id, stellar_status))
-                                SU.update_stellar_case (case_id=stellar_case_id, case_status=stellar_status, update_tag=False)
-                                LDB.update_remote_ticket_timestamp(stellar_case_id=stellar_case_id, rt_ticket_ts=cw_ticket_updated_ts)
-
-                        ''' check on ticket ownership '''
-                        if CW_SYNC_OWNER:
-                            if CW_FORCE_OWNER_SYNC:
-                                ''' force owner sync '''
-                                owner_link = cw_ticket.get('owner', {}).get('_info', {}).get('member_href', '')
-                                if owner_link:
-                                    new_owner_email = CW.get_member_email_via_link(owner_link)
-                                    SU.update_stellar_case_assignee(case_id=stellar_case_id, case_assignee=new_owner_email)
-                                    LDB.update_remote_ticket_timestamp(stellar_case_id=stellar_case_id, rt_ticket_ts=cw_ticket_updated_ts)
-                                    l.info("Updated stellar case with assignee: [{}] [{}]".format(stellar_case_id, new_owner_email))
-
-                            else:
-                                ''' get ownership changes from audit records '''
-                                owner_record = CW.get_ticket_ownership_change(rt_ticket_number)
-                                if owner_record:
-                                    owner_record_ts_str = owner_record.get('enteredDate', "1970-01-01T00:00:00Z")
-                                    owner_record_ts = CW.datestring_to_epoch(owner_record_ts_str)
-                                    if owner_record_ts > rt_ticket_last_modified:
-                                        owner_link = cw_ticket.get('owner', {}).get('_info', {}).get('member_href', '')
-                                        if owner_link:
-                                            new_owner_email = CW.get_member_email_via_link(owner_link)
-                                            SU.update_stellar_case_assignee(case_id=stellar_case_id, case_assignee=new_owner_email)
-                                            LDB.update_remote_ticket_timestamp(stellar_case_id=stellar_case_id, rt_ticket_ts=cw_ticket_updated_ts)
-                                            l.info("Updated stellar case with assignee: [{}] [{}]".format(stellar_case_id,
-                                                                                                       new_owner_email))
-
-                        ''' check on new notes '''
-                        if CW_SYNC_NOTES:
-                            ''' pull notes '''
-                            cw_ticket_notes = CW.get_ticket_notes(ticket_id=rt_ticket_number)
-                            for cw_ticket_note in cw_ticket_notes:
-                                cw_note_id = cw_ticket_note.get('id', 0)
-                                cw_note_text = cw_ticket_note.get('text')
-                                cw_note_ts_str = cw_ticket_note.get('_info', {}).get('lastUpdated', "2025-01-01T00:00:00Z")
-                                cw_note_ts = CW.datestring_to_epoch(cw_note_ts_str)
-                                if cw_note_ts > rt_ticket_last_modified:
-                                    l.info("Updating stellar case: [{}] with ticket note id: [{}]".format(stellar_case_id, cw_note_id))
-                                    SU.add_case_comment(case_id=stellar_case_id, comment=cw_note_text)
-                                    LDB.update_remote_ticket_timestamp(stellar_case_id=stellar_case_id, rt_ticket_ts=cw_ticket_updated_ts)
-
-                        ''' check on audit items '''
-                        if CW_SYNC_AUDIT_RECORDS:
-                            ''' pull audit records  '''
-                            cw_audit_records = CW.get_audit_records(ticket_id=rt_ticket_number)
-                            for cw_audit_record in cw_audit_records:
-                                cw_ar_text = cw_audit_record.get('text', '')
-                                cw_ar_entered_by = cw_audit_record.get('enteredBy', '')
-                                cw_ar_audit_type = cw_audit_record.get('auditType', '')
-                                cw_ar_audit_subtype = cw_audit_record.get('auditSubType', '')
-                                cw_ar_audit_source = cw_audit_record.get('auditSource', '')
-                                # cw_note_ts_str = cw_audit_record.get('enteredDate')
-                                cw_note_ts_str = cw_audit_record.get('enteredDate', "1970-01-01T00:00:00Z")
-                                cw_note_ts = CW.datestring_to_epoch(cw_note_ts_str)
-                                if cw_note_ts > rt_ticket_last_modified:
-                                    stellar_comment_string = 'CW audit record\nType: {} Subtype: {} Time: {} By: {}\n[{}]'.format(
-                                        cw_ar_audit_type, cw_ar_audit_subtype, cw_note_ts_str, cw_ar_entered_by, cw_ar_text)
-                                    l.info("Updating stellar case: [{}] with ticket audit record: [{} / {}]".format(stellar_case_id, cw_note_ts_str, cw_ar_entered_by))
-                                    SU.add_case_comment(case_id=stellar_case_id, comment=stellar_comment_string)
-                                    LDB.update_remote_ticket_timestamp(stellar_case_id=stellar_case_id, rt_ticket_ts=cw_ticket_updated_ts)
-
-            ''''''
-            ''' Complete CW loop                            '''
-            ''''''
-            SU.checkpoint_write(filepath=CW_CHECKPOINT_FILENAME, val=NEW_CHECKPOINT_TS)
-
-
-            ''''''
-            ''' get all STELLAR cases since last checkpoint '''
-            ''''''
-            NEW_CHECKPOINT_TS = int(time() * 1000)
-            CHECKPOINT_TS = int(SU.checkpoint_read(filepath=STELLAR_CHECKPOINT_FILENAME))
-
-            # cases = SU.get_stellar_cases(from_ts=1707541200000)
-            cases = SU.get_stellar_cases(from_ts=CHECKPOINT_TS, use_modified_at=True)
-            for case in cases.get('cases', {}):
-                stellar_case_id = case.get("_id")
-
-                ''' if the case is already sync'd - skip over '''
-                syncd_case = LDB.get_ticket_linkage(stellar_case_id=stellar_case_id)
-                if syncd_case:
-                    continue
-
-                stellar_case_number = case.get('ticket_id')
-                case_name = case.get('name', '')
-                case_score = case.get('score', 0)
-                case_tenant_name = case.get('tenant_name')
-                case_summary = SU.get_case_summary(case_id=stellar_case_id)
-                event_names = SU.get_case_alerts(stellar_case_id, return_only_alert_names=True)
-                stellar_url = SU.make_stellar_case_url(stellar_case_id)
-                l.info(
-                    "Stellar Case ID: [{}] | Ticket Number: [{}] | URL: [{}]".format(stellar_case_id, stellar_case_number,
-                                                                                     stellar_url))
-                new_ticket_id = CW.create_ticket(ticket_summary=case_name, company_name=case_tenant_name, event_score=case_score, stellar_case_number=stellar_case_number)
-                if new_ticket_id:
-                    ticket_note_text = CW.create_ticket_note_text(case_summary=case_summary,
-                                                                  case_tenant_name=case_tenant_name, case_url=stellar_url,
-                                                                  alerts=event_names)
-                    CW.create_ticket_note(ticket_id=new_ticket_id, ticket_note_text=ticket_note_text)
-                    stellar_comment = "Connectwise ticket created: [{}]".format(new_ticket_id)
-                    SU.update_stellar_case(case_id=stellar_case_id, case_comment=stellar_comment)
-                    LDB.put_ticket_linkage(stellar_case_id=stellar_case_id, stellar_case_number=stellar_case_number, remote_ticket_id=new_ticket_id)
-                else:
-                    l.error("Failed to create Connectwise ticket - see log messages for more information")
+            if args.async_mode:
+                ASYNC_LOOP.run_until_complete(run_async_cycle())
+            else:
+                run_cycle()
 
-            SU.checkpoint_write(filepath=STELLAR_CHECKPOINT_FILENAME, val=NEW_CHECKPOINT_TS)
+            l.info("CW connection pool: {}".format(CW.get_pool_stats()))
+            l.info("CW member email cache: {}".format(CW.get_member_cache_stats()))
+            l.info("CW projected payloads: {}".format(CW.get_payload_stats()))
+            l.info("Stellar interflow cache: {}".format(SU.get_interflow_cache_stats()))
+            CW.save_member_cache()
+            if LDB_ARCHIVE_CLOSED_DAYS:
+                archived_cnt = LDB.archive_closed_linkages(LDB_ARCHIVE_CLOSED_DAYS)
+                if archived_cnt:
+                    l.info("Archived closed linkages: [{}]".format(archived_cnt))
             ts_loop_duration = time() - ts_start_of_loop
             if POLL_INTERVAL > ts_loop_duration:
                 ts_sleep_time = POLL_INTERVAL - ts_loop_duration
@@ -261,4 +657,8 @@ if __name__ == "__main__":
     except Exception as e:
         l.error(traceback.format_exc())
         exit(1)
+    finally:
+        # also on exit(1) / ctrl-c - the shared aiohttp session is not left to the garbage collector
+        if ASYNC_SESSION is not None:
+            ASYNC_LOOP.run_until_complete(ASYNC_SESSION.close())
 
@@ -0,0 +1,25 @@
+import importlib.util
+import logging
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("connectwise-case-sync-tests")
+
+
+@pytest.fixture
+def sync_script(monkeypatch):
+    ''' connectwise-case-sync.py loaded as a module - its argparse reads sys.argv at import '''
+    monkeypatch.setattr(sys, "argv", ["connectwise-case-sync.py"])
+    spec = importlib.util.spec_from_file_location("connectwise_case_sync",
+                                                  os.path.join(REPO_DIR, "connectwise-case-sync.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import re
+import threading
+
+import pytest
+import requests
+import urllib3
+
+import ConnectWise as cw_module
+from ConnectWise import ConnectWise, AsyncConnectWise
+
+MAX_RETRIES = 2
+
+
+class FakeResponse():
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class FakeSession():
+    ''' returns / raises the given outcomes in turn and records the calls '''
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(method)
+        outcome = self.outcomes[min(len(self.calls), len(self.outcomes)) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+def make_client(logger, cls=ConnectWise, **attrs):
+    ''' client with only the attributes the tested methods use - __init__ loads company / reference data from CW '''
+    c = object.__new__(cls)
+    c.l = logger
+    c.base_url = 'https://cw.example.com/v4_6_release/apis/3.0'
+    c.request_lock = threading.Lock()
+    c.request_cnt = 0
+    c.cw_request_timeout = 60
+    c.cw_max_retries = MAX_RETRIES
+    c.cw_retry_backoff = 1
+    c.cw_retry_max_wait = 60
+    c.fields = {}
+    c.fields_measure = False
+    c.payload_stats = {}
+    c.payload_lock = threading.Lock()
+    for (name, value) in attrs.items():
+        setattr(c, name, value)
+    return c
+
+
+def connect_error():
+    reason = urllib3.exceptions.NewConnectionError(None, "Failed to establish a new connection")
+    return requests.exceptions.ConnectionError(urllib3.exceptions.MaxRetryError(None, "/", reason=reason))
+
+
+def reset_error():
+    return requests.exceptions.ConnectionError(urllib3.exceptions.ProtocolError("Connection aborted.", ConnectionResetError()))
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(cw_module, "sleep", lambda s: None)
+
+
+@pytest.mark.parametrize("method, status_code, calls", [
+    ("GET", 503, MAX_RETRIES + 1),
+    ("PATCH", 502, MAX_RETRIES + 1),
+    ("POST", 503, 1),
+    ("POST", 500, 1),
+    ("POST", 429, MAX_RETRIES + 1),
+    ("GET", 400, 1),
+])
+def test_send_retry_status(logger, no_sleep, method, status_code, calls):
+    c = make_client(logger, session=FakeSession(status_code))
+    r = c._send(method, c.base_url + '/service/tickets')
+    assert r.status_code == status_code
+    assert len(c.session.calls) == calls
+    assert c.request_cnt == calls
+
+
+@pytest.mark.parametrize("error", [connect_error, requests.exceptions.ConnectTimeout])
+@pytest.mark.parametrize("method", ["GET", "POST"])
+def test_send_retries_connect_error(logger, no_sleep, method, error):
+    c = make_client(logger, session=FakeSession(error(), 201))
+    assert c._send(method, c.base_url + '/service/tickets').status_code == 201
+    assert len(c.session.calls) == 2
+
+
+@pytest.mark.parametrize("error", [reset_error, requests.exceptions.ReadTimeout])
+def test_send_does_not_replay_post(logger, no_sleep, error):
+    c = make_client(logger, session=FakeSession(error(), 201))
+    with pytest.raises((requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        c._send("POST", c.base_url + '/service/tickets')
+    assert len(c.session.calls) == 1
+
+
+@pytest.mark.parametrize("error", [reset_error, requests.exceptions.ReadTimeout])
+def test_send_retries_get_after_reset_or_timeout(logger, no_sleep, error):
+    c = make_client(logger, session=FakeSession(error(), 200))
+    assert c._send("GET", c.base_url + '/service/tickets').status_code == 200
+    assert len(c.session.calls) == 2
+
+
+def test_send_raises_when_retries_exhausted(logger, no_sleep):
+    c = make_client(logger, session=FakeSession(requests.exceptions.ReadTimeout()))
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        c._send("GET", c.base_url + '/service/tickets')
+    assert len(c.session.calls) == MAX_RETRIES + 1
+
+
+class FakeTicketApi():
+    '''
+    /service/tickets with count, page and "id > n" queries over the ids 1..100 (page size 10)
+    drop_after_page: tickets leaving the result set once that page was served (updated while paging)
+    '''
+    def __init__(self, drop_after_page=None, drop_ids=(), fail_page=None):
+        self.ids = list(range(1, 101))
+        self.drop_after_page = drop_after_page
+        self.drop_ids = set(drop_ids)
+        self.fail_page = fail_page
+        self.urls = []
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            self.urls.append(url)
+            if '/count?' in url:
+                return FakeResponse(200, json.dumps({'count': len(self.ids)}))
+            page = re.search(r'&page=(\d+)', url)
+            if page:
+                page_cnt = int(page.group(1))
+                if page_cnt == self.fail_page:
+                    return FakeResponse(500, 'page failed')
+                ids = self.ids[(page_cnt - 1) * 10:page_cnt * 10]
+                if page_cnt == self.drop_after_page:
+                    self.ids = [i for i in self.ids if i not in self.drop_ids]
+                return self._make_page(ids)
+            last_id = int(re.search(r'\) and id > (\d+)&', url).group(1))
+            gaps = [(int(a), int(b)) for (a, b) in re.findall(r'\(id > (\d+) and id < (\d+)\)', url)]
+            ids = [i for i in self.ids if i > last_id and (not gaps or any(a < i < b for (a, b) in gaps))]
+            return self._make_page(ids[:10])
+
+    async def async_get(self, url):
+        return self.get(url)
+
+    def get_after_id_urls(self):
+        return [url for url in self.urls if '&page=' not in url and '/count?' not in url]
+
+    def _make_page(self, ids):
+        return FakeResponse(200, json.dumps([{'id': i} for i in ids]))
+
+
+def make_ticket_client(logger, api, cls=ConnectWise, page_workers=1):
+    return make_client(logger, cls=cls, _get=api.get, _async_get=api.async_get, tickets_page_size=10,
+                       tickets_page_workers=page_workers, max_conditions_length=2000)
+
+
+def list_tickets(c):
+    if isinstance(c, AsyncConnectWise):
+        async def collect():
+            return [ticket['id'] async for ticket in c.iter_tickets(1)]
+        return asyncio.run(collect())
+    return [ticket['id'] for ticket in c.iter_tickets(1)]
+
+
+@pytest.mark.parametrize("cls", [ConnectWise, AsyncConnectWise])
+@pytest.mark.parametrize("page_workers", [1, 4])
+def test_iter_tickets_reads_pages_once(logger, cls, page_workers):
+    api = FakeTicketApi()
+    ids = list_tickets(make_ticket_client(logger, api, cls, page_workers))
+    assert ids == list(range(1, 101))
+    assert len(api.urls) == 1 + 10
+    assert api.get_after_id_urls() == []
+
+
+@pytest.mark.parametrize("cls", [ConnectWise, AsyncConnectWise])
+def test_iter_tickets_drift_queries_only_gaps(logger, cls):
+    # 5, 6, 7 leave the result set after page 1 - 11, 12, 13 shift onto page 1 and are skipped by page 2
+    api = FakeTicketApi(drop_after_page=1, drop_ids=(5, 6, 7))
+    ids = list_tickets(make_ticket_client(logger, api, cls))
+    assert sorted(ids) == list(range(1, 101))
+    assert len(ids) == len(set(ids))
+    after_id_urls = api.get_after_id_urls()
+    assert len(after_id_urls) == 2
+    assert 'and ((id > 10 and id < 14))) and id > 0&' in after_id_urls[0]
+    assert '") and id > 100&' in after_id_urls[1]
+
+
+@pytest.mark.parametrize("cls", [ConnectWise, AsyncConnectWise])
+def test_iter_tickets_failed_page_reads_rest_after_last_page(logger, cls):
+    api = FakeTicketApi(fail_page=6)
+    ids = list_tickets(make_ticket_client(logger, api, cls))
+    assert ids == list(range(1, 101))
+    after_id_urls = api.get_after_id_urls()
+    # pages 1-5 end with id 50 - no gaps, the rest is read after it (5 full pages and an empty one)
+    assert len(after_id_urls) == 6
+    assert '") and id > 50&' in after_id_urls[0]
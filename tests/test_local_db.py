@@ -0,0 +1,145 @@
+import sqlite3 as sl
+
+import pytest
+
+from STELLAR_UTIL import local_db
+
+TABLE = "cw_tickets"
+
+
+def make_db(tmp_path, linkage_index=False):
+    return local_db(ticket_table_name=TABLE, optional_db_dir=str(tmp_path), linkage_index=linkage_index)
+
+
+def create_legacy_table(tmp_path, rows):
+    ''' schema 0 table as written by the releases before the migration: text ticket ids, no unique ids '''
+    con = sl.connect(str(tmp_path / "stellar_sync.db"))
+    con.execute("CREATE TABLE {} (stellar_case_id TEXT, stellar_case_number INTEGER, stellar_tenant_id TEXT, "
+                "stellar_last_modified INTEGER, remote_ticket_id TEXT, remote_ticket_last_modified INTEGER, "
+                "state TEXT, ts INTEGER);".format(TABLE))
+    con.executemany("INSERT INTO {} VALUES (?, ?, '', 0, ?, 0, ?, 0);".format(TABLE), rows)
+    con.commit()
+    con.close()
+
+
+def test_migration_moves_duplicates_to_archive(tmp_path):
+    create_legacy_table(tmp_path, [("a", 1, "100", "new"),
+                                   ("a", 1, "101", "new"),
+                                   ("b", 2, "100", "new"),
+                                   ("c", 3, "102", "closed")])
+    db = make_db(tmp_path)
+    rows = db._read("SELECT stellar_case_id, remote_ticket_id, typeof(remote_ticket_id) FROM {} ORDER BY rowid;".format(TABLE))
+    # the first row for a case / ticket is kept
+    assert rows == [("a", 100, "integer"), ("c", 102, "integer")]
+    archived = db._read("SELECT stellar_case_id, remote_ticket_id FROM {}_archive ORDER BY rowid;".format(TABLE))
+    assert archived == [("a", 101), ("b", 100)]
+    assert db._read_one("SELECT version FROM schema_version WHERE table_name = ?;", (TABLE,)) == (2,)
+    with pytest.raises(sl.IntegrityError):
+        db._write("INSERT INTO {} (stellar_case_id, remote_ticket_id) VALUES ('a', 200);".format(TABLE))
+
+
+def test_migration_runs_once(tmp_path):
+    create_legacy_table(tmp_path, [("a", 1, "100", "new"), ("a", 1, "101", "new")])
+    make_db(tmp_path).con.close()
+    db = make_db(tmp_path)
+    assert db._read_one("SELECT COUNT(*) FROM {}_archive;".format(TABLE)) == (1,)
+    assert db._read_one("SELECT COUNT(*) FROM {};".format(TABLE)) == (1,)
+
+
+@pytest.mark.parametrize("linkage_index", [False, True])
+def test_put_ticket_linkage_replaces_linkage_of_case(tmp_path, linkage_index):
+    db = make_db(tmp_path, linkage_index)
+    db.put_ticket_linkage("a", 1, "100")
+    db.put_ticket_linkage("a", 1, "101", state="reopen")
+    assert db._read_one("SELECT COUNT(*) FROM {};".format(TABLE)) == (1,)
+    linkage = db.get_ticket_linkage(stellar_case_id="a")
+    assert linkage["remote_ticket_id"] == 101
+    assert linkage["state"] == "reopen"
+    assert db.get_ticket_linkage(remote_ticket_id="100") == {}
+    assert db.get_ticket_linkage(remote_ticket_id=101)["stellar_case_id"] == "a"
+
+
+@pytest.mark.parametrize("linkage_index", [False, True])
+def test_put_ticket_linkage_refuses_ticket_of_other_case(tmp_path, linkage_index):
+    db = make_db(tmp_path, linkage_index)
+    db.put_ticket_linkage("a", 1, 100)
+    with pytest.raises(Exception, match="already linked to case"):
+        db.put_ticket_linkage("b", 2, 100)
+    assert db.get_ticket_linkage(remote_ticket_id=100)["stellar_case_id"] == "a"
+    assert db.get_ticket_linkage(stellar_case_id="b") == {}
+
+
+@pytest.mark.parametrize("linkage_index", [False, True])
+def test_archive_closed_linkages(tmp_path, linkage_index):
+    db = make_db(tmp_path, linkage_index)
+    db.put_ticket_linkage("a", 1, 100)
+    db.put_ticket_linkage("b", 2, 200)
+    db.put_ticket_linkage("c", 3, 300)
+    db.put_sync_cursor(100, "audit", {"ts": 1, "keys": [1]})
+    db.close_ticket_linkage("a")
+    db.close_ticket_linkage("c")
+    # only a was closed long enough ago
+    db._write("UPDATE {} SET ts = 0 WHERE stellar_case_id = 'a';".format(TABLE))
+    assert db.archive_closed_linkages(30) == 1
+    assert set(db.get_ticket_linkages(stellar_case_ids=["a", "b", "c"])) == {"b", "c"}
+    assert db.get_ticket_linkage(remote_ticket_id=100) == {}
+    assert db.get_sync_cursor(100, "audit") is None
+    assert db.get_archived_case_ids(["a", "b", "z"]) == {"a"}
+    assert db.archive_closed_linkages(30) == 0
+
+
+def test_get_unlinked_cases_skips_linked_and_archived_cases(tmp_path, sync_script):
+    db = make_db(tmp_path)
+    db.put_ticket_linkage("a", 1, 100)
+    db.put_ticket_linkage("b", 2, 200)
+    db.close_ticket_linkage("b")
+    db._write("UPDATE {} SET ts = 0 WHERE stellar_case_id = 'b';".format(TABLE))
+    db.archive_closed_linkages(30)
+    sync_script.LDB = db
+    cases = [{"_id": case_id} for case_id in ["a", "b", "c"]]
+    assert sync_script.get_unlinked_cases(cases) == [{"_id": "c"}]
+
+
+def count_from_other_connection(tmp_path):
+    con = sl.connect(str(tmp_path / "stellar_sync.db"))
+    try:
+        return con.execute("SELECT COUNT(*) FROM {}_cursors;".format(TABLE)).fetchone()[0]
+    finally:
+        con.close()
+
+
+def test_unit_of_work_commits_when_block_ends(tmp_path):
+    db = make_db(tmp_path)
+    with db.unit_of_work():
+        db.put_sync_cursor(100, "audit", {"ts": 1})
+        db.put_sync_cursor(200, "audit", {"ts": 1})
+        assert count_from_other_connection(tmp_path) == 0
+    assert count_from_other_connection(tmp_path) == 2
+
+
+def test_unit_of_work_nested_blocks_commit_with_outermost(tmp_path):
+    db = make_db(tmp_path)
+    with db.unit_of_work():
+        with db.unit_of_work():
+            db.put_sync_cursor(100, "audit", {"ts": 1})
+        assert count_from_other_connection(tmp_path) == 0
+    assert count_from_other_connection(tmp_path) == 1
+
+
+def test_unit_of_work_commits_when_block_raises(tmp_path):
+    db = make_db(tmp_path)
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.put_sync_cursor(100, "audit", {"ts": 1})
+            raise RuntimeError("sync failed")
+    assert count_from_other_connection(tmp_path) == 1
+    assert db.uow_depth == 0
+
+
+def test_unit_of_work_commits_linkage_right_away(tmp_path):
+    db = make_db(tmp_path)
+    with db.unit_of_work():
+        db.put_ticket_linkage("a", 1, 100)
+        con = sl.connect(str(tmp_path / "stellar_sync.db"))
+        assert con.execute("SELECT COUNT(*) FROM {};".format(TABLE)).fetchone()[0] == 1
+        con.close()
@@ -0,0 +1,187 @@
+import json
+
+import pytest
+import requests
+import urllib3
+
+import STELLAR_UTIL
+from STELLAR_UTIL import STELLAR_UTIL as StellarUtil
+
+MAX_RETRIES = 2
+
+
+class FakeResponse():
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeSession():
+    ''' returns / raises the given outcomes in turn and records the calls '''
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(method)
+        outcome = self.outcomes[min(len(self.calls), len(self.outcomes)) - 1]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+def connect_error():
+    reason = urllib3.exceptions.NewConnectionError(None, "Failed to establish a new connection")
+    return requests.exceptions.ConnectionError(urllib3.exceptions.MaxRetryError(None, "/", reason=reason))
+
+
+def reset_error():
+    return requests.exceptions.ConnectionError(urllib3.exceptions.ProtocolError("Connection aborted.", ConnectionResetError()))
+
+
+@pytest.fixture
+def stellar(logger, tmp_path, monkeypatch):
+    monkeypatch.setattr(STELLAR_UTIL.time, "sleep", lambda s: None)
+    config = {'stellar_dp': 'dp.example.com', 'stellar_saas': False, 'stellar_interflow_cache_size': 0,
+              'stellar_max_retries': MAX_RETRIES}
+    return StellarUtil(logger, config, optional_data_path=str(tmp_path))
+
+
+@pytest.mark.parametrize("method, status_code, calls", [
+    ("GET", 503, MAX_RETRIES + 1),
+    ("PUT", 500, MAX_RETRIES + 1),
+    ("POST", 503, 1),
+    ("POST", 500, 1),
+    ("POST", 429, MAX_RETRIES + 1),
+    ("GET", 404, 1),
+])
+def test_send_retry_status(stellar, method, status_code, calls):
+    stellar.session = FakeSession(status_code)
+    r = stellar._send(method, "/connect/api/v1/cases", {})
+    assert r.status_code == status_code
+    assert len(stellar.session.calls) == calls
+
+
+def test_send_returns_once_retry_succeeds(stellar):
+    stellar.session = FakeSession(503, 200)
+    assert stellar._send("GET", "/connect/api/v1/cases", {}).status_code == 200
+    assert len(stellar.session.calls) == 2
+
+
+@pytest.mark.parametrize("method", ["GET", "POST"])
+def test_send_retries_connect_error(stellar, method):
+    stellar.session = FakeSession(connect_error(), 200)
+    assert stellar._send(method, "/connect/api/v1/cases", {}).status_code == 200
+    assert len(stellar.session.calls) == 2
+
+
+def test_send_does_not_replay_post_after_reset(stellar):
+    stellar.session = FakeSession(reset_error(), 200)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        stellar._send("POST", "/connect/api/v1/cases", {})
+    assert len(stellar.session.calls) == 1
+
+
+def test_send_raises_when_retries_exhausted(stellar):
+    stellar.session = FakeSession(reset_error())
+    with pytest.raises(requests.exceptions.ConnectionError):
+        stellar._send("GET", "/connect/api/v1/cases", {})
+    assert len(stellar.session.calls) == MAX_RETRIES + 1
+
+
+def make_record(i, size=10):
+    return {"_id": str(i), "payload": "x" * size}
+
+
+def test_interflow_cache_evicts_least_recently_used():
+    cache = STELLAR_UTIL.interflow_cache(max_size=2)
+    cache.put(("aella-ser", "1"), make_record(1))
+    cache.put(("aella-ser", "2"), make_record(2))
+    assert cache.get(("aella-ser", "1")) == make_record(1)
+    cache.put(("aella-ser", "3"), make_record(3))
+    assert cache.get(("aella-ser", "2")) is None
+    assert cache.get(("aella-ser", "1")) == make_record(1)
+    assert cache.get(("aella-ser", "3")) == make_record(3)
+    stats = cache.get_stats()
+    assert (stats["size"], stats["evictions"], stats["hits"], stats["misses"]) == (2, 1, 3, 1)
+
+
+def test_interflow_cache_keys_include_index():
+    cache = STELLAR_UTIL.interflow_cache()
+    cache.put(("aella-ser", "1"), make_record(1))
+    assert cache.get(("aella-syslog", "1")) is None
+
+
+def test_interflow_cache_returns_copies():
+    cache = STELLAR_UTIL.interflow_cache()
+    cache.put(("aella-ser", "1"), make_record(1))
+    cache.get(("aella-ser", "1"))["payload"] = "changed"
+    assert cache.get(("aella-ser", "1")) == make_record(1)
+
+
+def test_interflow_cache_byte_limit():
+    record_bytes = len(json.dumps(make_record(1, 100)))
+    cache = STELLAR_UTIL.interflow_cache(max_size=100, max_bytes=record_bytes * 2)
+    for i in range(3):
+        cache.put(("aella-ser", str(i)), make_record(i, 100))
+    assert cache.get_stats()["bytes"] == record_bytes * 2
+    assert cache.get(("aella-ser", "0")) is None
+    # a record larger than the whole cache is not kept and does not evict the others
+    cache.put(("aella-ser", "big"), make_record("big", record_bytes * 2))
+    assert cache.get(("aella-ser", "big")) is None
+    assert cache.get(("aella-ser", "1")) == make_record(1, 100)
+    assert cache.get(("aella-ser", "2")) == make_record(2, 100)
+    assert cache.get_stats()["bytes"] == record_bytes * 2
+
+
+def test_interflow_cache_replaces_record():
+    cache = STELLAR_UTIL.interflow_cache()
+    cache.put(("aella-ser", "1"), make_record(1, 100))
+    cache.put(("aella-ser", "1"), make_record(1, 10))
+    assert cache.get(("aella-ser", "1")) == make_record(1, 10)
+    assert cache.get_stats()["bytes"] == len(json.dumps(make_record(1, 10)))
+
+
+def test_interflow_cache_ttl(monkeypatch):
+    cache = STELLAR_UTIL.interflow_cache(ttl=60)
+    now = STELLAR_UTIL.time.time()
+    cache.put(("aella-ser", "1"), make_record(1))
+    monkeypatch.setattr(STELLAR_UTIL.time, "time", lambda: now + 61)
+    assert cache.get(("aella-ser", "1")) is None
+    assert cache.get_stats()["size"] == 0
+
+
+def test_interflow_cache_spill(tmp_path):
+    cache = STELLAR_UTIL.interflow_cache(max_size=1, spill_file_path=str(tmp_path / "interflow_cache.db"))
+    cache.put(("aella-ser", "1"), make_record(1))
+    cache.put(("aella-ser", "2"), make_record(2))
+    assert cache.get_stats()["spill_size"] == 1
+    # moved back to memory - and record 2 is spilled in turn
+    assert cache.get(("aella-ser", "1")) == make_record(1)
+    stats = cache.get_stats()
+    assert (stats["spill_hits"], stats["spill_size"], stats["size"]) == (1, 1, 1)
+    assert cache.get(("aella-ser", "2")) == make_record(2)
+    cache.invalidate(("aella-ser", "1"))
+    cache.invalidate(("aella-ser", "2"))
+    assert cache.get(("aella-ser", "1")) is None
+    assert cache.get(("aella-ser", "2")) is None
+    assert cache.get_stats()["spill_size"] == 0
+
+
+def test_interflow_cache_spill_survives_restart(tmp_path):
+    spill_file_path = str(tmp_path / "interflow_cache.db")
+    cache = STELLAR_UTIL.interflow_cache(max_size=1, spill_file_path=spill_file_path)
+    cache.put(("aella-ser", "1"), make_record(1))
+    cache.put(("aella-ser", "2"), make_record(2))
+    cache = STELLAR_UTIL.interflow_cache(max_size=1, spill_file_path=spill_file_path)
+    assert cache.get_stats()["spill_size"] == 1
+    assert cache.get(("aella-ser", "1")) == make_record(1)
+
+
+def test_interflow_cache_spill_is_pruned(tmp_path):
+    cache = STELLAR_UTIL.interflow_cache(max_size=1, spill_file_path=str(tmp_path / "interflow_cache.db"),
+                                         spill_max_size=10)
+    for i in range(30):
+        cache.put(("aella-ser", str(i)), make_record(i))
+    assert cache.get_stats()["spill_size"] <= 11
+    assert cache.get(("aella-ser", "28")) == make_record(28)